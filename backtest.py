@@ -4,29 +4,103 @@ import matplotlib
 matplotlib.use("Agg")  # just in case
 import matplotlib.pyplot as plt
 import matplotlib.ticker as mticker
+from src.profiling import profiled
+from src.features import MARKETS, market_columns
 
-def simulate_returns(preds, df_full, model="logreg", threshold=0.3, stake=1.0):
-    prob_col = f"{model}_prob"
-    flagged = preds[preds[prob_col] >= threshold].copy()
+MODELS = ["logreg", "rf", "xgb"]
 
-    if len(flagged) == 0:
-        print(f"  no bets at threshold={threshold} for {model}")
-        return pd.DataFrame(), {}
+# the b365 favourite bet in each market, see features.FAVOURITES
+MARKET_FAVS = {"1x2": "fav", "ou": "ou_fav", "ah": "ah_fav"}
 
-    need = ["B365H", "B365D", "B365A", "FTR", "b365_ph", "b365_pd", "b365_pa", "Date", "league"]
+def bet_table(preds, df_full, stake=1.0, market="1x2"):
+    # flat bet on the b365 closing favourite of `market` for every predicted
+    # match, settled off its payout column (ah pushes / half wins included).
+    # built once and shared by every model/threshold
+    fav = MARKET_FAVS[market]
+    need = [f"{fav}_outcome", f"{fav}_odds", f"{fav}_won", f"{fav}_payout", "FTR", "Date", "league"]
     need = [c for c in need if c in df_full.columns]
-    flagged = flagged.join(df_full[need], how="left")
+    bets = df_full[need].reindex(preds.index)
+    # no price or no settled result (o/u not quoted, no AHh, no score) is no
+    # bet. those rows stay so the table lines up with preds, flagged
+    # valid=False with zero odds / won / pnl, and never count as bets
+    payout = bets[f"{fav}_payout"].astype(np.float64)
+    odds = bets[f"{fav}_odds"].astype(np.float64)
+    valid = (bets[f"{fav}_outcome"].notna() & payout.notna() & odds.notna()).to_numpy()
+    bets["valid"] = valid
+    bets["odds"] = np.where(valid, odds, 0.0)
+    bets["won"] = valid & bets[f"{fav}_won"].fillna(False).astype(bool).to_numpy()
+    bets["pnl"] = np.where(valid, stake * (payout - 1), 0.0)
+
+    # pinnacle's de-vigged prob of the same outcome, a sharp estimate of the
+    # favourite's chance of winning (what kelly wants, p_col="ps_p")
+    ps_cols = market_columns(market, "ps")
+    if f"{fav}_outcome" in bets.columns and all(c in df_full.columns for c in ps_cols):
+        codes = pd.Categorical(bets[f"{fav}_outcome"], categories=MARKETS[market]["outcomes"]).codes
+        probs = df_full[ps_cols].reindex(preds.index).to_numpy(dtype=np.float64)
+        bets["ps_p"] = np.where(codes >= 0, probs[np.arange(len(bets)), codes.clip(0)], np.nan)
+    return bets
+
+@profiled
+def sweep_returns(preds, df_full, models=None, thresholds=None, stake=1.0, markets=("1x2",)):
+    # every (model, threshold, market) in one go: sort each model's probs
+    # descending, cumsum the payoffs, and the bets at threshold t are just the
+    # first count(prob >= t) rows of that ordering. the markets share the
+    # sort, their payoffs are extra columns of the same cumsum
+    models = [m for m in (models or MODELS) if f"{m}_prob" in preds.columns]
+    thresholds = np.asarray(thresholds if thresholds is not None else np.linspace(0, 1, 1001), dtype=np.float64)
+    markets = list(markets)
 
-    flagged["fav_col"] = flagged[["b365_ph", "b365_pd", "b365_pa"]].idxmax(axis=1)
-    flagged["fav_outcome"] = flagged["fav_col"].map(
-        {"b365_ph": "H", "b365_pd": "D", "b365_pa": "A"}
-    )
+    tables = [bet_table(preds, df_full, stake=stake, market=mk) for mk in markets]
+    pnl = np.column_stack([b["pnl"].to_numpy() for b in tables])
+    valid = np.column_stack([b["valid"].to_numpy(dtype=np.float64) for b in tables])
+    won = np.column_stack([b["won"].to_numpy(dtype=np.float64) for b in tables])
+    odds = np.column_stack([b["odds"].to_numpy(dtype=np.float64) for b in tables])
 
-    odds_map = {"b365_ph": "B365H", "b365_pd": "B365D", "b365_pa": "B365A"}
-    flagged["fav_odds"] = flagged.apply(lambda r: r[odds_map[r["fav_col"]]], axis=1)
-    flagged["won"] = flagged["fav_outcome"] == flagged["FTR"]
+    probs = preds[[f"{m}_prob" for m in models]].to_numpy(dtype=np.float64)
+    order = np.argsort(-probs, axis=0, kind="stable")
+    sorted_probs = np.take_along_axis(probs, order, axis=0)
+
+    # leading zero row so cum[k] is the total over the top k bets.
+    # (n_bets + 1, n_models, n_markets)
+    def cum(v):
+        return np.concatenate([np.zeros((1, len(models), len(markets))), np.cumsum(v[order], axis=0)])
+
+    cum_pnl, cum_won, cum_odds, cum_valid = cum(pnl), cum(won), cum(odds), cum(valid)
+
+    # rows flagged at each threshold; the bets are the valid ones among them
+    top = np.stack([
+        np.searchsorted(-sorted_probs[:, j], -thresholds, side="right") for j in range(len(models))
+    ], axis=1)
+    shape = (len(thresholds), len(models), len(markets))
+    top = np.broadcast_to(top[:, :, None], shape)
+    cols = np.arange(len(models))[None, :, None]
+    mks = np.arange(len(markets))[None, None, :]
+    n_bets = cum_valid[top, cols, mks].astype(int)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        out = pd.DataFrame({
+            "model": np.broadcast_to(np.array(models)[None, :, None], shape).ravel(),
+            "market": np.broadcast_to(np.array(markets)[None, None, :], shape).ravel(),
+            "threshold": np.broadcast_to(thresholds[:, None, None], shape).ravel(),
+            "n_bets": n_bets.ravel(),
+            "n_won": cum_won[top, cols, mks].astype(int).ravel(),
+            "strike_rate": (cum_won[top, cols, mks] / n_bets).ravel(),
+            "avg_odds": (cum_odds[top, cols, mks] / n_bets).ravel(),
+            "total_pnl": cum_pnl[top, cols, mks].ravel(),
+            "roi": (cum_pnl[top, cols, mks] / (n_bets * stake)).ravel(),
+        })
+    return out
+
+def simulate_returns(preds, df_full, model="logreg", threshold=0.3, stake=1.0, market="1x2"):
+    prob_col = f"{model}_prob"
+    flagged = preds[preds[prob_col] >= threshold]
+    flagged = flagged.join(bet_table(flagged, df_full, stake=stake, market=market))
+    flagged = flagged[flagged["valid"]].copy()
+
+    if len(flagged) == 0:
+        print(f"  no bets at threshold={threshold} for {model}")
+        return pd.DataFrame(), {}
 
-    flagged["pnl"] = np.where(flagged["won"], stake * (flagged["fav_odds"] - 1), -stake)
     flagged["cumulative_pnl"] = flagged["pnl"].cumsum()
 
     n = len(flagged)
@@ -34,28 +108,190 @@ def simulate_returns(preds, df_full, model="logreg", threshold=0.3, stake=1.0):
 
     summary = {
         "model": model,
+        "market": market,
         "threshold": threshold,
         "n_bets": n,
         "n_won": int(flagged["won"].sum()),
-        "strike_rate": f"{flagged['won'].mean():.1%}",
-        "avg_odds": f"{flagged['fav_odds'].mean():.2f}",
-        "total_pnl": f"£{total:.2f}",
-        "roi": f"{(total / (n * stake)) * 100:.1f}%",
+        "strike_rate": flagged["won"].mean(),
+        "avg_odds": flagged["odds"].mean(),
+        "total_pnl": total,
+        "roi": total / (n * stake),
     }
 
     return flagged, summary
 
-def threshold_sweep(preds, df_full, model="logreg", stake=1.0):
-    rows = []
+@profiled
+def threshold_sweep(preds, df_full, model="logreg", stake=1.0, market="1x2"):
     thresholds = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6]
-    for t in thresholds:
-        _, s = simulate_returns(preds, df_full, model=model, threshold=t, stake=stake)
-        if s:
-            rows.append(s)
+    out = sweep_returns(preds, df_full, models=[model], thresholds=thresholds, stake=stake, markets=[market])
+    out = out[out["n_bets"] > 0].reset_index(drop=True)
 
-    out = pd.DataFrame(rows)
     print(f"\n--- threshold sweep ({model}) ---")
-    print(out.to_string(index=False))
+    print(out.to_string(index=False, formatters={
+        "strike_rate": "{:.1%}".format, "avg_odds": "{:.2f}".format,
+        "total_pnl": "£{:.2f}".format, "roi": "{:.1%}".format,
+    }))
+    return out
+
+# ---- staking / bankroll ----
+
+STRATEGIES = ["flat", "proportional", "kelly"]
+
+def stake_fractions(odds, p, strategy, fraction=0.02, kelly_mult=0.25, max_fraction=0.2):
+    # fraction of the current bankroll put on each bet. flat staking doesn't
+    # use this (fixed stake). kelly: f* = (p*o - 1) / (o - 1), scaled down by
+    # kelly_mult and capped; no bet when the edge is negative
+    if strategy == "proportional":
+        return np.full(np.shape(odds), fraction)
+    if strategy == "kelly":
+        with np.errstate(invalid="ignore", divide="ignore"):
+            f = (p * odds - 1) / (odds - 1)
+        return np.clip(np.nan_to_num(f * kelly_mult), 0, max_fraction)
+    return np.zeros(np.shape(odds))
+
+def bankroll_paths(returns, fractions, strategy="flat", bankroll=100.0, stake=1.0, ruin_level=1.0):
+    # returns: (..., n_bets) net return per unit staked (odds - 1 or -1).
+    # works on a single sequence or a (n_resamples, n_bets) block.
+    # once the bankroll drops to ruin_level we stop betting
+    if returns.shape[-1] == 0:
+        return np.zeros(returns.shape), np.zeros(returns.shape), np.full(returns.shape[:-1], -1)
+
+    if strategy == "flat":
+        stakes = np.full(returns.shape, float(stake))
+        path = bankroll + np.cumsum(stakes * returns, axis=-1)
+    else:
+        path = bankroll * np.cumprod(1 + fractions * returns, axis=-1)
+        prev = np.concatenate([np.full(returns.shape[:-1] + (1,), float(bankroll)), path[..., :-1]], axis=-1)
+        stakes = fractions * prev
+
+    ruined = np.maximum.accumulate(path <= ruin_level, axis=-1)
+    # everything after the first ruined bet is frozen at the ruin value
+    after = np.concatenate([np.zeros(ruined.shape[:-1] + (1,), dtype=bool), ruined[..., :-1]], axis=-1)
+    first = np.argmax(ruined, axis=-1)
+    at_ruin = np.take_along_axis(path, first[..., None], axis=-1)
+    path = np.where(after, at_ruin, path)
+    stakes = np.where(after, 0.0, stakes)
+
+    ruin_bet = np.where(ruined[..., -1], first + 1, -1)
+    return path, stakes, ruin_bet
+
+def max_drawdown(path, bankroll):
+    full = np.concatenate([np.full(path.shape[:-1] + (1,), float(bankroll)), path], axis=-1)
+    peak = np.maximum.accumulate(full, axis=-1)
+    return ((peak - full) / peak).max(axis=-1)
+
+def _strategy_inputs(preds, df_full, model, threshold, strategy, p_col, fraction, kelly_mult, max_fraction,
+                     market="1x2"):
+    prob_col = f"{model}_prob"
+    flagged = preds[preds[prob_col] >= threshold]
+    bets = bet_table(flagged, df_full, market=market)
+    bets = bets[bets["valid"]]
+    # chronological, not per-league, so the bankroll sees bets in date order
+    if "Date" in bets.columns:
+        bets = bets.sort_values("Date", kind="stable")
+
+    odds = bets["odds"].to_numpy(dtype=np.float64)
+    # net per unit staked: odds - 1, -1, 0 on a push and in between on ah quarter lines
+    returns = bets["pnl"].to_numpy()
+    # kelly needs the favourite's win probability. the model score is
+    # P(high_gap), not that, so it has to be named: "ps_p" (de-vigged
+    # pinnacle, from bet_table) or a column of preds / df_full, e.g. a
+    # calibrated win model
+    p = None
+    if strategy == "kelly":
+        if p_col is None:
+            raise ValueError("kelly staking needs p_col, a win probability for the favourite "
+                             "(e.g. 'ps_p'); the model score is not one")
+        src = next((t for t in (bets, flagged, df_full) if p_col in t.columns), None)
+        if src is None:
+            raise ValueError(f"p_col {p_col} not found in the bets, preds or df_full")
+        p = src[p_col].reindex(bets.index).to_numpy(dtype=np.float64)
+    f = stake_fractions(odds, p, strategy, fraction=fraction, kelly_mult=kelly_mult, max_fraction=max_fraction)
+    return bets, returns, f
+
+def simulate_bankroll(preds, df_full, model="logreg", threshold=0.3, strategy="flat",
+                      bankroll=100.0, stake=1.0, fraction=0.02, kelly_mult=0.25, max_fraction=0.2,
+                      p_col=None, ruin_level=1.0, market="1x2"):
+    bets, returns, f = _strategy_inputs(preds, df_full, model, threshold, strategy,
+                                        p_col, fraction, kelly_mult, max_fraction, market)
+    path, stakes, ruin_bet = bankroll_paths(returns, f, strategy=strategy, bankroll=bankroll,
+                                            stake=stake, ruin_level=ruin_level)
+
+    bets = bets.assign(stake=stakes, bankroll=path)
+    prev = np.concatenate([[bankroll], path[:-1]]) if len(path) else path
+    placed = stakes > 0
+    with np.errstate(invalid="ignore", divide="ignore"):
+        step = (path - prev)[placed] / prev[placed]
+
+    staked = stakes.sum()
+    final = path[-1] if len(path) else bankroll
+    summary = {
+        "model": model,
+        "market": market,
+        "threshold": threshold,
+        "strategy": strategy,
+        "n_bets": int(placed.sum()),
+        "total_staked": staked,
+        "final_bankroll": final,
+        "pnl": final - bankroll,
+        "roi": (final - bankroll) / staked if staked > 0 else np.nan,
+        "max_drawdown": max_drawdown(path, bankroll) if len(path) else 0.0,
+        "sharpe_per_bet": step.mean() / step.std() if len(step) > 1 and step.std() > 0 else np.nan,
+        "ruin_bet": int(ruin_bet) if ruin_bet >= 0 else np.nan,
+    }
+    return bets, summary
+
+@profiled
+def bootstrap_bankroll(preds, df_full, model="logreg", threshold=0.3, strategy="flat",
+                       bankroll=100.0, stake=1.0, fraction=0.02, kelly_mult=0.25, max_fraction=0.2,
+                       p_col=None, ruin_level=1.0, n_boot=5000, ci=0.95, seed=42, batch=500, market="1x2"):
+    # resample the bet sequence with replacement n_boot times and push every
+    # resample through bankroll_paths as one (batch, n_bets) block
+    _, returns, f = _strategy_inputs(preds, df_full, model, threshold, strategy,
+                                     p_col, fraction, kelly_mult, max_fraction, market)
+    n = len(returns)
+    if n == 0:
+        return {}
+
+    rng = np.random.default_rng(seed)
+    roi, dd, ruined = [], [], []
+    for start in range(0, n_boot, batch):
+        idx = rng.integers(0, n, size=(min(batch, n_boot - start), n))
+        path, stakes, ruin_bet = bankroll_paths(returns[idx], f[idx], strategy=strategy,
+                                                bankroll=bankroll, stake=stake, ruin_level=ruin_level)
+        staked = stakes.sum(axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            roi.append((path[:, -1] - bankroll) / staked)
+        dd.append(max_drawdown(path, bankroll))
+        ruined.append(ruin_bet >= 0)
+
+    roi, dd, ruined = np.concatenate(roi), np.concatenate(dd), np.concatenate(ruined)
+    lo, hi = (1 - ci) / 2, 1 - (1 - ci) / 2
+    return {
+        "n_boot": n_boot,
+        "roi_median": np.nanmedian(roi),
+        "roi_lo": np.nanquantile(roi, lo),
+        "roi_hi": np.nanquantile(roi, hi),
+        # resamples with nothing staked have no roi, they don't count either way
+        "p_loss": np.mean(roi[np.isfinite(roi)] < 0) if np.isfinite(roi).any() else np.nan,
+        "max_drawdown_median": np.median(dd),
+        "max_drawdown_hi": np.quantile(dd, hi),
+        "p_ruin": ruined.mean(),
+    }
+
+@profiled
+def staking_report(preds, df_full, model="logreg", threshold=0.3, **kwargs):
+    rows = []
+    for strategy in STRATEGIES:
+        _, summary = simulate_bankroll(preds, df_full, model=model, threshold=threshold,
+                                       strategy=strategy, **kwargs)
+        boot = bootstrap_bankroll(preds, df_full, model=model, threshold=threshold,
+                                  strategy=strategy, **kwargs)
+        rows.append({**summary, **boot})
+
+    out = pd.DataFrame(rows)
+    print(f"\n--- staking ({model}, threshold={threshold}) ---")
+    print(out[["strategy", "n_bets", "roi", "roi_lo", "roi_hi", "max_drawdown", "p_ruin"]].round(4).to_string(index=False))
     return out
 
 def plot_cumulative_pnl(preds, df_full, threshold=0.3, stake=1.0,
@@ -73,7 +309,7 @@ def plot_cumulative_pnl(preds, df_full, threshold=0.3, stake=1.0,
             continue
 
         bets = bets.sort_index()
-        lbl = f"{m}  (n={info['n_bets']}, roi={info['roi']}, pnl={info['total_pnl']})"
+        lbl = f"{m}  (n={info['n_bets']}, roi={info['roi']:.1%}, pnl=£{info['total_pnl']:.2f})"
         ax.plot(range(len(bets)), bets["cumulative_pnl"],
                 label=lbl, color=colors[m], lw=2)
 
@@ -97,13 +333,13 @@ def plot_walk_forward_auc(fold_stats, save_path="output/plots/walk_forward_auc.p
     fig.patch.set_facecolor("white")
 
     for name, grp in fold_stats.groupby("model"):
-        ax.plot(grp["season"], grp["roc_auc"], marker="o",
+        ax.plot(grp["test_period"], grp["roc_auc"], marker="o",
                 label=name, color=colors.get(name, "grey"), lw=2)
 
     ax.axhline(0.5, color="grey", lw=0.8, ls="--", label="random baseline")
     ax.set_ylim(0.4, 1.05)
     ax.set_ylabel("roc-auc", fontsize=11)
-    ax.set_title("walk-forward auc by season", fontsize=13)
+    ax.set_title("walk-forward auc by test period", fontsize=13)
     ax.legend()
     ax.grid(axis="y", ls="--", alpha=0.5)
 
@@ -0,0 +1,98 @@
+# python -m bench.cube
+# checks the sufficient-statistics cube against plain pandas groupbys on a
+# synthetic feature frame: every cell of match_cube, roll-ups against a
+# direct build at the coarser dims, brier_table against per-season brier
+# scores and calibration_data against sklearn's calibration_curve. times
+# the cube against the per-target groupbys it replaces
+import time
+import numpy as np
+import pandas as pd
+from sklearn.calibration import calibration_curve
+from src.features import build_features
+from src.analysis.cube import DIMS, PROB_BUCKETS, FAV_TARGET, outcome_targets, match_rows, match_cube, rollup
+from src.analysis.calibration import brier_table, brier_score, calibration_data
+from bench.scoring import synthetic_history
+
+def reference_cube(df, dims=DIMS):
+    # one groupby per target, the way the tables used to be built
+    df = match_rows(df)
+    frame_dims = [d for d in dims if d != "prob_bucket"]
+    parts = []
+    for name, spec in {**outcome_targets(df), **FAV_TARGET}.items():
+        y = df[spec["y"]] if isinstance(spec["y"], str) else spec["y"]
+        sub = df[frame_dims].assign(p=df[spec["p"]].astype(np.float64), y=np.asarray(y, dtype=np.float64))
+        sub = sub[sub["p"].notna() & sub["y"].notna()]
+        if "prob_bucket" in dims:
+            sub["prob_bucket"] = pd.cut(sub["p"], PROB_BUCKETS)
+            sub = sub[sub["prob_bucket"].notna()]
+        sub["sq"] = (sub["p"] - sub["y"]) ** 2
+        g = sub.groupby(list(dims), observed=True, dropna=False).agg(
+            n=("p", "size"), sum_p=("p", "sum"), sum_y=("y", "sum"), sum_sq=("sq", "sum"))
+        parts.append(g.reset_index().assign(target=name))
+    return pd.concat(parts, ignore_index=True)
+
+def key(frame, dims):
+    out = frame.copy()
+    for d in ["target", *dims]:
+        out[d] = out[d].astype(str)
+    return out.set_index(["target", *dims]).sort_index()
+
+def assert_same(a, b, dims):
+    a, b = key(a, dims), key(b, dims)
+    assert a.index.equals(b.index), "cube cells differ"
+    assert (a["n"].to_numpy() == b["n"].to_numpy()).all()
+    for c in ["sum_p", "sum_y", "sum_sq"]:
+        np.testing.assert_allclose(a[c].to_numpy(), b[c].to_numpy(), rtol=1e-9, atol=1e-9)
+
+def check(df):
+    cube = match_cube(df)
+    assert_same(cube[["target", *DIMS, "n", "sum_p", "sum_y", "sum_sq"]], reference_cube(df), DIMS)
+
+    # a roll-up is the same as building at the coarser dims
+    for by in [["season"], ["league", "season"], ["movement_cat"], []]:
+        assert_same(rollup(cube, by), match_cube(df, dims=by), by)
+
+    # brier_table off the cube vs brier_score per season
+    rows = match_rows(df)
+    brier = brier_table(cube, ["season"]).set_index("season")
+    for season, grp in rows.groupby("season", observed=True):
+        ok = grp["b365_ph"].notna()
+        ref = brier_score(grp.loc[ok, "b365_ph"].astype(np.float64), (grp.loc[ok, "FTR"] == "H").astype(float))
+        assert np.isclose(brier.loc[season, "brier_h"], ref, rtol=1e-9)
+
+    # quantile calibration bins vs sklearn
+    for outcome, col in [("H", "b365_ph"), ("A", "ps_pa")]:
+        mean_pred, frac_pos = calibration_data(rows, outcome, col)
+        ok = rows[col].notna()
+        ref_pos, ref_pred = calibration_curve(rows.loc[ok, "FTR"] == outcome, rows.loc[ok, col],
+                                              n_bins=10, strategy="quantile")
+        np.testing.assert_allclose(mean_pred, ref_pred, rtol=1e-6)
+        np.testing.assert_allclose(frac_pos, ref_pos, rtol=1e-9)
+    return len(cube)
+
+def timed(fn, df, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn(df)
+        best = min(best, time.perf_counter() - t)
+    return best
+
+def main():
+    rows = []
+    for n_seasons, per_season in [(3, 2000), (5, 10_000), (10, 20_000)]:
+        df = build_features(synthetic_history(n_seasons, per_season), detect_flip=True)
+        cells = check(df)
+        t_ref = timed(reference_cube, df)
+        t_cube = timed(match_cube, df)
+        rows.append({
+            "matches": len(df),
+            "cube_rows": cells,
+            "groupby_s": round(t_ref, 4),
+            "cube_s": round(t_cube, 4),
+            "speedup": round(t_ref / t_cube, 1),
+        })
+    print(pd.DataFrame(rows).to_string(index=False))
+
+if __name__ == "__main__":
+    main()
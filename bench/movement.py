@@ -0,0 +1,94 @@
+# python -m bench.movement
+# regression check + timing for categorise_movement against the old
+# row-wise version on synthetic open/close b365 probs with NaNs in them
+import time
+import numpy as np
+import pandas as pd
+from src.features import categorise_movement, add_line_movement
+
+def synthetic_probs(n, seed=0):
+    rng = np.random.default_rng(seed)
+    open_ph = rng.uniform(0.1, 0.8, n)
+    open_pa = rng.uniform(0.1, 0.9 - open_ph)
+    ph = np.clip(open_ph + rng.normal(0, 0.04, n), 0.02, 0.95)
+    pa = np.clip(open_pa + rng.normal(0, 0.04, n), 0.02, 0.95)
+    # a slice of equal home/away probs, the home side is favourite on ties
+    tie = rng.random(n) < 0.005
+    pa[tie] = ph[tie]
+    df = pd.DataFrame({"b365_ph": ph, "b365_pa": pa, "b365_open_ph": open_ph, "b365_open_pa": open_pa})
+    for col in df.columns:
+        df.loc[rng.random(n) < 0.02, col] = np.nan
+    # float32 like the feature frame
+    return df.astype(np.float32)
+
+def old_categorise_movement(row):
+    # the pre-vectorised version, kept here as the reference
+    if any(np.isnan(v) for v in [row["b365_ph"], row["b365_pa"], row["b365_open_ph"], row["b365_open_pa"]]):
+        return np.nan
+
+    home_fav = row["b365_ph"] >= row["b365_pa"]
+    if home_fav:
+        close_p, open_p = row["b365_ph"], row["b365_open_ph"]
+    else:
+        close_p, open_p = row["b365_pa"], row["b365_open_pa"]
+
+    delta = close_p - open_p  # positive = steamed (shortened), negative = drifted
+
+    if abs(delta) < 0.02:
+        return "stable_fav" if close_p >= 0.5 else "stable_dog"
+    elif delta > 0.02:
+        return "steamed_fav"
+    elif delta < -0.02:
+        return "drifted_fav"
+    else:
+        # implied favourite flipped between open and close
+        return "flip"
+
+def check(df):
+    ref = df.apply(old_categorise_movement, axis=1).astype(object)
+    new = pd.Series(categorise_movement(df), index=df.index).astype(object)
+
+    # the old else branch only fired at |delta| == 0.02 exactly, those go to
+    # steamed / drifted by the sign of delta now. everything else must agree
+    edge = ref == "flip"
+    home_fav = df["b365_ph"] >= df["b365_pa"]
+    delta = np.where(home_fav, df["b365_ph"] - df["b365_open_ph"], df["b365_pa"] - df["b365_open_pa"])
+    assert (np.abs(delta[edge]) == 0.02).all()
+    assert (new[edge] == np.where(delta[edge] > 0, "steamed_fav", "drifted_fav")).all()
+    assert ref[~edge].equals(new[~edge]), "labels differ from the row-wise version"
+
+    # detect_flip only relabels matches whose favourite changed side
+    flip = pd.Series(categorise_movement(df, detect_flip=True), index=df.index).astype(object)
+    changed = new.notna() & (flip != new)
+    side = home_fav != (df["b365_open_ph"] >= df["b365_open_pa"])
+    assert (flip[changed] == "flip").all() and side[changed].all()
+    assert (flip == "flip").sum() == (side & new.notna()).sum()
+    assert add_line_movement(df.copy(), detect_flip=True)["movement_cat"].astype(object).equals(flip)
+    return int(changed.sum())
+
+def timed(fn, df, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn(df)
+        best = min(best, time.perf_counter() - t)
+    return best
+
+def main():
+    rows = []
+    for n in [1_000, 10_000, 100_000]:
+        df = synthetic_probs(n)
+        flips = check(df)
+        t_row = timed(lambda d: d.apply(old_categorise_movement, axis=1), df, repeat=1)
+        t_vec = timed(categorise_movement, df)
+        rows.append({
+            "rows": n,
+            "flips": flips,
+            "row_wise_s": round(t_row, 4),
+            "vectorised_s": round(t_vec, 4),
+            "speedup": round(t_row / t_vec, 1),
+        })
+    print(pd.DataFrame(rows).to_string(index=False))
+
+if __name__ == "__main__":
+    main()
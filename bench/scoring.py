@@ -0,0 +1,112 @@
+# python -m bench.scoring
+# latency / throughput of score_batch and the http endpoint on synthetic odds
+# snapshots. trains a throwaway model on synthetic history into a temp
+# registry, so it doesn't need data/raw or a previous main.py run
+import json
+import time
+import tempfile
+import threading
+import urllib.request
+from http.server import ThreadingHTTPServer
+import numpy as np
+import pandas as pd
+from src.features import build_features
+from src.schema import compact
+from src.ml.train import build_ml_features, split, train_models
+from src.ml.scoring import save_scorer, load_scorer, score_batch
+from score import make_handler
+
+LEAGUES = ["E0", "SP1", "D1", "I1", "F1", "N1", "P1", "B1"]
+
+def _prices(rng, true_p, margin, noise):
+    q = np.clip(true_p + rng.normal(0, noise, true_p.shape), 0.02, 0.97)
+    q = q / q.sum(axis=1, keepdims=True) * margin
+    return np.round(1 / q, 2)
+
+def synthetic_odds(n, seed=0, start="2025-08-15"):
+    # football-data shaped snapshot rows: b365 (both price sets), pinnacle,
+    # market max/avg, with a true 1x2 probability underneath
+    rng = np.random.default_rng(seed)
+    ph = rng.uniform(0.15, 0.75, n)
+    pdr = rng.uniform(0.18, 0.30, n)
+    true_p = np.c_[ph, pdr, np.clip(1 - ph - pdr, 0.05, None)]
+    true_p = true_p / true_p.sum(axis=1, keepdims=True)
+
+    snap = {
+        "Div": rng.choice(LEAGUES, n),
+        "Date": (pd.Timestamp(start) + pd.to_timedelta(rng.integers(0, 280, n), unit="D")).strftime("%d/%m/%Y"),
+        "HomeTeam": [f"H{i}" for i in rng.integers(0, 200, n)],
+        "AwayTeam": [f"A{i}" for i in rng.integers(0, 200, n)],
+    }
+    for prefix, margin, noise in [("B365", 1.05, 0.02), ("B365C", 1.05, 0.01), ("PS", 1.03, 0.01),
+                                  ("PSC", 1.025, 0.005), ("Max", 0.99, 0.01), ("MaxC", 0.99, 0.01),
+                                  ("Avg", 1.06, 0.005)]:
+        odds = _prices(rng, true_p, margin, noise)
+        for j, side in enumerate("HDA"):
+            snap[f"{prefix}{side}"] = odds[:, j]
+    return pd.DataFrame(snap), true_p
+
+def synthetic_history(n_seasons=5, per_season=3000, seed=1):
+    frames = []
+    for s in range(n_seasons):
+        year = 2019 + s
+        snap, true_p = synthetic_odds(per_season, seed=seed + s, start=f"{year}-08-10")
+        rng = np.random.default_rng(seed + 100 + s)
+        snap["FTR"] = np.array(["H", "D", "A"])[[rng.choice(3, p=p) for p in true_p]]
+        snap["season"] = f"{year}-{(year + 1) % 100:02d}"
+        frames.append(snap)
+    df = pd.concat(frames, ignore_index=True)
+    df["league"] = df["Div"]
+    df["Date"] = pd.to_datetime(df["Date"], dayfirst=True)
+    return compact(df)
+
+def timed_batches(fn, sizes, repeats, seed=0):
+    rows = []
+    for size in sizes:
+        batches = [synthetic_odds(size, seed=seed + r)[0] for r in range(repeats)]
+        fn(batches[0])  # warm up
+        lat = []
+        for b in batches:
+            t = time.perf_counter()
+            fn(b)
+            lat.append(time.perf_counter() - t)
+        lat = np.array(lat) * 1000
+        rows.append({
+            "batch": size,
+            "p50_ms": round(np.percentile(lat, 50), 2),
+            "p95_ms": round(np.percentile(lat, 95), 2),
+            "rows_per_s": int(size / (np.median(lat) / 1000)),
+        })
+    return pd.DataFrame(rows)
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        df = build_features(synthetic_history())
+        ml_df, pipeline = build_ml_features(df)
+        X_train, _, y_train, _ = split(ml_df)
+        models = train_models(X_train, y_train, registry_dir=tmp)
+        save_scorer(models, pipeline, path=f"{tmp}/scorer.joblib")
+
+        sizes = [1, 10, 100, 1000, 10000]
+        for name in ["logreg", "xgb"]:
+            scorer = load_scorer(f"{tmp}/scorer.joblib", model=name, registry_dir=tmp)
+            print(f"\n--- score_batch ({name}) ---")
+            print(timed_batches(lambda b: score_batch(b, scorer), sizes, repeats=20).to_string(index=False))
+
+        scorer = load_scorer(f"{tmp}/scorer.joblib", model="logreg", registry_dir=tmp)
+        server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(scorer))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_address[1]}/score"
+
+        def post(batch):
+            body = json.dumps(batch.to_dict(orient="records")).encode()
+            req = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"})
+            with urllib.request.urlopen(req) as resp:
+                return resp.read()
+
+        print("\n--- http /score (logreg, json) ---")
+        print(timed_batches(post, sizes[:4], repeats=20).to_string(index=False))
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
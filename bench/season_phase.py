@@ -0,0 +1,62 @@
+# python -m bench.season_phase
+# times add_season_phase against the old per-season loop on synthetic
+# archives of growing size (380 matches per league-season)
+import time
+import numpy as np
+import pandas as pd
+from src.features import add_season_phase
+from src.schema import compact
+
+def synthetic_matches(n_leagues, n_seasons, per_season=380, seed=0):
+    rng = np.random.default_rng(seed)
+    frames = []
+    for lg in range(n_leagues):
+        for s in range(n_seasons):
+            start = pd.Timestamp(f"{1990 + s}-08-01")
+            days = np.sort(rng.integers(0, 290, per_season))
+            frames.append(pd.DataFrame({
+                "league": f"L{lg:02d}",
+                "season": f"{1990 + s}-{(s + 91) % 100:02d}",
+                "Date": start + pd.to_timedelta(days, unit="D"),
+            }))
+    return compact(pd.concat(frames, ignore_index=True))
+
+def loop_season_phase(df):
+    # the pre-vectorised version, kept here as the reference
+    df["season_phase"] = "mid"
+    for season, grp in df.groupby("season", observed=True):
+        early_cut = grp["Date"].quantile(0.26)
+        late_cut  = grp["Date"].quantile(0.74)
+        df.loc[grp[grp["Date"] <= early_cut].index, "season_phase"] = "early"
+        df.loc[grp[grp["Date"] >= late_cut].index,  "season_phase"] = "late"
+    return df
+
+def timed(fn, df, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        d = df.copy()
+        t = time.perf_counter()
+        out = fn(d)
+        best = min(best, time.perf_counter() - t)
+    return best, out
+
+def main():
+    rows = []
+    for n_leagues, n_seasons in [(4, 5), (8, 5), (20, 5), (20, 10), (20, 25), (40, 25)]:
+        df = synthetic_matches(n_leagues, n_seasons)
+        t_loop, ref = timed(loop_season_phase, df)
+        t_vec, out = timed(add_season_phase, df)
+        t_league, _ = timed(lambda d: add_season_phase(d, per_league=True), df)
+        assert (ref["season_phase"].astype(str) == out["season_phase"].astype(str)).all()
+        rows.append({
+            "league_seasons": n_leagues * n_seasons,
+            "rows": len(df),
+            "loop_s": round(t_loop, 4),
+            "vectorised_s": round(t_vec, 4),
+            "per_league_s": round(t_league, 4),
+            "speedup": round(t_loop / t_vec, 1),
+        })
+    print(pd.DataFrame(rows).to_string(index=False))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+# python -m bench.settlement
+# hand-worked over/under 2.5 and asian handicap settlements (whole, half and
+# quarter lines, pushes, missing results) against features.settle and the
+# *_payout / *_won columns add_favourites builds from them, then the time
+# to settle a large synthetic frame
+import time
+import numpy as np
+import pandas as pd
+from src.features import settle, add_implied_probs, add_favourites
+
+nan = np.nan
+
+# AHh is the home handicap. win / push are shares of the stake on each side
+AH_CASES = [
+    # AHh, FTHG, FTAG, home win, away win, push
+    (-0.5,  1, 0, 1.0, 0.0, 0.0),
+    (-0.5,  0, 0, 0.0, 1.0, 0.0),
+    ( 0.0,  0, 0, 0.0, 0.0, 1.0),
+    (-1.0,  1, 0, 0.0, 0.0, 1.0),
+    (-1.0,  2, 0, 1.0, 0.0, 0.0),
+    (-1.5,  2, 1, 0.0, 1.0, 0.0),
+    # quarter lines: half the stake on each neighbouring line
+    (-0.25, 0, 0, 0.0, 0.5, 0.5),
+    (-0.25, 1, 0, 1.0, 0.0, 0.0),
+    (-0.75, 1, 0, 0.5, 0.0, 0.5),
+    (-0.75, 2, 0, 1.0, 0.0, 0.0),
+    ( 0.25, 0, 0, 0.5, 0.0, 0.5),
+    ( 0.75, 0, 1, 0.0, 0.5, 0.5),
+    ( 1.25, 0, 1, 0.5, 0.0, 0.5),
+    (-1.25, 1, 0, 0.0, 0.5, 0.5),
+    (-1.75, 2, 0, 0.5, 0.0, 0.5),
+    # no line / no score
+    (nan,   1, 0, nan, nan, nan),
+    (-0.5, nan, 0, nan, nan, nan),
+]
+
+OU_CASES = [
+    # FTHG, FTAG, over, under
+    (2, 1, 1.0, 0.0),
+    (1, 1, 0.0, 1.0),
+    (3, 0, 1.0, 0.0),
+    (0, 0, 0.0, 1.0),
+    (nan, 1, nan, nan),
+]
+
+def check_settle():
+    ah = pd.DataFrame(AH_CASES, columns=["AHh", "FTHG", "FTAG", "win_h", "win_a", "push"])
+    win, push = settle(ah, "ah")
+    np.testing.assert_array_equal(win, ah[["win_h", "win_a"]].to_numpy())
+    np.testing.assert_array_equal(push, ah[["push", "push"]].to_numpy())
+    # every stake is fully accounted for: won + pushed + lost = 1 per side
+    ok = ~np.isnan(win).any(axis=1)
+    assert (win[ok].sum(axis=1) + push[ok, 0] <= 1).all()
+
+    ou = pd.DataFrame(OU_CASES, columns=["FTHG", "FTAG", "over", "under"])
+    win, push = settle(ou, "ou")
+    np.testing.assert_array_equal(win, ou[["over", "under"]].to_numpy())
+    assert (push[~np.isnan(push)] == 0).all()
+
+    x12 = pd.DataFrame({"FTR": ["H", "D", "A", None]})
+    win, _ = settle(x12, "1x2")
+    np.testing.assert_array_equal(win, [[1, 0, 0], [0, 1, 0], [0, 0, 1], [nan, nan, nan]])
+    return len(AH_CASES) + len(OU_CASES) + len(x12)
+
+def check_payouts():
+    # home is the b365 ah favourite and under the o/u one in every row, so
+    # ah_fav_payout = odds x home win share + push share, and the same for under
+    ah = pd.DataFrame(AH_CASES, columns=["AHh", "FTHG", "FTAG", "win_h", "win_a", "push"])
+    df = ah[["AHh", "FTHG", "FTAG"]].assign(**{"B365AHH": 1.8, "B365AHA": 2.1,
+                                               "B365>2.5": 2.2, "B365<2.5": 1.7})
+    df = add_favourites(add_implied_probs(df))
+    expected = 1.8 * ah["win_h"] + ah["push"]
+    np.testing.assert_allclose(df["ah_fav_payout"].to_numpy(dtype=np.float64), expected, rtol=1e-6)
+    assert (df["ah_fav_outcome"] == "home").all()
+    assert (df["ah_fav_won"] == (expected > 1)).all()
+
+    under = np.where(ah["FTHG"] + ah["FTAG"] > 2.5, 0.0, 1.0)
+    under[ah["FTHG"].isna()] = nan
+    np.testing.assert_allclose(df["ou_fav_payout"].to_numpy(dtype=np.float64), 1.7 * under, rtol=1e-6)
+    assert (df["ou_fav_outcome"] == "under").all()
+
+def main():
+    n_cases = check_settle()
+    check_payouts()
+    print(f"{n_cases} settlement cases ok")
+
+    rng = np.random.default_rng(0)
+    rows = []
+    for n in [10_000, 100_000, 1_000_000]:
+        df = pd.DataFrame({
+            "FTHG": rng.poisson(1.5, n).astype(float),
+            "FTAG": rng.poisson(1.2, n).astype(float),
+            "AHh": rng.integers(-10, 11, n) / 4,
+        })
+        t = time.perf_counter()
+        settle(df, "ah")
+        settle(df, "ou")
+        rows.append({"rows": n, "settle_s": round(time.perf_counter() - t, 4)})
+    print(pd.DataFrame(rows).to_string(index=False))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+# python -m bench.streaming
+# checks the out-of-core calibration sketches on synthetic football-data
+# csvs (one season without the closing prices, like pre-2019 files):
+# sketches of row splits merged together, and stream_sketch over the
+# files in small chunks (one process and a pool), against one sketch of
+# the whole loaded frame. then the brier decomposition against the direct
+# brier and the quantile bins against sklearn's calibration_curve
+import os
+import time
+import tempfile
+import numpy as np
+import pandas as pd
+from sklearn.calibration import calibration_curve
+from src.load_data import load_all
+from src.features import build_row_features
+from src.analysis.cube import match_rows
+from src.analysis.streaming import FINE_BINS, sketch, merge, stream_sketch, calibration_bins, brier_decomposition
+from bench.scoring import synthetic_history
+
+BY = ["league", "season"]
+
+# price sets football-data only has from 2019-20 on
+CLOSING_COLS = [f"{b}C{o}" for b in ["B365", "PS", "Max"] for o in "HDA"]
+
+def write_csvs(df, out_dir):
+    # one football-data style file per league-season, e.g. E0_2122.csv. the
+    # first season is written the pre-2019 way, without the closing prices
+    first = df["season"].astype(str).min()
+    for (div, season), grp in df.groupby(["Div", "season"], observed=True):
+        tag = season[2:4] + season[-2:]
+        grp = grp.drop(columns=["league", "season"]).assign(Date=grp["Date"].dt.strftime("%d/%m/%Y"))
+        if season == first:
+            grp = grp.drop(columns=CLOSING_COLS)
+        grp.to_csv(os.path.join(out_dir, f"{div}_{tag}.csv"), index=False)
+
+def assert_same(a, b):
+    keys = ["target", *BY, "bin"]
+    a = a.assign(target=a["target"].astype(str)).set_index(keys).sort_index()
+    b = b.assign(target=b["target"].astype(str)).set_index(keys).sort_index()
+    assert a.index.equals(b.index), "sketch cells differ"
+    assert (a["n"].to_numpy() == b["n"].to_numpy()).all()
+    for c in ["sum_p", "sum_y", "sum_sq"]:
+        np.testing.assert_allclose(a[c].to_numpy(), b[c].to_numpy(), rtol=1e-9, atol=1e-9)
+
+def check(data_dir, seed=0):
+    df = build_row_features(load_all(data_dir, cache_dir=None))
+    whole = sketch(df, by=BY)
+
+    # random row splits, merged in a shuffled order
+    rng = np.random.default_rng(seed)
+    parts = np.array_split(rng.permutation(len(df)), 7)
+    sketches = [sketch(df.iloc[np.sort(p)], by=BY) for p in parts]
+    assert_same(merge(*[sketches[i] for i in rng.permutation(len(sketches))]), whole)
+
+    for workers in [1, 2]:
+        assert_same(stream_sketch(data_dir, by=BY, chunksize=700, workers=workers), whole)
+
+    # brier off the sketch = brier of the rows, and the decomposition adds up
+    dec = brier_decomposition(whole, by=[])
+    rows = match_rows(df)
+    home = dec.set_index("target").loc["b365_H"]
+    y = (rows["FTR"] == "H").to_numpy(dtype=np.float64)
+    assert np.isclose(home["brier"], np.mean((rows["b365_ph"].to_numpy(dtype=np.float64) - y) ** 2), rtol=1e-9)
+    parts = dec["reliability"] - dec["resolution"] + dec["uncertainty"] + dec["within_bin"]
+    np.testing.assert_allclose(parts, dec["brier"], rtol=1e-9)
+
+    # quantile bins land within a couple of grid widths of sklearn's
+    bins = calibration_bins(whole, by=[])
+    worst = 0.0
+    for outcome, col in [("H", "b365_ph"), ("D", "b365_pd"), ("A", "ps_pa")]:
+        ok = rows[col].notna()
+        ref_pos, ref_pred = calibration_curve(rows.loc[ok, "FTR"] == outcome, rows.loc[ok, col],
+                                              n_bins=10, strategy="quantile")
+        got = bins[bins["target"] == f"{col.split('_')[0]}_{outcome}"]
+        worst = max(worst, np.abs(got["mean_pred"].to_numpy() - ref_pred).max())
+    assert worst < 5 / FINE_BINS, worst
+    return worst
+
+def timed(fn, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t)
+    return best
+
+def main():
+    rows = []
+    for n_seasons, per_season in [(3, 2000), (5, 10_000)]:
+        with tempfile.TemporaryDirectory() as data_dir:
+            write_csvs(synthetic_history(n_seasons, per_season), data_dir)
+            worst = check(data_dir)
+            t_mem = timed(lambda: sketch(build_row_features(load_all(data_dir, cache_dir=None)), by=BY))
+            t_stream = timed(lambda: stream_sketch(data_dir, by=BY, chunksize=5_000))
+            rows.append({
+                "matches": n_seasons * per_season,
+                "files": len(os.listdir(data_dir)),
+                "max_bin_diff": round(worst, 5),
+                "in_memory_s": round(t_mem, 4),
+                "streamed_s": round(t_stream, 4),
+            })
+    print(pd.DataFrame(rows).to_string(index=False))
+
+if __name__ == "__main__":
+    main()
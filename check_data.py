@@ -2,7 +2,6 @@ import os
 import glob
 
 data_dir = "data/raw"
-expected_seasons = ["2021", "2122", "2223", "2324", "2425"]
 
 files = glob.glob(os.path.join(data_dir, "*.csv"))
 
@@ -15,6 +14,9 @@ for f in files:
     league, tag = parts
     coverage.setdefault(league, set()).add(tag)
 
+# a league is missing a season if any other league has it
+expected_seasons = sorted(set().union(*coverage.values()))
+
 print(f"{'league':<10} {'seasons found':<40} {'missing'}")
 print("-" * 70)
 for league in sorted(coverage):
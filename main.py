@@ -1,109 +1,274 @@
 import os
-import pandas as pd
+import argparse
 from src.load_data import load_all
-from src.features import build_features
-from src.analysis.calibration import brier_by_season, calibration_data, favorite_accuracy
-from src.analysis.line_movement import movement_win_rates, steamed_vs_implied, movement_by_season
-from src.analysis.value_gap import gap_summary, gap_by_outcome, gap_distribution, gap_by_season
+from src.features import MARKETS, build_features_incremental
+from src.schema import memory_report
+from src.analysis.cube import match_cube
+from src.analysis.streaming import sketch, brier_decomposition
+from src.analysis.calibration import brier_table, calibration_data, favorite_accuracy
+from src.analysis.line_movement import movement_win_rates, steamed_vs_implied, movement_by_season, movement_table
+from src.analysis.value_gap import (gap_summary, gap_by_outcome, gap_by_market, gap_distribution, gap_by_season,
+                                   book_gaps, outlier_scan, gap_threshold_sweep)
 from src.ml.train import build_ml_features, split, train_models
-from src.ml.evaluate import evaluate_all, roc_data, pr_data, model_calibration_data, feature_importance
+from src.ml.registry import REGISTRY_DIR, evict
+from src.ml.scoring import SCORER_PATH, save_scorer
+from src.ml.evaluate import evaluate_all, model_curves, metrics_frame, feature_importance
+from src.runner import run
+from src import profiling
 from src.viz.plots import (
     plot_calibration_curves, plot_brier_by_season, plot_favorite_accuracy,
     plot_movement_win_rates, plot_steamed_vs_implied,
     plot_value_gap_summary, plot_gap_by_outcome,
     plot_roc_curves, plot_pr_curves, plot_feature_importance, plot_model_calibration,
 )
-from walk_forward import walk_forward_validate
-from backtest import threshold_sweep, plot_cumulative_pnl, plot_walk_forward_auc
+from walk_forward import walk_forward_validate, compare_training_modes, plan_folds, folds_to_frame
+from backtest import threshold_sweep, sweep_returns, staking_report, plot_cumulative_pnl, plot_walk_forward_auc
 
 os.makedirs("output/plots", exist_ok=True)
 os.makedirs("output/results", exist_ok=True)
 
-def main():
-    # load data
-    df = load_all("data/raw")
-    df = build_features(df)
+def results(name):
+    return f"output/results/{name}.csv"
 
-    # calibration
-    print("\n--- calibration ---")
-    brier = brier_by_season(df)
-    brier.to_csv("output/results/brier_by_season.csv", index=False)
+def plots(name):
+    return f"output/plots/{name}.png"
 
-    fav = favorite_accuracy(df, threshold=0.7)
-    fav.to_csv("output/results/favorite_accuracy.csv", index=False)
+# ---------- stages ----------
+# each takes its inputs as keyword args and returns its outputs by name,
+# see STAGES below for the wiring
 
-    plot_calibration_curves(df, calibration_data)
-    plot_brier_by_season(brier)
-    plot_favorite_accuracy(fav)
+def load():
+    return {"raw": load_all("data/raw")}
+
+def features(raw):
+    # favourites that changed side between open and close get their own
+    # "flip" movement category
+    df = build_features_incremental(raw, detect_flip=True)
+    mem = memory_report(df)
+    mem.to_csv(results("memory_report"), index=False)
+    print(f"match frame: {mem['bytes'].sum() / 1e6:.1f} MB")
+    return {"df": df}
+
+def calibration(df):
+    # sufficient stats for league x season x phase x movement x prob bucket,
+    # the brier tables are roll-ups of it
+    cube = match_cube(df)
+    cube.to_csv(results("metrics_cube"), index=False)
+
+    brier = brier_table(cube, ["season"])
+    brier.to_csv(results("brier_by_season"), index=False)
+    brier_table(cube, ["league", "season"]).to_csv(results("brier_by_league"), index=False)
+
+    # reliability / resolution / uncertainty per book, outcome and season
+    brier_decomposition(sketch(df, by=["season"])).to_csv(results("brier_decomposition"), index=False)
+
+    fav = favorite_accuracy(df, threshold=0.7)
+    fav.to_csv(results("favorite_accuracy"), index=False)
+    return {"cube": cube, "brier": brier, "fav": fav}
 
-    # line movement
-    print("\n--- line movement ---")
+def line_movement(df):
     mov = movement_win_rates(df)
-    mov.to_csv("output/results/movement_win_rates.csv", index=False)
+    mov.to_csv(results("movement_win_rates"), index=False)
+    movement_win_rates(df, by=["league"]).to_csv(results("movement_by_league"), index=False)
 
     steamed = steamed_vs_implied(df)
-    steamed.to_csv("output/results/steamed_vs_implied.csv", index=False)
+    steamed.to_csv(results("steamed_vs_implied"), index=False)
 
     tmp = movement_by_season(df)
-    tmp.to_csv("output/results/movement_by_season.csv", index=False)
+    tmp.to_csv(results("movement_by_season"), index=False)
 
-    plot_movement_win_rates(mov)
-    plot_steamed_vs_implied(steamed)
+    # every book and outcome, open vs close plus clv against the pinnacle close
+    movement_table(df, by=["league"]).to_csv(results("book_movement"), index=False)
+    return {"mov": mov, "steamed": steamed}
 
-    # value gap
-    print("\n--- value gap ---")
+def value_gap(df):
     gap = gap_summary(df)
-    gap.to_csv("output/results/gap_summary.csv", index=False)
+    gap.to_csv(results("gap_summary"), index=False)
+    gap_summary(df, by=["league"]).to_csv(results("gap_by_league"), index=False)
+    # same table for the o/u 2.5 and asian handicap favourites
+    gap_by_market(df).to_csv(results("gap_by_market"), index=False)
 
-    gap_out = gap_by_outcome(df)
-    gap_out.to_csv("output/results/gap_by_outcome.csv", index=False)
+    # every bookmaker against the consensus and the best price, plus a
+    # threshold sweep off the same arrays
+    gaps = book_gaps(df)
+    outlier_scan(gaps).to_csv(results("book_outliers"), index=False)
+    gap_threshold_sweep(gaps).to_csv(results("book_gap_sweep"), index=False)
 
-    gap_by_season(df).to_csv("output/results/gap_by_season.csv", index=False)
-    gap_distribution(df).to_csv("output/results/gap_distribution.csv", index=False)
+    gap_out = gap_by_outcome(df)
+    gap_out.to_csv(results("gap_by_outcome"), index=False)
 
-    plot_value_gap_summary(gap)
-    plot_gap_by_outcome(gap_out)
+    gap_by_season(df).to_csv(results("gap_by_season"), index=False)
+    gap_distribution(df).to_csv(results("gap_distribution"), index=False)
+    return {"gap": gap, "gap_out": gap_out}
 
-    # ml single split
-    print("\n--- ml (single split) ---")
-    ml_df, feat_cols = build_ml_features(df)
+def ml(df):
+    # single split
+    ml_df, pipeline = build_ml_features(df)
     X_train, X_test, y_train, y_test = split(ml_df)
 
-    models = train_models(X_train, y_train)
+    models = train_models(X_train, y_train, registry_dir=REGISTRY_DIR)
+    # what score.py loads to score live snapshots
+    save_scorer(models, pipeline)
 
     res, probas = evaluate_all(models, X_test, y_test)
-    res.to_csv("output/results/model_metrics.csv", index=False)
+    res.to_csv(results("model_metrics"), index=False)
     print(res.to_string(index=False))
 
-    imp = feature_importance(models, feat_cols)
-    imp.to_csv("output/results/feature_importance.csv", index=False)
+    imp = feature_importance(models, pipeline.feat_cols)
+    imp.to_csv(results("feature_importance"), index=False)
 
-    roc = roc_data(y_test, probas)
-    pr = pr_data(y_test, probas)
-    cal = model_calibration_data(y_test, probas)
+    roc, pr, cal = model_curves(y_test, probas)
+    return {"ml_results": res, "probas": probas, "y_test": y_test, "importance": imp,
+            "roc": roc, "pr": pr, "model_cal": cal}
 
-    plot_roc_curves(roc, res)
-    plot_pr_curves(pr, res)
-    plot_feature_importance(imp)
-    plot_model_calibration(cal)
+def walk_forward(df):
+    # folds come from the seasons actually loaded; the csv is enough to re-run
+    # any one of them via walk_forward.folds_from_frame
+    plan = plan_folds(df, freq="season")
+    folds_to_frame(plan).to_csv(results("walk_forward_folds"), index=False)
+    preds_df, fold_stats = walk_forward_validate(df, workers=None, plan=plan, registry_dir=REGISTRY_DIR)
 
-    # walk forward
-    print("\n--- walk-forward validation ---")
-    preds_df, fold_stats = walk_forward_validate(df)
+    fold_stats.to_csv(results("walk_forward_metrics"), index=False)
+    preds_df.to_csv(results("walk_forward_preds"))
+    return {"plan": plan, "preds": preds_df, "fold_stats": fold_stats}
 
-    fold_stats.to_csv("output/results/walk_forward_metrics.csv", index=False)
-    preds_df.to_csv("output/results/walk_forward_preds.csv")
+def training_modes(df, plan, fold_stats):
+    # warm-started folds vs the full refit
+    modes = compare_training_modes(df, baseline=fold_stats, workers=None, plan=plan,
+                                   registry_dir=REGISTRY_DIR)
+    modes.to_csv(results("walk_forward_modes"), index=False)
+    return {"modes": modes}
 
-    plot_walk_forward_auc(fold_stats)
+def model_metrics(y_test, probas, preds):
+    # bootstrap cis + delong model comparisons, single split and every fold
+    metrics = metrics_frame(y_test, probas, preds)
+    metrics.to_csv(results("model_metrics_ci"), index=False)
+    print("\n--- model metrics with 95% cis ---")
+    print(metrics[metrics["scope"] != "walk_forward"].drop(columns=["fold", "n_test", "n_pos"])
+          .round(4).to_string(index=False))
+    return {"metrics": metrics}
+
+def backtest(df, preds):
+    sweep = threshold_sweep(preds, df, model="logreg")
+    sweep.to_csv(results("backtest_sweep"), index=False)
+
+    # every model on a 0.001 threshold grid, numeric columns. the o/u and
+    # asian handicap favourites ride along in the same pass
+    sweep_returns(preds, df, markets=list(MARKETS)).to_csv(results("backtest_sweep_grid"), index=False)
 
-    # backtest
-    print("\n--- backtest ---")
-    sweep = threshold_sweep(preds_df, df, model="logreg")
-    sweep.to_csv("output/results/backtest_sweep.csv", index=False)
+    # flat / proportional / kelly bankrolls with bootstrap CIs on roi. kelly
+    # sizes off pinnacle's de-vigged prob of the favourite winning
+    staking = staking_report(preds, df, model="logreg", threshold=0.3, p_col="ps_p")
+    staking.to_csv(results("backtest_staking"), index=False)
+    return {"sweep": sweep, "staking": staking}
 
+PLOTS = [
+    "calibration_curves", "brier_by_season", "favorite_accuracy",
+    "movement_win_rates", "steamed_vs_implied", "value_gap_summary", "gap_by_outcome",
+    "roc_curves", "pr_curves", "feature_importance", "model_calibration",
+    "walk_forward_auc", "backtest_pnl",
+]
+
+def draw_plots(df, brier, fav, mov, steamed, gap, gap_out, ml_results, roc, pr, importance,
+               model_cal, fold_stats, preds):
+    plot_calibration_curves(df, calibration_data)
+    plot_brier_by_season(brier)
+    plot_favorite_accuracy(fav)
+
+    plot_movement_win_rates(mov)
+    plot_steamed_vs_implied(steamed)
+
+    plot_value_gap_summary(gap)
+    plot_gap_by_outcome(gap_out)
+
+    plot_roc_curves(roc, ml_results)
+    plot_pr_curves(pr, ml_results)
+    plot_feature_importance(importance)
+    plot_model_calibration(model_cal)
+
+    plot_walk_forward_auc(fold_stats)
     #TBC 0.3 seems decent, might try other thresholds later
-    plot_cumulative_pnl(preds_df, df, threshold=0.3)
+    plot_cumulative_pnl(preds, df, threshold=0.3)
+    return {}
+
+def _csvs(*names):
+    return [results(n) for n in names]
+
+# calibration, line_movement, value_gap, ml and walk_forward only need df, so
+# they run side by side. walk_forward / training_modes bring their own
+# process pool and run on their own
+STAGES = {
+    "load": {"fn": load, "inputs": [], "outputs": ["raw"], "cache": False},
+    "features": {"fn": features, "inputs": ["raw"], "outputs": ["df"],
+                 "files": _csvs("memory_report")},
+    "calibration": {"fn": calibration, "inputs": ["df"], "outputs": ["cube", "brier", "fav"],
+                    "files": _csvs("metrics_cube", "brier_by_season", "brier_by_league", "brier_decomposition",
+                                   "favorite_accuracy")},
+    "line_movement": {"fn": line_movement, "inputs": ["df"], "outputs": ["mov", "steamed"],
+                      "files": _csvs("movement_win_rates", "movement_by_league", "steamed_vs_implied",
+                                       "movement_by_season", "book_movement")},
+    "value_gap": {"fn": value_gap, "inputs": ["df"], "outputs": ["gap", "gap_out"],
+                  "files": _csvs("gap_summary", "gap_by_league", "gap_by_market", "gap_by_outcome", "gap_by_season",
+                                   "gap_distribution", "book_outliers", "book_gap_sweep")},
+    "ml": {"fn": ml, "inputs": ["df"],
+           "outputs": ["ml_results", "probas", "y_test", "importance", "roc", "pr", "model_cal"],
+           "files": _csvs("model_metrics", "feature_importance") + [SCORER_PATH]},
+    "walk_forward": {"fn": walk_forward, "inputs": ["df"], "outputs": ["plan", "preds", "fold_stats"],
+                     "files": _csvs("walk_forward_folds", "walk_forward_metrics", "walk_forward_preds"),
+                     "exclusive": True},
+    "training_modes": {"fn": training_modes, "inputs": ["df", "plan", "fold_stats"], "outputs": ["modes"],
+                       "files": _csvs("walk_forward_modes"), "exclusive": True},
+    "model_metrics": {"fn": model_metrics, "inputs": ["y_test", "probas", "preds"], "outputs": ["metrics"],
+                      "files": _csvs("model_metrics_ci")},
+    "backtest": {"fn": backtest, "inputs": ["df", "preds"], "outputs": ["sweep", "staking"],
+                 "files": _csvs("backtest_sweep", "backtest_sweep_grid", "backtest_staking")},
+    "plots": {"fn": draw_plots,
+              "inputs": ["df", "brier", "fav", "mov", "steamed", "gap", "gap_out", "ml_results", "roc", "pr",
+                         "importance", "model_cal", "fold_stats", "preds"],
+              "outputs": [], "files": [plots(n) for n in PLOTS]},
+}
+
+def main():
+    ap = argparse.ArgumentParser(description="run the analysis pipeline (or some stages of it)")
+    ap.add_argument("stages", nargs="*", help=f"stages to run plus what they need (default: all). "
+                                              f"one of: {', '.join(STAGES)}")
+    ap.add_argument("--force", nargs="+", default=[], metavar="STAGE", help="re-run even if cached")
+    ap.add_argument("--no-cache", action="store_true", help="ignore and don't write the stage cache")
+    ap.add_argument("--workers", type=int, default=4, help="stages run at the same time")
+    ap.add_argument("--list", action="store_true", help="print the stages and exit")
+    ap.add_argument("--profile", action="store_true",
+                    help="time / memory / rows per step into output/profile/run_report.json "
+                         "(stages run one at a time so the numbers are their own)")
+    ap.add_argument("--trace", action="store_true", help="with --profile, also write trace.json and stacks.folded")
+    ap.add_argument("--no-tracemalloc", action="store_true", help="with --profile, skip python allocation tracking")
+    args = ap.parse_args()
+
+    if args.list:
+        for name, spec in STAGES.items():
+            print(f"{name:15s} {', '.join(spec['inputs']) or '-':40s} -> {', '.join(spec['outputs']) or 'plots'}")
+        return
+
+    unknown = [s for s in args.stages + args.force if s not in STAGES]
+    if unknown:
+        ap.error(f"unknown stage {', '.join(unknown)} (--list shows them)")
+
+    if args.profile:
+        profiling.enable(trace_malloc=not args.no_tracemalloc)
+
+    _, summary = run(STAGES, targets=args.stages or None, force=args.force,
+                     workers=1 if args.profile else args.workers, use_cache=not args.no_cache)
+
+    evict(REGISTRY_DIR)
+
+    if args.profile:
+        paths = profiling.write_report("output/profile", trace=args.trace,
+                                       meta={"stages": summary.to_dict(orient="records")})
+        print("\n--- profile ---")
+        print(profiling.summary().head(20).round(3).to_string(index=False))
+        print(f"report: {', '.join(paths)}")
 
+    print("\n--- stages ---")
+    print(summary.to_string(index=False))
     print("\ndone. outputs in output/")
 
 if __name__ == "__main__":
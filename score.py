@@ -0,0 +1,115 @@
+import io
+import sys
+import json
+import time
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pandas as pd
+from src.ml.scoring import SCORER_PATH, load_scorer, score_batch
+
+# score upcoming-match odds snapshots with the model main.py registered.
+#   python score.py --file snapshots.csv [--out scores.csv]
+#   some_feed | python score.py --stdin      (one json object/list per line)
+#   python score.py --serve --port 8765      (POST json or csv to /score)
+
+def read_snapshots(path):
+    if path.endswith(".parquet"):
+        return pd.read_parquet(path)
+    if path.endswith(".jsonl") or path.endswith(".json"):
+        return pd.read_json(path, lines=path.endswith(".jsonl"))
+    return pd.read_csv(path, encoding="latin-1")
+
+def snapshot_frame(payload):
+    # a json object or a list of them, one row each
+    rows = json.loads(payload)
+    if isinstance(rows, dict):
+        rows = [rows]
+    if not isinstance(rows, list) or not all(isinstance(r, dict) for r in rows):
+        raise ValueError("expected a json object or a list of objects")
+    return pd.DataFrame(rows)
+
+def to_records(scores):
+    out = scores.copy()
+    if "Date" in out.columns:
+        out["Date"] = out["Date"].dt.strftime("%Y-%m-%d")
+    out = out.astype(object).where(out.notna(), None)
+    return out.to_dict(orient="records")
+
+def run_file(scorer, path, out_path=None):
+    t = time.perf_counter()
+    scores = score_batch(read_snapshots(path), scorer)
+    ms = (time.perf_counter() - t) * 1000
+    if out_path:
+        scores.to_csv(out_path, index=False)
+        print(f"scored {len(scores)} rows in {ms:.1f}ms -> {out_path}", file=sys.stderr)
+    else:
+        scores.to_csv(sys.stdout, index=False)
+
+def run_stdin(scorer):
+    # every line is its own batch and gets one json line back straight away.
+    # a line that can't be read or scored gets {"error": ..., "line": n}
+    # instead, and the feed carries on
+    for n, line in enumerate(sys.stdin, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            out = to_records(score_batch(snapshot_frame(line), scorer))
+        except (ValueError, KeyError, TypeError) as e:
+            out = {"error": str(e), "line": n}
+        print(json.dumps(out), flush=True)
+
+def make_handler(scorer):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path != "/score":
+                self.send_error(404)
+                return
+            try:
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if "csv" in self.headers.get("Content-Type", ""):
+                    snap = pd.read_csv(io.BytesIO(body))
+                else:
+                    snap = snapshot_frame(body)
+                payload = json.dumps(to_records(score_batch(snap, scorer))).encode()
+            except (ValueError, KeyError, TypeError) as e:
+                self.send_error(400, str(e))
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, fmt, *args):
+            pass
+
+    return Handler
+
+def main():
+    ap = argparse.ArgumentParser(description="score live odds snapshots for high_gap")
+    src = ap.add_mutually_exclusive_group(required=True)
+    src.add_argument("--file", help="csv / jsonl / parquet of snapshots")
+    src.add_argument("--stdin", action="store_true", help="json lines on stdin")
+    src.add_argument("--serve", action="store_true", help="local http endpoint")
+    ap.add_argument("--out", help="where --file results go (default stdout)")
+    ap.add_argument("--model", default="logreg")
+    ap.add_argument("--scorer", default=SCORER_PATH)
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8765)
+    args = ap.parse_args()
+
+    # model is loaded once, every batch after that is just features + predict
+    scorer = load_scorer(args.scorer, model=args.model)
+
+    if args.file:
+        run_file(scorer, args.file, args.out)
+    elif args.stdin:
+        run_stdin(scorer)
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), make_handler(scorer))
+        print(f"scoring on http://{args.host}:{args.port}/score  ({args.model})", file=sys.stderr)
+        server.serve_forever()
+
+if __name__ == "__main__":
+    main()
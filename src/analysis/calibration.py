@@ -1,59 +1,51 @@
 import numpy as np
-import pandas as pd
-from sklearn.calibration import calibration_curve
+from src.analysis.cube import FAV_TARGET, match_cube, stat_cube, rollup, ratios
+from src.profiling import profiled
 
 def brier_score(probs, outcomes):
     return np.mean((probs - outcomes) ** 2)
 
-def brier_by_season(df):
-    records = []
-    for season, grp in df.groupby("season"):
-        grp = grp.dropna(subset=["b365_ph", "b365_pd", "b365_pa"])
-        if len(grp) < 10:
-            continue
-
-        h_actual = (grp["FTR"] == "H").astype(int)
-        d_actual = (grp["FTR"] == "D").astype(int)
-        a_actual = (grp["FTR"] == "A").astype(int)
-
-        records.append({
-            "season": season,
-            "brier_h": brier_score(grp["b365_ph"], h_actual),
-            "brier_d": brier_score(grp["b365_pd"], d_actual),
-            "brier_a": brier_score(grp["b365_pa"], a_actual),
-            "brier_ps_h": brier_score(grp["ps_ph"].dropna(), (grp.loc[grp["ps_ph"].notna(), "FTR"] == "H").astype(int)),
-            "n": len(grp),
-        })
-
-    return pd.DataFrame(records)
-
+# cube target -> column in the brier tables
+BRIER_COLS = {"b365_H": "brier_h", "b365_D": "brier_d", "b365_A": "brier_a", "ps_H": "brier_ps_h"}
+
+def brier_table(cube, by=("season",), min_n=10):
+    # b365 brier per outcome (and pinnacle home) for each slice of a
+    # match_cube. slices with fewer than min_n matches are left out
+    by = list(by)
+    sub = ratios(rollup(cube[cube["target"].isin(list(BRIER_COLS))], by))
+    sub["target"] = sub["target"].astype(str)
+    wide = sub.set_index(by + ["target"]).unstack("target")
+    out = wide["brier"].reindex(columns=list(BRIER_COLS)).rename(columns=BRIER_COLS)
+    out["n"] = wide["n"]["b365_H"]
+    out = out[out["n"] >= min_n].reset_index()
+    out.columns.name = None
+    out["n"] = out["n"].astype(int)
+    return out
+
+@profiled
+def brier_by_season(df, by=("season",)):
+    return brier_table(match_cube(df, dims=list(by)), by)
+
+@profiled
 def calibration_data(df, outcome, prob_col, n_bins=10):
     mask = df[prob_col].notna()
-    y = (df.loc[mask, "FTR"] == outcome).astype(int)
     p = df.loc[mask, prob_col]
-    frac_pos, mean_pred = calibration_curve(y, p, n_bins=n_bins, strategy="quantile")
-    return mean_pred, frac_pos
-
-def favorite_accuracy(df, threshold=0.7):
+    # quantile bins like sklearn's calibration_curve(strategy="quantile");
+    # the lowest edge is opened up so the minimum lands in the first bin
+    edges = np.percentile(p, np.linspace(0, 100, n_bins + 1))
+    edges[0] = -np.inf
+    target = {outcome: {"p": prob_col, "y": df.loc[mask, "FTR"] == outcome}}
+    bins = ratios(stat_cube(df.loc[mask], target, dims=["prob_bucket"], buckets=np.unique(edges)))
+    return bins["avg_p"].to_numpy(), bins["win_rate"].to_numpy()
+
+@profiled
+def favorite_accuracy(df, threshold=0.7, by=()):
     # matches where b365 implied prob on any outcome exceeds threshold
-    heavy = df[
-        (df[["b365_ph", "b365_pd", "b365_pa"]].max(axis=1) >= threshold) &
-        df[["b365_ph", "b365_pd", "b365_pa"]].notna().all(axis=1)
-    ].copy()
-
-    heavy["fav_outcome"] = heavy[["b365_ph", "b365_pd", "b365_pa"]].idxmax(axis=1).map({
-        "b365_ph": "H", "b365_pd": "D", "b365_pa": "A"
-    })
-    heavy["fav_implied"] = heavy[["b365_ph", "b365_pd", "b365_pa"]].max(axis=1)
-    heavy["fav_won"] = heavy["fav_outcome"] == heavy["FTR"]
+    # (fav_* columns come from features.add_favourites, NaN when a price is missing)
+    heavy = df.loc[df["fav_implied"] >= threshold]
 
     bins = np.arange(threshold, 1.01, 0.05)
-    heavy["prob_bucket"] = pd.cut(heavy["fav_implied"], bins=bins)
-
-    summary = heavy.groupby("prob_bucket", observed=True).agg(
-        n=("fav_won", "count"),
-        win_rate=("fav_won", "mean"),
-        avg_implied=("fav_implied", "mean"),
-    ).reset_index()
+    summary = ratios(stat_cube(heavy, FAV_TARGET, dims=[*by, "prob_bucket"], buckets=bins))
+    summary = summary.rename(columns={"avg_p": "avg_implied"})
 
-    return summary
\ No newline at end of file
+    return summary[[*by, "prob_bucket", "n", "win_rate", "avg_implied"]]
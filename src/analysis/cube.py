@@ -0,0 +1,96 @@
+import numpy as np
+import pandas as pd
+from src.profiling import profiled
+
+# sufficient statistics behind every probability-vs-outcome table. each
+# target (a prob column and the outcome it forecasts) is stacked into one
+# long frame and summed in a single groupby over whatever dims are asked for:
+#   n, sum_p, sum_y, sum_sq = sum((p - y) ** 2), plus sum_<col> for extras
+# sums add up, so a fine cube rolls up to any coarser slicing for free, and
+# brier, win rate, calibration bins and gap tables are all ratios of them
+
+DIMS = ["league", "season", "season_phase", "movement_cat", "prob_bucket"]
+PROB_BUCKETS = np.round(np.linspace(0, 1, 11), 2)
+STATS = ["n", "sum_p", "sum_y", "sum_sq"]
+
+# b365 closing favourite: its implied prob vs whether it won
+FAV_TARGET = {"fav": {"p": "fav_implied", "y": "fav_won"}}
+
+def outcome_targets(df, books=("b365", "b365_open", "ps")):
+    # one target per book and 1x2 outcome, named like "b365_H"
+    targets = {}
+    for book in books:
+        for outcome in ["H", "D", "A"]:
+            col = f"{book}_p{outcome.lower()}"
+            if col in df.columns:
+                targets[f"{book}_{outcome}"] = {"p": col, "y": df["FTR"] == outcome}
+    return targets
+
+def stack(df, targets, dims=(), buckets=PROB_BUCKETS):
+    # one row per (match, target): target, dims, p, y and any other columns
+    # the target spec names, e.g. {"p": "b365_ph", "y": ..., "gap": "gap_h"}.
+    # y is a column name or a boolean array lined up with df. rows with a NaN
+    # in any of them are dropped. "prob_bucket" in dims is cut from p on buckets
+    frame_dims = [d for d in dims if d != "prob_bucket"]
+    rows, lengths, cols = [], [], {}
+    for spec in targets.values():
+        arrays = {k: (df[v] if isinstance(v, str) else np.asarray(v)) for k, v in spec.items()}
+        arrays = {k: np.asarray(a, dtype=np.float64) for k, a in arrays.items()}
+        keep = np.flatnonzero(np.isfinite(np.column_stack(list(arrays.values()))).all(axis=1))
+        rows.append(keep)
+        lengths.append(len(keep))
+        for k, a in arrays.items():
+            cols.setdefault(k, []).append(a[keep])
+
+    codes = np.repeat(np.arange(len(targets)), lengths)
+    long = df[frame_dims].iloc[np.concatenate(rows)].reset_index(drop=True)
+    long.insert(0, "target", pd.Categorical.from_codes(codes, categories=list(targets)))
+    for k, parts in cols.items():
+        long[k] = np.concatenate(parts)
+
+    if "prob_bucket" in dims:
+        long["prob_bucket"] = pd.cut(long["p"], buckets)
+        # outside the bucket edges
+        long = long[long["prob_bucket"].notna()]
+    return long
+
+def aggregate(long, dims=()):
+    # the one grouped pass. every column that isn't target / a dim / p / y
+    # is summed as sum_<col>. NaN dims (no movement category, ...) stay a group
+    dims = list(dims)
+    values = [c for c in long.columns if c not in ["target", "p", "y", *dims]]
+    long = long.assign(n=1, sq=(long["p"] - long["y"]) ** 2)
+    cube = long.groupby(["target", *dims], observed=True, dropna=False, sort=True)[
+        ["n", "p", "y", "sq", *values]].sum()
+    cube.columns = STATS + [f"sum_{v}" for v in values]
+    return cube.reset_index()
+
+def stat_cube(df, targets, dims=DIMS, buckets=PROB_BUCKETS):
+    return aggregate(stack(df, targets, dims, buckets), dims)
+
+def rollup(cube, by=()):
+    # re-aggregate a cube to fewer dims
+    sums = [c for c in cube.columns if c == "n" or c.startswith("sum_")]
+    out = cube.groupby(["target", *by], observed=True, dropna=False, sort=True)[sums].sum()
+    return out.reset_index()
+
+def ratios(cube):
+    # brier, win_rate and avg_p, plus avg_<col> for every extra sum
+    out = cube.copy()
+    out["brier"] = out["sum_sq"] / out["n"]
+    out["win_rate"] = out["sum_y"] / out["n"]
+    out["avg_p"] = out["sum_p"] / out["n"]
+    for c in cube.columns:
+        if c.startswith("sum_") and c not in STATS:
+            out[f"avg_{c[len('sum_'):]}"] = out[c] / out["n"]
+    return out
+
+def match_rows(df):
+    # matches with a full b365 price set, the population all the analyses use
+    return df.loc[df[["b365_ph", "b365_pd", "b365_pa"]].notna().all(axis=1)]
+
+@profiled
+def match_cube(df, dims=DIMS):
+    # every book's 1x2 outcomes plus the b365 favourite
+    df = match_rows(df)
+    return stat_cube(df, {**outcome_targets(df), **FAV_TARGET}, dims=dims)
@@ -1,47 +1,33 @@
+import numpy as np
 import pandas as pd
+from src.features import BOOKS, devig
+from src.schema import KNOWN_CATEGORIES
+from src.analysis.cube import FAV_TARGET, stat_cube, ratios
+from src.profiling import profiled
 
-def movement_win_rates(df):
-    mask = df["movement_cat"].notna()
-    grp = df[mask].copy()
-
-    # who is the fav at close?
-    grp["fav_outcome"] = grp[["b365_ph", "b365_pd", "b365_pa"]].idxmax(axis=1).map({
-        "b365_ph": "H", "b365_pd": "D", "b365_pa": "A"
-    })
-    grp["fav_implied_close"] = grp[["b365_ph", "b365_pd", "b365_pa"]].max(axis=1)
-    grp["fav_won"] = grp["fav_outcome"] == grp["FTR"]
+@profiled
+def movement_win_rates(df, by=()):
+    # fav_* is the closing-price favourite from features.add_favourites
+    grp = df.loc[df["movement_cat"].notna()]
 
-    summary = grp.groupby("movement_cat", observed=True).agg(
-        n=("fav_won", "count"),
-        win_rate=("fav_won", "mean"),
-        avg_implied_close=("fav_implied_close", "mean"),
-    ).reset_index()
+    summary = ratios(stat_cube(grp, FAV_TARGET, dims=[*by, "movement_cat"]))
+    summary = summary.rename(columns={"avg_p": "avg_implied_close"})
 
-    return summary
+    return summary[[*by, "movement_cat", "n", "win_rate", "avg_implied_close"]]
 
-def steamed_vs_implied(df):
+@profiled
+def steamed_vs_implied(df, by=()):
     # for steamed favs specifically: how does actual win rate compare
     # to what the closing implied prob predicted?
-    steamed = df[df["movement_cat"] == "steamed_fav"].copy()
-    steamed = steamed.dropna(subset=["b365_ph", "b365_pa"])
-
-    steamed["fav_outcome"] = steamed[["b365_ph", "b365_pd", "b365_pa"]].idxmax(axis=1).map({
-        "b365_ph": "H", "b365_pd": "D", "b365_pa": "A"
-    })
-    steamed["fav_implied_close"] = steamed[["b365_ph", "b365_pd", "b365_pa"]].max(axis=1)
-    steamed["fav_won"] = steamed["fav_outcome"] == steamed["FTR"]
+    mask = (df["movement_cat"] == "steamed_fav") & df["fav_implied"].notna()
 
     bins = [0, 0.4, 0.5, 0.6, 0.7, 0.8, 1.0]
-    steamed["implied_bucket"] = pd.cut(steamed["fav_implied_close"], bins=bins)
-
-    summary = steamed.groupby("implied_bucket", observed=True).agg(
-        n=("fav_won", "count"),
-        win_rate=("fav_won", "mean"),
-        avg_implied=("fav_implied_close", "mean"),
-    ).reset_index()
+    summary = ratios(stat_cube(df.loc[mask], FAV_TARGET, dims=[*by, "prob_bucket"], buckets=bins))
+    summary = summary.rename(columns={"prob_bucket": "implied_bucket", "avg_p": "avg_implied"})
 
-    return summary
+    return summary[[*by, "implied_bucket", "n", "win_rate", "avg_implied"]]
 
+@profiled
 def movement_by_season(df):
     mask = df["movement_cat"].notna()
     return (
@@ -49,4 +35,109 @@ def movement_by_season(df):
         .groupby(["season", "movement_cat"], observed=True)
         .size()
         .reset_index(name="n")
-    )
\ No newline at end of file
+    )
+
+# ---------- every book, every outcome ----------
+# book -> (opening, closing) price sets, named as in features.BOOKS. every
+# book closes on its C-suffixed columns (B365C* / PSC* / MaxC*), so delta,
+# steam / drift and clv have the same sign for all of them. the b365 close
+# is the set features still calls b365_open: that legacy name comes from
+# movement_cat, which compares B365* against B365C* the other way round
+MOVEMENT_BOOKS = {"b365": ("b365", "b365_open"), "ps": ("ps", "ps_close"), "max": ("max", "max_close")}
+# clv is measured against the de-vigged pinnacle close (PSCH/PSCD/PSCA)
+CLV_REF = "ps_close"
+MOVES = ["drifted", "stable", "steamed"]
+
+def movement_arrays(df, books=None, threshold=0.02, method="multiplicative"):
+    # (n_matches, n_books, 3) blocks for every book that has both price
+    # sets, outcomes in h/d/a order, all de-vigged in one devig call:
+    #   open_p / close_p / delta (close - open implied prob), open_odds /
+    #   close_odds, clv_open / clv_close (odds x pinnacle close prob - 1),
+    #   move (index into MOVES, -1 without both prices) and won
+    books = {b: (o, c) for b, (o, c) in (books or MOVEMENT_BOOKS).items()
+             if all(col in df.columns for col in BOOKS[o] + BOOKS[c])}
+    names = list(books)
+    k = len(names)
+    sets = [books[b][1] for b in names] + [books[b][0] for b in names] + [CLV_REF]
+    # no pinnacle close in the csvs -> NaN clv
+    odds = np.stack([df[list(BOOKS[s])].to_numpy(dtype=np.float64) if set(BOOKS[s]) <= set(df.columns)
+                     else np.full((len(df), 3), np.nan) for s in sets], axis=1)
+    probs, _ = devig(odds, method=method)
+
+    out = {"books": names, "close_odds": odds[:, :k], "open_odds": odds[:, k:2 * k],
+           "close_p": probs[:, :k], "open_p": probs[:, k:2 * k]}
+    ref = probs[:, 2 * k:]
+    out["delta"] = out["close_p"] - out["open_p"]
+    out["clv_open"] = out["open_odds"] * ref - 1
+    out["clv_close"] = out["close_odds"] * ref - 1
+    with np.errstate(invalid="ignore"):
+        out["move"] = np.select([np.isnan(out["delta"]), out["delta"] >= threshold, out["delta"] <= -threshold],
+                                [-1, 2, 0], default=1)
+    ftr = pd.Categorical(df["FTR"], categories=KNOWN_CATEGORIES["FTR"]).codes
+    out["won"] = np.broadcast_to(ftr[:, None, None] == np.arange(3), out["delta"].shape)
+    return out
+
+# summed per cell, averaged by the count next to them
+_MOVEMENT_SUMS = {
+    "won": "win_rate", "open_p": "avg_open_p", "close_p": "avg_close_p", "delta": "avg_delta",
+    "ret_open": "roi_open", "ret_close": "roi_close",
+}
+
+@profiled
+def movement_table(df, by=(), books=None, threshold=0.02, block_rows=200_000):
+    # win rate, implied probs, movement, clv and flat-stake roi at the open
+    # and close price per (by..., book, outcome, movement), for every book
+    # with both price sets. bincounts over numpy blocks of block_rows
+    # matches, so memory stays flat however many cells there are
+    by = list(by)
+    if by:
+        grouped = df.groupby(by, observed=True, sort=True)
+        gid, keys = grouped.ngroup().to_numpy(), grouped.size().index
+    else:
+        gid, keys = np.zeros(len(df), dtype=np.int64), None
+    n_groups = len(keys) if by else 1
+
+    sums, names = {}, None
+    for start in range(0, len(df), block_rows):
+        block = df.iloc[start:start + block_rows]
+        m = movement_arrays(block, books=books, threshold=threshold)
+        names = m["books"]
+        k = len(names)
+        m["ret_open"] = m["won"] * m["open_odds"] - 1
+        m["ret_close"] = m["won"] * m["close_odds"] - 1
+
+        g = gid[start:start + block_rows][:, None, None]
+        cell = ((g * k + np.arange(k)[:, None]) * 3 + np.arange(3)) * len(MOVES) + m["move"]
+        ok = (m["move"] >= 0) & (g >= 0)
+        size = n_groups * k * 3 * len(MOVES)
+
+        def add(name, values, valid=ok):
+            counts = np.bincount(cell[valid], weights=values[valid], minlength=size)
+            sums[name] = sums.get(name, 0) + counts
+
+        add("n", np.ones(cell.shape))
+        for col in _MOVEMENT_SUMS:
+            add(col, m[col].astype(np.float64))
+        # clv needs the pinnacle close too
+        clv_ok = ok & np.isfinite(m["clv_open"])
+        add("n_clv", np.ones(cell.shape), clv_ok)
+        add("clv_open", m["clv_open"], clv_ok)
+        add("clv_close", m["clv_close"], clv_ok & np.isfinite(m["clv_close"]))
+
+    nz = np.flatnonzero(sums["n"])
+    g, b, o, mv = np.unravel_index(nz, (n_groups, len(names), 3, len(MOVES)))
+    out = {}
+    if by:
+        for i, d in enumerate(by):
+            level = keys.get_level_values(i) if len(by) > 1 else keys
+            out[d] = level[g]
+    out["book"] = np.asarray(names)[b]
+    out["outcome"] = np.asarray(KNOWN_CATEGORIES["FTR"])[o]
+    out["movement"] = pd.Categorical.from_codes(mv, categories=MOVES)
+    out["n"] = sums["n"][nz].astype(int)
+    for col, name in _MOVEMENT_SUMS.items():
+        out[name] = sums[col][nz] / sums["n"][nz]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        out["avg_clv_open"] = sums["clv_open"][nz] / sums["n_clv"][nz]
+        out["avg_clv_close"] = sums["clv_close"][nz] / sums["n_clv"][nz]
+    return pd.DataFrame(out)
@@ -0,0 +1,111 @@
+import os
+import glob
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import numpy as np
+import pandas as pd
+from src.load_data import KEEP_COLS, iter_file_chunks
+from src.features import build_row_features
+from src.analysis.cube import FAV_TARGET, outcome_targets, match_rows, stack, aggregate, rollup, ratios
+from src.profiling import profiled
+
+# out-of-core calibration. a sketch is a cube over a fixed grid of FINE_BINS
+# equal-width p buckets per target and group, so it stays a few thousand rows
+# however many matches go in, and sketches merge by adding. built a chunk at
+# a time (stream_sketch reads the csvs in chunks, a process per file) and
+# summed up at the end.
+# quantile bins are read off the cumulative counts over the grid. p lives on
+# [0, 1], so the grid already pins every quantile to within 1 / FINE_BINS
+# and there's no need for a t-digest / kll sketch
+#   sk = stream_sketch("data/raw", by=["league", "season"])
+#   calibration_bins(sk), brier_decomposition(sk)
+
+FINE_BINS = 1000
+
+def _dims(sk):
+    return [c for c in sk.columns if c not in ["target", "n"] and not c.startswith("sum_")]
+
+def sketch(df, by=("season",), targets=None, fine_bins=FINE_BINS):
+    # df: matches (or a chunk of them) with the row features. targets
+    # default to every book's 1x2 outcome plus the b365 favourite
+    if targets is None:
+        df = match_rows(df)
+        targets = {**outcome_targets(df), **FAV_TARGET}
+    long = stack(df, targets, dims=list(by))
+    long["bin"] = np.minimum((long["p"] * fine_bins).astype(int), fine_bins - 1)
+    return aggregate(long, [*by, "bin"])
+
+def merge(*sketches):
+    # sketches of disjoint rows -> the sketch of all of them
+    return rollup(pd.concat(sketches, ignore_index=True), _dims(sketches[0]))
+
+def _file_sketch(f, by, chunksize, fine_bins):
+    sk = None
+    for chunk in iter_file_chunks(f, chunksize):
+        # older files lack whole price sets (no B365C* / PSC* / MaxC* before
+        # 2019-20). give them NaN columns, as concat does for the loaded frame
+        chunk = chunk.reindex(columns=list(dict.fromkeys(KEEP_COLS + list(chunk.columns))))
+        part = sketch(build_row_features(chunk), by=by, fine_bins=fine_bins)
+        sk = part if sk is None else merge(sk, part)
+    return sk
+
+@profiled
+def stream_sketch(data_dir="data/raw", by=("season",), chunksize=50_000, workers=1, fine_bins=FINE_BINS):
+    # sketch every csv in data_dir holding at most one chunk per process.
+    # only row-level features exist here, so season_phase can't be a dim.
+    # workers=None -> one per core
+    files = sorted(glob.glob(os.path.join(data_dir, "*.csv")))
+    if not files:
+        raise FileNotFoundError(f"no CSVs found in {data_dir}")
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    fn = partial(_file_sketch, by=list(by), chunksize=chunksize, fine_bins=fine_bins)
+    if min(workers, len(files)) <= 1:
+        parts = [fn(f) for f in files]
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(files))) as pool:
+            parts = list(pool.map(fn, files))
+    return merge(*[p for p in parts if p is not None])
+
+def calibration_bins(sk, n_bins=10, strategy="quantile", by=None, fine_bins=FINE_BINS):
+    # reliability diagram points per target (and per group in by, default
+    # every dim the sketch has): n, mean_pred, frac_pos and brier per bin.
+    # quantile: each grid bucket goes to the quantile bin its middle row
+    # falls in, like calibration_curve(strategy="quantile") up to grid width
+    by = [d for d in _dims(sk) if d != "bin"] if by is None else list(by)
+    fine = rollup(sk, [*by, "bin"])
+    if strategy == "quantile":
+        grp = fine.groupby(["target", *by], observed=True, dropna=False, sort=False)["n"]
+        mid = (grp.cumsum() - fine["n"] / 2) / grp.transform("sum")
+        fine["cal_bin"] = np.minimum((mid * n_bins).astype(int), n_bins - 1)
+    elif strategy == "uniform":
+        fine["cal_bin"] = fine["bin"] * n_bins // fine_bins
+    else:
+        raise ValueError(f"strategy must be quantile or uniform, got {strategy}")
+
+    out = ratios(rollup(fine.drop(columns="bin"), [*by, "cal_bin"]))
+    out = out.rename(columns={"avg_p": "mean_pred", "win_rate": "frac_pos"})
+    return out[["target", *by, "cal_bin", "n", "sum_p", "sum_y", "sum_sq", "mean_pred", "frac_pos", "brier"]]
+
+def brier_decomposition(sk, n_bins=10, strategy="quantile", by=None, fine_bins=FINE_BINS):
+    # murphy (1973): brier = reliability - resolution + uncertainty, over the
+    # calibration bins. within_bin is what's left from p varying inside a
+    # bin, it shrinks towards 0 as the bins get finer
+    bins = calibration_bins(sk, n_bins=n_bins, strategy=strategy, by=by, fine_bins=fine_bins)
+    keys = [c for c in bins.columns[:bins.columns.get_loc("cal_bin")]]
+    grp = bins.groupby(keys, observed=True, dropna=False, sort=False)
+    n = grp["n"].transform("sum")
+    base_rate = grp["sum_y"].transform("sum") / n
+
+    bins["rel"] = bins["n"] * (bins["mean_pred"] - bins["frac_pos"]) ** 2
+    bins["res"] = bins["n"] * (bins["frac_pos"] - base_rate) ** 2
+    out = bins.groupby(keys, observed=True, dropna=False, sort=True)[["n", "sum_y", "sum_sq", "rel", "res"]].sum()
+    out["brier"] = out["sum_sq"] / out["n"]
+    out["reliability"] = out["rel"] / out["n"]
+    out["resolution"] = out["res"] / out["n"]
+    base_rate = out["sum_y"] / out["n"]
+    out["uncertainty"] = base_rate * (1 - base_rate)
+    out["within_bin"] = out["brier"] - (out["reliability"] - out["resolution"] + out["uncertainty"])
+    out["n_bins"] = grp.size().reindex(out.index)
+    return out.reset_index()[keys + ["n", "brier", "reliability", "resolution", "uncertainty", "within_bin", "n_bins"]]
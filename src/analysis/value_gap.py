@@ -1,49 +1,59 @@
+import warnings
+import numpy as np
 import pandas as pd
+from src.load_data import BOOKMAKERS
+from src.features import MARKETS, market_columns, settle, devig
+from src.analysis.cube import stack, aggregate, stat_cube, ratios
+from src.profiling import profiled
 
-def gap_summary(df):
-    mask = df["max_gap"].notna()
-    grp = df[mask].copy()
-
-    grp["fav_outcome"] = grp[["b365_ph", "b365_pd", "b365_pa"]].idxmax(axis=1).map({
-        "b365_ph": "H", "b365_pd": "D", "b365_pa": "A"
-    })
-    grp["fav_implied"] = grp[["b365_ph", "b365_pd", "b365_pa"]].max(axis=1)
-    grp["fav_won"] = grp["fav_outcome"] == grp["FTR"]
-
-    summary = grp.groupby("high_gap", observed=True).agg(
-        n=("fav_won", "count"),
-        win_rate=("fav_won", "mean"),
-        avg_b365_implied=("fav_implied", "mean"),
-        avg_max_gap=("max_gap", "mean"),
-    ).reset_index()
-
-    return summary
-
-def gap_by_outcome(df):
-    # break down where the gap is coming from — h, d, or a
-    rows = []
-    for outcome, gap_col, prob_col in [("H", "gap_h", "b365_ph"), ("D", "gap_d", "b365_pd"), ("A", "gap_a", "b365_pa")]:
-        sub = df[df[gap_col].notna()].copy()
-        sub["actual"] = (sub["FTR"] == outcome).astype(int)
-        sub["high_gap"] = sub[gap_col] > 0.03
-
-        agg = sub.groupby("high_gap", observed=True).agg(
-            n=("actual", "count"),
-            win_rate=("actual", "mean"),
-            avg_gap=(gap_col, "mean"),
-            avg_implied=(prob_col, "mean"),
-        ).reset_index()
-        agg["outcome"] = outcome
-        rows.append(agg)
-
-    return pd.concat(rows, ignore_index=True)
+def _pre(market):
+    # column prefix features.add_value_gap / add_favourites use per market
+    return "" if market == "1x2" else f"{market}_"
 
+@profiled
+def gap_summary(df, by=(), market="1x2"):
+    pre = _pre(market)
+    grp = df.loc[df[f"{pre}max_gap"].notna()]
+    target = {"fav": {"p": f"{pre}fav_implied", "y": f"{pre}fav_won", "max_gap": f"{pre}max_gap"}}
+
+    summary = ratios(stat_cube(grp, target, dims=[*by, f"{pre}high_gap"]))
+    summary = summary.rename(columns={f"{pre}high_gap": "high_gap", "avg_p": "avg_b365_implied"})
+
+    return summary[[*by, "high_gap", "n", "win_rate", "avg_b365_implied", "avg_max_gap"]]
+
+@profiled
+def gap_by_outcome(df, by=(), market="1x2", threshold=0.03):
+    # break down where the gap is coming from — h, d, or a (over / under,
+    # home / away). the outcomes are stacked and summed together rather than
+    # looped over. win_rate counts ah half wins as half
+    outcomes = MARKETS[market]["outcomes"]
+    win, _ = settle(df, market)
+    probs = market_columns(market, "b365")
+    targets = {o: {"p": probs[i], "y": win[:, i], "gap": f"{_pre(market)}gap_{o.lower()}"}
+               for i, o in enumerate(outcomes)}
+    long = stack(df, targets, dims=by)
+    long["high_gap"] = long["gap"] > threshold
+
+    out = ratios(aggregate(long, [*by, "high_gap"]))
+    out = out.rename(columns={"target": "outcome", "avg_p": "avg_implied"})
+    return out[[*by, "high_gap", "n", "win_rate", "avg_gap", "avg_implied", "outcome"]]
+
+@profiled
+def gap_by_market(df, by=()):
+    # gap_summary for every market with a b365 and a max price set
+    parts = [gap_summary(df, by=by, market=m).assign(market=m) for m in MARKETS
+             if f"{_pre(m)}max_gap" in df.columns]
+    out = pd.concat(parts, ignore_index=True)
+    return out[["market"] + [c for c in out.columns if c != "market"]]
+
+@profiled
 def gap_distribution(df):
     mask = df[["gap_h", "gap_d", "gap_a"]].notna().all(axis=1)
     melted = df[mask][["gap_h", "gap_d", "gap_a"]].melt(var_name="outcome", value_name="gap")
     melted["outcome"] = melted["outcome"].map({"gap_h": "H", "gap_d": "D", "gap_a": "A"})
     return melted
 
+@profiled
 def gap_by_season(df):
     mask = df["high_gap"].notna()
     return (
@@ -51,4 +61,134 @@ def gap_by_season(df):
         .groupby(["season", "high_gap"], observed=True)
         .agg(n=("high_gap", "count"), avg_gap=("max_gap", "mean"))
         .reset_index()
-    )
\ No newline at end of file
+    )
+# ---------- outlier books ----------
+# every bookmaker's 1x2 prices against the consensus of the others and
+# against the best price on offer, gap = reference prob - book prob like
+# above (positive: the book's price is longer than the reference says)
+
+def _loo_median(probs):
+    # (n, k, outcomes) -> for every book, the median over the other books
+    # quoting the match (NaN = not quoted). off one sort: dropping the book
+    # at sorted position r shifts everything above it down by one, so the
+    # middle of the remaining m - 1 values sits at a known sorted index
+    k = probs.shape[1]
+    order = np.argsort(probs, axis=1, kind="stable")
+    sorted_p = np.take_along_axis(probs, order, axis=1)
+    rank = np.empty_like(order)
+    np.put_along_axis(rank, order, np.arange(k)[None, :, None], axis=1)
+
+    rest = (~np.isnan(probs)).sum(axis=1, keepdims=True) - 1
+    lo, hi = (rest - 1) // 2, rest // 2
+    lo, hi = lo + (lo >= rank), hi + (hi >= rank)
+
+    def at(i):
+        return np.take_along_axis(sorted_p, np.clip(i, 0, k - 1), axis=1)
+
+    out = (at(lo) + at(hi)) / 2
+    out[(rest < 1) | np.isnan(probs)] = np.nan
+    return out
+
+def book_gaps(df, books=None, method="multiplicative", min_books=2):
+    # one (n_matches x n_books x 3) block for every bookmaker with a full set
+    # of prices in df, de-vigged in one call. a book's consensus is the
+    # median de-vigged prob over the other books quoting the match (NaN with
+    # fewer than min_books quoting, itself included), so it isn't pulled
+    # towards the book being scored. best is the de-vigged set of best
+    # prices per outcome. the result is what outlier_scan / gap_threshold_sweep take
+    wanted = books or BOOKMAKERS
+    books = [b for b in wanted if all(f"{b}{o}" in df.columns for o in "HDA")]
+    if not books:
+        raise ValueError(f"no bookmaker with a full set of 1x2 prices in df, "
+                         f"looked for <code>H/D/A with codes {', '.join(wanted)}")
+    odds = np.stack([df[[f"{b}H", f"{b}D", f"{b}A"]].to_numpy(dtype=np.float64) for b in books], axis=1)
+    probs, overround = devig(odds, method=method)
+
+    quoted = ~np.isnan(probs).any(axis=2)
+    with warnings.catch_warnings():
+        # matches nobody quotes
+        warnings.simplefilter("ignore", RuntimeWarning)
+        best_p, _ = devig(np.nanmax(odds, axis=1), method=method)
+    consensus = _loo_median(probs)
+    consensus[np.broadcast_to((quoted.sum(axis=1) < min_books)[:, None, None], consensus.shape)] = np.nan
+
+    win, _ = settle(df, "1x2")
+    return {
+        "books": books, "odds": odds, "probs": probs, "overround": overround,
+        "gap_consensus": consensus - probs,
+        "gap_best": best_p[:, None, :] - probs,
+        "won": np.broadcast_to(win[:, None, :], probs.shape),
+    }
+
+@profiled
+def outlier_scan(gaps):
+    # per (book, outcome): how far the book sits from the consensus on
+    # average, how often it is the furthest book out and how often it has
+    # the best price. ranked, biggest outlier first
+    books, gap = gaps["books"], gaps["gap_consensus"]
+    ok = ~np.isnan(gap)
+    absgap = np.where(ok, np.abs(gap), -np.inf)
+    furthest = np.argmax(absgap, axis=1)
+    has_any = ok.any(axis=1)
+    best = np.argmax(np.where(np.isnan(gaps["odds"]), -np.inf, gaps["odds"]), axis=1)
+    priced = ~np.isnan(gaps["odds"])
+
+    n = ok.sum(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        out = pd.DataFrame({
+            "book": np.repeat(books, 3),
+            "outcome": np.tile(MARKETS["1x2"]["outcomes"], len(books)),
+            "n": n.ravel(),
+            "avg_gap_consensus": (np.where(ok, gap, 0).sum(axis=0) / n).ravel(),
+            "avg_abs_gap_consensus": (np.where(ok, np.abs(gap), 0).sum(axis=0) / n).ravel(),
+            "avg_gap_best": np.nanmean(np.where(ok, gaps["gap_best"], np.nan), axis=0).ravel(),
+            "outlier_share": ((furthest[:, None, :] == np.arange(len(books))[:, None]) & has_any[:, None, :]
+                              & ok).sum(axis=0).ravel() / n.ravel(),
+            "best_price_share": ((best[:, None, :] == np.arange(len(books))[:, None]) & priced)
+                                .sum(axis=0).ravel() / priced.sum(axis=0).ravel(),
+            "avg_overround": np.repeat(np.nanmean(gaps["overround"], axis=0), 3),
+        })
+    out = out.sort_values("avg_abs_gap_consensus", ascending=False, kind="stable").reset_index(drop=True)
+    out.insert(0, "rank", np.arange(1, len(out) + 1))
+    return out
+
+@profiled
+def gap_threshold_sweep(gaps, thresholds=None, gap="gap_consensus", stake=1.0):
+    # flat bet at a book's price on every (match, outcome) where its gap is
+    # >= threshold, for every book and threshold off the one gaps array:
+    # each book's cells are sorted by gap once and the bets at threshold t
+    # are the first count(gap >= t) of them (same trick as backtest.sweep_returns)
+    books = gaps["books"]
+    thresholds = np.asarray(thresholds if thresholds is not None else np.round(np.arange(0, 0.1001, 0.005), 3),
+                            dtype=np.float64)
+    # (n_matches * 3, n_books) cells, unquoted ones sort last and never bet
+    g = np.moveaxis(gaps[gap], 1, -1).reshape(-1, len(books))
+    odds = np.moveaxis(gaps["odds"], 1, -1).reshape(-1, len(books))
+    won = np.moveaxis(gaps["won"], 1, -1).reshape(-1, len(books))
+    g = np.where(np.isnan(g) | np.isnan(won), -np.inf, g)
+    won = np.nan_to_num(won)
+
+    order = np.argsort(-g, axis=0, kind="stable")
+    sorted_g = np.take_along_axis(g, order, axis=0)
+
+    def cum(v):
+        return np.vstack([np.zeros((1, len(books))), np.cumsum(np.take_along_axis(v, order, axis=0), axis=0)])
+
+    pnl = stake * (won * np.nan_to_num(odds) - 1)
+    cum_pnl, cum_won, cum_odds = cum(pnl), cum(won), cum(np.nan_to_num(odds))
+    n_bets = np.stack([np.searchsorted(-sorted_g[:, j], -thresholds, side="right") for j in range(len(books))],
+                      axis=1)
+    cols = np.arange(len(books))[None, :]
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        out = pd.DataFrame({
+            "book": np.repeat(np.array(books)[None, :], len(thresholds), axis=0).ravel(),
+            "threshold": np.repeat(thresholds, len(books)),
+            "n_bets": n_bets.ravel(),
+            "n_won": cum_won[n_bets, cols].astype(int).ravel(),
+            "strike_rate": (cum_won[n_bets, cols] / n_bets).ravel(),
+            "avg_odds": (cum_odds[n_bets, cols] / n_bets).ravel(),
+            "total_pnl": cum_pnl[n_bets, cols].ravel(),
+            "roi": (cum_pnl[n_bets, cols] / (n_bets * stake)).ravel(),
+        })
+    return out
@@ -1,97 +1,346 @@
+import os
+import json
+import hashlib
 import numpy as np
 import pandas as pd
+from src.schema import FLOAT, KNOWN_CATEGORIES, compact
+from src.profiling import profiled
 
-def remove_vig(h, d, a):
-    total = 1/h + 1/d + 1/a
-    return 1/(h * total), 1/(d * total), 1/(a * total)
-
-def add_implied_probs(df):
-    for prefix, cols in [
-        ("b365", ("B365H", "B365D", "B365A")),
-        ("ps",   ("PSH",   "PSD",   "PSA")),
-        ("max",  ("MaxH",  "MaxD",  "MaxA")),
-    ]:
-        mask = df[list(cols)].notna().all(axis=1)
-        ph, pd_, pa = remove_vig(df.loc[mask, cols[0]], df.loc[mask, cols[1]], df.loc[mask, cols[2]])
-        df.loc[mask, f"{prefix}_ph"] = ph
-        df.loc[mask, f"{prefix}_pd"] = pd_
-        df.loc[mask, f"{prefix}_pa"] = pa
-
-    # opening b365 implied probs (used for line movement)
-    mask = df[["B365CH", "B365CD", "B365CA"]].notna().all(axis=1)
-    ph, pd_, pa = remove_vig(df.loc[mask, "B365CH"], df.loc[mask, "B365CD"], df.loc[mask, "B365CA"])
-    df.loc[mask, "b365_open_ph"] = ph
-    df.loc[mask, "b365_open_pd"] = pd_
-    df.loc[mask, "b365_open_pa"] = pa
+# every 1x2 price set we de-vig. b365_open comes from the B365C* columns
+# (see line movement). the pinnacle and market max closing sets are the
+# PSC* / MaxC* columns, ps / max being their opening prices
+BOOKS = {
+    "b365":      ("B365H",  "B365D",  "B365A"),
+    "ps":        ("PSH",    "PSD",    "PSA"),
+    "max":       ("MaxH",   "MaxD",   "MaxA"),
+    "avg":       ("AvgH",   "AvgD",   "AvgA"),
+    "b365_open": ("B365CH", "B365CD", "B365CA"),
+    "ps_close":  ("PSCH",   "PSCD",   "PSCA"),
+    "max_close": ("MaxCH",  "MaxCD",  "MaxCA"),
+}
 
-    return df
+def _devig_multiplicative(q):
+    return q / q.sum(axis=-1, keepdims=True)
+
+def _devig_power(q, iters=30):
+    # p_i = q_i ** k with k picked so the p_i sum to 1 (newton on k)
+    k = np.ones(q.shape[:-1] + (1,))
+    logq = np.log(q)
+    for _ in range(iters):
+        qk = q ** k
+        f = qk.sum(axis=-1, keepdims=True) - 1
+        k = k - f / (qk * logq).sum(axis=-1, keepdims=True)
+    return q ** k
+
+def _devig_shin(q, iters=50):
+    # shin (1993): z is the share of insider money. bisection on z so it works
+    # for 2-way markets too, where the usual fixed-point update divides by n-2.
+    # sets with no overround (best prices across books can sum below 1) have
+    # no z to find, those fall back to multiplicative
+    S = q.sum(axis=-1, keepdims=True)
+    lo = np.zeros(q.shape[:-1] + (1,))
+    hi = np.full_like(lo, 0.999)
+
+    def probs(z):
+        return (np.sqrt(z ** 2 + 4 * (1 - z) * q ** 2 / S) - z) / (2 * (1 - z))
+
+    for _ in range(iters):
+        z = (lo + hi) / 2
+        over = probs(z).sum(axis=-1, keepdims=True) > 1
+        lo = np.where(over, z, lo)
+        hi = np.where(over, hi, z)
+    return np.where(S > 1, probs((lo + hi) / 2), q / S)
+
+DEVIG_METHODS = {
+    "multiplicative": _devig_multiplicative,
+    "power": _devig_power,
+    "shin": _devig_shin,
+}
+
+def devig(odds, method="multiplicative"):
+    # odds: (..., n_outcomes) decimal odds, any leading shape (matches x books).
+    # returns (probs same shape, overround with the last axis dropped).
+    # rows with a missing price come back all-NaN
+    odds = np.asarray(odds, dtype=np.float64)
+    q = 1 / odds
+    overround = q.sum(axis=-1)
+
+    ok = np.isfinite(overround)
+    probs = np.full(odds.shape, np.nan)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        probs[ok] = DEVIG_METHODS[method](q[ok])
+    return probs, overround
+
+# every market, 1x2 first. price sets are named as in BOOKS for the 1x2 and
+# <market>_<book> for the rest, so de-vigged columns come out as b365_ph /
+# ou_b365_pover / ah_ps_paway and <set>_overround
+MARKETS = {
+    "1x2": {"outcomes": KNOWN_CATEGORIES["FTR"], "books": BOOKS},
+    "ou":  {"outcomes": ["over", "under"], "books": {
+        "b365": ("B365>2.5", "B365<2.5"),
+        "ps":   ("P>2.5",    "P<2.5"),
+        "max":  ("Max>2.5",  "Max<2.5"),
+    }},
+    "ah":  {"outcomes": ["home", "away"], "books": {
+        "b365": ("B365AHH", "B365AHA"),
+        "ps":   ("PAHH",    "PAHA"),
+        "max":  ("MaxAHH",  "MaxAHA"),
+    }},
+}
+
+def market_prefix(market, book):
+    return book if market == "1x2" else f"{market}_{book}"
+
+def market_columns(market, book):
+    # de-vigged prob column per outcome
+    prefix = market_prefix(market, book)
+    return [f"{prefix}_p{o.lower()}" for o in MARKETS[market]["outcomes"]]
+
+@profiled
+def add_implied_probs(df, method="multiplicative"):
+    # every (market, book) price set with the same number of outcomes goes in
+    # one (n_matches x n_sets x n_outcomes) block, de-vigged in a single pass:
+    # one call for the 1x2 sets, one for all the two-way o/u and ah sets.
+    # sets whose columns aren't in the csvs are skipped
+    sets = [(m, b, cols) for m, spec in MARKETS.items() for b, cols in spec["books"].items()
+            if all(c in df.columns for c in cols)]
+
+    out = {}
+    for width in sorted({len(cols) for _, _, cols in sets}, reverse=True):
+        group = [s for s in sets if len(s[2]) == width]
+        odds = np.stack([df[list(cols)].to_numpy(dtype=np.float64) for _, _, cols in group], axis=1)
+        probs, overround = devig(odds, method=method)
+        for j, (market, book, _) in enumerate(group):
+            for i, col in enumerate(market_columns(market, book)):
+                out[col] = probs[:, j, i]
+            out[f"{market_prefix(market, book)}_overround"] = overround[:, j]
+
+    new = pd.DataFrame(out, index=df.index).astype(FLOAT)
+    return pd.concat([df.drop(columns=[c for c in new.columns if c in df.columns]), new], axis=1)
+
+def settle(df, market):
+    # (n_matches, n_outcomes) shares of a stake on each outcome that win and
+    # that are pushed back, from FTR / the full-time score. asian handicap
+    # quarter lines split the stake over the two lines either side, which is
+    # where the 0.5s come from. NaN where the result (or the line) is missing
+    n_out = len(MARKETS[market]["outcomes"])
+    if market == "1x2":
+        codes = pd.Categorical(df["FTR"], categories=KNOWN_CATEGORIES["FTR"]).codes \
+            if "FTR" in df.columns else np.full(len(df), -1)
+        win = (codes[:, None] == np.arange(n_out)).astype(np.float64)
+        win[codes < 0] = np.nan
+        return win, np.where(np.isnan(win), np.nan, 0.0)
+
+    if not {"FTHG", "FTAG"} <= set(df.columns):
+        nan = np.full((len(df), n_out), np.nan)
+        return nan, nan
+    diff = df["FTHG"].to_numpy(dtype=np.float64) - df["FTAG"].to_numpy(dtype=np.float64)
+    if market == "ou":
+        over = (df["FTHG"].to_numpy(dtype=np.float64) + df["FTAG"].to_numpy(dtype=np.float64)) > 2.5
+        win = np.column_stack([over, ~over]).astype(np.float64)
+        push = np.zeros_like(win)
+    elif market == "ah":
+        # AHh is the home side's handicap; .25 / .75 lines are quarter lines
+        line = df["AHh"].to_numpy(dtype=np.float64) if "AHh" in df.columns else np.full(len(df), np.nan)
+        quarter = np.abs(line * 4) % 2 == 1
+        margin = (diff + line)[:, None] + np.where(quarter, 0.25, 0.0)[:, None] * np.array([-1.0, 1.0])
+        home, push_h, away = (margin > 0).mean(axis=1), (margin == 0).mean(axis=1), (margin < 0).mean(axis=1)
+        win = np.column_stack([home, away])
+        push = np.column_stack([push_h, push_h])
+        diff = diff + line
+    else:
+        raise ValueError(f"unknown market {market}, have {', '.join(MARKETS)}")
+    missing = np.isnan(diff)
+    win[missing], push[missing] = np.nan, np.nan
+    return win, push
+
+# favourite per price set: outcome, implied prob, decimal odds, gross payout
+# per unit staked (odds on a win, the stake back on a push) and whether it
+# made money. the b365 1x2 closing set keeps the plain fav_* names the
+# analysis uses
+FAVOURITES = {
+    ("1x2", "b365"):      "fav",
+    ("1x2", "b365_open"): "open_fav",
+    ("1x2", "ps"):        "ps_fav",
+    ("ou", "b365"):       "ou_fav",
+    ("ah", "b365"):       "ah_fav",
+}
+
+@profiled
+def add_favourites(df):
+    settled = {}
+    for (market, book), name in FAVOURITES.items():
+        cols = market_columns(market, book)
+        if not all(c in df.columns for c in cols):
+            continue
+        if market not in settled:
+            settled[market] = settle(df, market)
+        win, push = settled[market]
+        probs = df[cols].to_numpy(dtype=np.float64)
+        odds = df[list(MARKETS[market]["books"][book])].to_numpy(dtype=np.float64)
+        valid = ~np.isnan(probs).any(axis=1)
+
+        idx = np.argmax(np.where(valid[:, None], probs, -np.inf), axis=1)
+        pick = idx[:, None]
+
+        def take(a):
+            return np.where(valid, np.take_along_axis(a, pick, axis=1)[:, 0], np.nan)
+
+        payout = take(win) * take(odds) + take(push)
+        df[f"{name}_outcome"] = pd.Categorical.from_codes(np.where(valid, idx, -1),
+                                                          categories=MARKETS[market]["outcomes"])
+        df[f"{name}_implied"] = take(probs).astype(FLOAT)
+        df[f"{name}_odds"] = take(odds).astype(FLOAT)
+        df[f"{name}_payout"] = payout.astype(FLOAT)
+        df[f"{name}_won"] = valid & (payout > 1)
 
-def add_overround(df):
-    df["b365_overround"] = 1/df["B365H"] + 1/df["B365D"] + 1/df["B365A"]
-    df["ps_overround"]   = 1/df["PSH"]   + 1/df["PSD"]   + 1/df["PSA"]
     return df
 
-def categorise_movement(row):
+def categorise_movement(df, detect_flip=False):
     # compare b365 closing vs opening implied prob for the favourite
     # favourite defined by closing b365 implied prob
-    if any(np.isnan(v) for v in [row["b365_ph"], row["b365_pa"], row["b365_open_ph"], row["b365_open_pa"]]):
-        return np.nan
+    ph, pa = df["b365_ph"].to_numpy(), df["b365_pa"].to_numpy()
+    open_ph, open_pa = df["b365_open_ph"].to_numpy(), df["b365_open_pa"].to_numpy()
+    valid = ~(np.isnan(ph) | np.isnan(pa) | np.isnan(open_ph) | np.isnan(open_pa))
 
-    home_fav = row["b365_ph"] >= row["b365_pa"]
-    if home_fav:
-        close_p, open_p = row["b365_ph"], row["b365_open_ph"]
-    else:
-        close_p, open_p = row["b365_pa"], row["b365_open_pa"]
+    home_fav = ph >= pa
+    close_p = np.where(home_fav, ph, pa)
+    open_p = np.where(home_fav, open_ph, open_pa)
 
     delta = close_p - open_p  # positive = steamed (shortened), negative = drifted
+    stable = np.abs(delta) < 0.02
 
-    if abs(delta) < 0.02:
-        return "stable_fav" if close_p >= 0.5 else "stable_dog"
-    elif delta > 0.02:
-        return "steamed_fav"
-    elif delta < -0.02:
-        return "drifted_fav"
-    else:
-        # implied favourite flipped between open and close
-        return "flip"
+    # implied favourite flipped between open and close. only split out when
+    # asked for, otherwise these matches land in steamed/drifted like before
+    flipped = (home_fav != (open_ph >= open_pa)) if detect_flip else np.zeros(len(df), dtype=bool)
 
-def add_line_movement(df):
-    df["movement_cat"] = df.apply(categorise_movement, axis=1)
+    cats = KNOWN_CATEGORIES["movement_cat"]
+    code = {c: i for i, c in enumerate(cats)}
+    codes = np.select(
+        [~valid, flipped, stable & (close_p >= 0.5), stable, delta > 0],
+        [-1, code["flip"], code["stable_fav"], code["stable_dog"], code["steamed_fav"]],
+        default=code["drifted_fav"],
+    )
+    return pd.Categorical.from_codes(codes, categories=cats)
+
+@profiled
+def add_line_movement(df, detect_flip=False):
+    df["movement_cat"] = categorise_movement(df, detect_flip=detect_flip)
     df["b365_close_open_delta_h"] = df["b365_ph"] - df["b365_open_ph"]
     df["b365_close_open_delta_a"] = df["b365_pa"] - df["b365_open_pa"]
     return df
 
-def add_value_gap(df):
-    # value gap: how much lower is b365 implied prob vs market max
-    # positive gap = b365 is less generous than the market max
-    mask = df[["max_ph", "b365_ph", "max_pa", "b365_pa", "max_pd", "b365_pd"]].notna().all(axis=1)
-    df.loc[mask, "gap_h"] = df.loc[mask, "max_ph"] - df.loc[mask, "b365_ph"]
-    df.loc[mask, "gap_d"] = df.loc[mask, "max_pd"] - df.loc[mask, "b365_pd"]
-    df.loc[mask, "gap_a"] = df.loc[mask, "max_pa"] - df.loc[mask, "b365_pa"]
+@profiled
+def add_value_gap(df, threshold=0.03):
+    # value gap: how much lower is b365 implied prob vs market max, for every
+    # market with both. positive gap = b365 is less generous than the market
+    # max. the 1x2 keeps gap_h / max_gap / high_gap, the others get
+    # ou_gap_over / ou_max_gap / ou_high_gap and so on
+    for market, spec in MARKETS.items():
+        b365, best = market_columns(market, "b365"), market_columns(market, "max")
+        if not all(c in df.columns for c in b365 + best):
+            continue
+        gap = df[best].to_numpy() - df[b365].to_numpy()
+        mask = ~np.isnan(gap).any(axis=1)
+        gap[~mask] = np.nan
 
-    # max gap across any outcome for this match
-    df.loc[mask, "max_gap"] = df.loc[mask, ["gap_h", "gap_d", "gap_a"]].max(axis=1)
-    df["high_gap"] = df["max_gap"] > 0.03
+        pre = "" if market == "1x2" else f"{market}_"
+        for i, outcome in enumerate(spec["outcomes"]):
+            df[f"{pre}gap_{outcome.lower()}"] = gap[:, i]
+        # max gap across any outcome for this match
+        max_gap = np.where(mask, gap.max(axis=1, initial=-np.inf), np.nan)
+        df[f"{pre}max_gap"] = max_gap.astype(gap.dtype)
+        df[f"{pre}high_gap"] = df[f"{pre}max_gap"] > threshold
 
     return df
 
-def add_season_phase(df):
+@profiled
+def add_season_phase(df, per_league=False):
     # early = first 10 GWs, late = last 10 GWs, mid = everything else
-    # rough approximation: sort by date within season, assign decile
-    df["season_phase"] = "mid"
-    for season, grp in df.groupby("season"):
-        n = len(grp)
-        early_cut = grp["Date"].quantile(0.26)
-        late_cut  = grp["Date"].quantile(0.74)
-        df.loc[grp[grp["Date"] <= early_cut].index, "season_phase"] = "early"
-        df.loc[grp[grp["Date"] >= late_cut].index,  "season_phase"] = "late"
+    # rough approximation: date quantiles within each season. the leagues run
+    # different calendars, so per_league=True cuts within each league-season
+    keys = ["league", "season"] if per_league else ["season"]
+    dates = df.groupby(keys, observed=True)["Date"]
+    early_cut = dates.transform("quantile", 0.26)
+    late_cut = dates.transform("quantile", 0.74)
+
+    # late wins ties, same as the old loop which wrote late after early
+    codes = np.select([df["Date"] >= late_cut, df["Date"] <= early_cut], [2, 0], default=1)
+    df["season_phase"] = pd.Categorical.from_codes(codes, categories=KNOWN_CATEGORIES["season_phase"])
 
     return df
 
-def build_features(df):
-    df = add_implied_probs(df)
-    df = add_overround(df)
-    df = add_line_movement(df)
+def build_row_features(df, devig_method="multiplicative", detect_flip=False):
+    # everything that only looks at the match itself (so also usable on live
+    # odds snapshots with no history around them)
+    df = add_implied_probs(df, method=devig_method)
+    df = add_favourites(df)
+    df = add_line_movement(df, detect_flip=detect_flip)
     df = add_value_gap(df)
-    df = add_season_phase(df)
-    return df
\ No newline at end of file
+    return df
+
+@profiled
+def build_features(df, devig_method="multiplicative", phase_per_league=False, detect_flip=False):
+    df = build_row_features(df, devig_method=devig_method, detect_flip=detect_flip)
+    df = add_season_phase(df, per_league=phase_per_league)
+    # derived probs come out of the .loc writes as float64
+    return compact(df)
+
+# bump when anything above changes what build_features produces
+FEATURES_VERSION = 4
+
+def _row_hashes(df):
+    # one uint64 per match over the raw loaded columns. categoricals hash by
+    # value so frames with different category sets still line up
+    return pd.util.hash_pandas_object(df, index=False).to_numpy()
+
+@profiled
+def build_features_incremental(df, cache_dir="data/cache", devig_method="multiplicative",
+                               phase_per_league=False, detect_flip=False):
+    # same result as build_features(df), but reuses the last build for every
+    # match whose raw columns are unchanged. only season_phase looks across
+    # rows, so it gets redone for seasons that gained, lost or changed matches
+    raw_cols = list(df.columns)
+    cols_key = hashlib.sha1(json.dumps(raw_cols).encode()).hexdigest()[:8]
+    phase_key = "league" if phase_per_league else "pooled"
+    flip_key = "_flip" if detect_flip else ""
+    path = os.path.join(cache_dir, f"features_v{FEATURES_VERSION}_{devig_method}_{phase_key}{flip_key}_{cols_key}.parquet")
+
+    prev = pd.read_parquet(path) if os.path.exists(path) else None
+    if prev is None:
+        out = build_features(df, devig_method=devig_method, phase_per_league=phase_per_league,
+                             detect_flip=detect_flip)
+    else:
+        derived = [c for c in prev.columns if c not in raw_cols]
+        new_h = _row_hashes(df[raw_cols])
+        old_h = _row_hashes(prev[raw_cols])
+
+        lookup = prev[derived].set_axis(old_h)
+        lookup = lookup[~lookup.index.duplicated()]
+        hit = np.isin(new_h, lookup.index)
+        print(f"  features: {int((~hit).sum())} new/changed rows, reusing {int(hit.sum())}")
+
+        parts = [lookup.loc[new_h[hit]].set_axis(df.index[hit])]
+        if (~hit).any():
+            fresh = build_features(df.loc[~hit].copy(), devig_method=devig_method,
+                                   phase_per_league=phase_per_league, detect_flip=detect_flip)
+            parts.append(fresh[derived])
+        derived_df = pd.concat(parts).reindex(df.index).astype(prev[derived].dtypes.to_dict())
+        out = pd.concat([df, derived_df], axis=1)[list(prev.columns)]
+
+        # seasons whose set of matches moved need their date quantiles redone
+        gone = ~np.isin(old_h, new_h)
+        changed = set(df.loc[~hit, "season"].astype(str)) | set(prev.loc[gone, "season"].astype(str))
+        if not changed:
+            return out
+
+        in_changed = out["season"].astype(str).isin(changed).to_numpy()
+        phase = add_season_phase(out.loc[in_changed, ["league", "season", "Date"]].copy(),
+                                 per_league=phase_per_league)["season_phase"]
+        out["season_phase"] = out["season_phase"].astype(object)
+        out.loc[in_changed, "season_phase"] = phase.astype(object)
+        out = compact(out)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    out.to_parquet(path)
+    return out
@@ -1,6 +1,11 @@
 import os
 import glob
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
+from src.schema import NON_NUMERIC, compact, concat_compact
+from src.profiling import profiled
 
 KEEP_COLS = [
     "Div", "Date", "HomeTeam", "AwayTeam",
@@ -13,10 +18,15 @@ KEEP_COLS = [
     "MaxH", "MaxD", "MaxA",
     "MaxCH", "MaxCD", "MaxCA",
     "AvgH", "AvgD", "AvgA",
-    "B365>2.5", "B365<2.5", "P>2.5", "P<2.5", "Max>2.5",
-    "AHh", "B365AHH", "B365AHA", "PAHH", "PAHA",
+    "B365>2.5", "B365<2.5", "P>2.5", "P<2.5", "Max>2.5", "Max<2.5",
+    "AHh", "B365AHH", "B365AHA", "PAHH", "PAHA", "MaxAHH", "MaxAHA",
 ]
 
+# every bookmaker football-data has quoted 1x2 prices for over the years,
+# <code>H / <code>D / <code>A. whichever ones a csv has get kept
+BOOKMAKERS = ["B365", "BS", "BW", "GB", "IW", "LB", "PS", "SO", "SB", "SJ", "SY", "VC", "WH", "1XB"]
+KEEP_COLS += [f"{b}{o}" for b in BOOKMAKERS for o in "HDA" if f"{b}{o}" not in KEEP_COLS]
+
 LEAGUE_NAMES = {
     "E0":  "Premier League", #added
     "SP1": "La Liga", #added
@@ -28,43 +38,165 @@ LEAGUE_NAMES = {
     "B1":  "Belgian Pro League", #added
 }
 
-def load_all(data_dir="data/raw"):
-    files = sorted(glob.glob(os.path.join(data_dir, "*.csv")))
-    if not files:
-        raise FileNotFoundError(f"no CSVs found in {data_dir}")
+# bump when the per-file parse below changes so old cache entries get thrown away
+CACHE_VERSION = 3
 
-    print(f"loading {len(files)} files...")
-    frames = []
-    for f in files:
-        df = pd.read_csv(f, encoding="latin-1")
+def parse_file(f):
+    return clean_rows(pd.read_csv(f, encoding="latin-1"), f)
 
-        # SP1_2122.csv -> league="SP1", season="2021-22"
-        stem = os.path.splitext(os.path.basename(f))[0]
-        parts = stem.split("_")
-        league_code = parts[0]
-        tag = parts[-1]
+def iter_file_chunks(f, chunksize=50_000):
+    # parse_file a chunk of rows at a time, for files too big to read whole
+    with pd.read_csv(f, encoding="latin-1", chunksize=chunksize) as reader:
+        for chunk in reader:
+            yield clean_rows(chunk, f)
 
-        df["season"] = f"20{tag[:2]}-{tag[2:]}" if len(tag) == 4 else tag
-        df["league"] = LEAGUE_NAMES.get(league_code, league_code)
+def clean_rows(df, f):
+    # raw rows of csv f (all of it or a chunk) -> kept, typed columns.
+    # SP1_2122.csv -> league="SP1", season="2021-22"
+    stem = os.path.splitext(os.path.basename(f))[0]
+    parts = stem.split("_")
+    league_code = parts[0]
+    tag = parts[-1]
 
-        keep = [c for c in KEEP_COLS if c in df.columns] + ["season", "league"]
-        frames.append(df[keep])
+    df["season"] = f"20{tag[:2]}-{tag[2:]}" if len(tag) == 4 else tag
+    df["league"] = LEAGUE_NAMES.get(league_code, league_code)
 
-    df = pd.concat(frames, ignore_index=True)
+    keep = [c for c in KEEP_COLS if c in df.columns] + ["season", "league"]
+    df = df[keep]
 
     df["Date"] = pd.to_datetime(df["Date"], dayfirst=True, errors="coerce")
     df = df.dropna(subset=["FTR", "Date"])
     df = df[df["FTR"].str.strip().str.upper().isin(["H", "D", "A"])]
     df["FTR"] = df["FTR"].str.strip().str.upper()
 
-    non_numeric = ["Div", "Date", "HomeTeam", "AwayTeam", "FTR", "season", "league"]
-    odds_cols = [c for c in df.columns if c not in non_numeric]
+    odds_cols = [c for c in df.columns if c not in NON_NUMERIC]
     df[odds_cols] = df[odds_cols].apply(pd.to_numeric, errors="coerce")
 
+    return compact(df.reset_index(drop=True))
+
+def parse_files(files, workers=1):
+    # workers=None -> one per core. pool.map keeps the input order
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(files))
+    if workers <= 1:
+        return [parse_file(f) for f in files]
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(parse_file, files, chunksize=max(1, len(files) // (workers * 4))))
+
+def _content_hash(f):
+    h = hashlib.sha1()
+    with open(f, "rb") as fh:
+        for chunk in iter(lambda: fh.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _cache_schema():
+    # anything that changes what parse_file produces has to invalidate the cache
+    return hashlib.sha1(json.dumps([CACHE_VERSION, KEEP_COLS, LEAGUE_NAMES]).encode()).hexdigest()
+
+def _read_manifest(cache_dir):
+    p = os.path.join(cache_dir, "manifest.json")
+    if not os.path.exists(p):
+        return {}
+    with open(p) as fh:
+        manifest = json.load(fh)
+    if manifest.get("schema") != _cache_schema():
+        return {}
+    return manifest.get("files", {})
+
+def _write_manifest(cache_dir, entries):
+    p = os.path.join(cache_dir, "manifest.json")
+    tmp = p + ".tmp"
+    with open(tmp, "w") as fh:
+        json.dump({"schema": _cache_schema(), "files": entries}, fh, indent=1)
+    os.replace(tmp, p)
+
+def lookup_cached(f, cache_dir, manifest):
+    # cache key is path + mtime + size, falling back to a content hash when the
+    # stat changed (e.g. re-downloaded but identical file) so we don't re-parse.
+    # returns (df or None, sha1 or None, manifest_changed)
+    key = os.path.abspath(f)
+    st = os.stat(f)
+    entry = manifest.get(key)
+    cache_path = entry and os.path.join(cache_dir, entry["cache_file"])
+
+    if not entry or not os.path.exists(cache_path):
+        return None, _content_hash(f), False
+
+    if entry["mtime"] == st.st_mtime_ns and entry["size"] == st.st_size:
+        return pd.read_parquet(cache_path, memory_map=True), None, False
+
+    sha = _content_hash(f)
+    if entry["sha1"] == sha:
+        entry["mtime"], entry["size"] = st.st_mtime_ns, st.st_size
+        return pd.read_parquet(cache_path, memory_map=True), None, True
+    return None, sha, False
+
+def store_cached(f, df, sha, cache_dir, manifest):
+    key = os.path.abspath(f)
+    st = os.stat(f)
+    stem = os.path.splitext(os.path.basename(f))[0]
+    cache_file = f"{stem}_{hashlib.sha1(key.encode()).hexdigest()[:8]}.parquet"
+    df.to_parquet(os.path.join(cache_dir, cache_file), index=False)
+
+    old = manifest.get(key)
+    if old and old["cache_file"] != cache_file and os.path.exists(os.path.join(cache_dir, old["cache_file"])):
+        os.remove(os.path.join(cache_dir, old["cache_file"]))
+
+    manifest[key] = {"mtime": st.st_mtime_ns, "size": st.st_size, "sha1": sha, "cache_file": cache_file}
+
+@profiled
+def load_all(data_dir="data/raw", cache_dir="data/cache", workers=1):
+    # cache_dir=None turns the parquet cache off and parses every csv.
+    # workers > 1 (or None for all cores) parses the uncached files in a process pool
+    files = sorted(glob.glob(os.path.join(data_dir, "*.csv")))
+    if not files:
+        raise FileNotFoundError(f"no CSVs found in {data_dir}")
+
+    print(f"loading {len(files)} files...")
+    if cache_dir is None:
+        frames = parse_files(files, workers=workers)
+    else:
+        os.makedirs(cache_dir, exist_ok=True)
+        manifest = _read_manifest(cache_dir)
+        dirty = False
+
+        frames, misses = [], []
+        for i, f in enumerate(files):
+            df, sha, changed = lookup_cached(f, cache_dir, manifest)
+            frames.append(df)
+            dirty = dirty or changed
+            if df is None:
+                misses.append((i, f, sha))
+
+        if misses:
+            print(f"  parsing {len(misses)} new/changed files")
+            parsed = parse_files([f for _, f, _ in misses], workers=workers)
+            for (i, f, sha), df in zip(misses, parsed):
+                store_cached(f, df, sha, cache_dir, manifest)
+                frames[i] = df
+            dirty = True
+
+        # forget files that have disappeared from this data dir
+        wanted = {os.path.abspath(f) for f in files}
+        root = os.path.abspath(data_dir) + os.sep
+        for key in [k for k in manifest if k.startswith(root) and k not in wanted]:
+            old = os.path.join(cache_dir, manifest.pop(key)["cache_file"])
+            if os.path.exists(old):
+                os.remove(old)
+            dirty = True
+
+        if dirty:
+            _write_manifest(cache_dir, manifest)
+
+    df = concat_compact(frames)
+
     # quick sanity check
     # print(df.isna().sum()) 
     # print(df['league'].value_counts())
 
     df = df.sort_values(["league", "Date"]).reset_index(drop=True)
     print("Loaded", len(df), "rows across", df['league'].nunique(), "leagues")
-    return df
\ No newline at end of file
+    return df
@@ -1,8 +1,85 @@
+import math
 import numpy as np
 import pandas as pd
-from sklearn.metrics import roc_auc_score, precision_recall_curve, average_precision_score
-from sklearn.calibration import calibration_curve
+from scipy.stats import norm
+from src.profiling import profiled
 
+# every metric here comes off one descending sort per model: cumulative
+# true/false positives at each distinct score give roc, pr, auc and ap, and
+# the same sorted arrays give the calibration bins, the bootstrap resamples
+# (as per-row weights) and the delong components
+
+def sorted_counts(y, p):
+    y = np.asarray(y, dtype=np.float64)
+    p = np.asarray(p, dtype=np.float64)
+    order = np.argsort(-p, kind="mergesort")
+    p_s, y_s = p[order], y[order]
+    # last position of each run of tied scores
+    last = np.r_[np.flatnonzero(np.diff(p_s)), len(p_s) - 1]
+    tps = np.cumsum(y_s)[last]
+    fps = last + 1 - tps
+    return {"order": order, "p": p_s, "y": y_s, "last": last, "tps": tps, "fps": fps}
+
+def _auc(tps, fps):
+    # trapezoids under (fpr, tpr) starting from the origin. works row-wise
+    # on (n_boot, n_thresholds) blocks too
+    tpr = tps / tps[..., -1:]
+    fpr = fps / fps[..., -1:]
+    zero = np.zeros(tpr.shape[:-1] + (1,))
+    tpr, fpr = np.concatenate([zero, tpr], -1), np.concatenate([zero, fpr], -1)
+    return (np.diff(fpr, axis=-1) * (tpr[..., 1:] + tpr[..., :-1]) / 2).sum(-1)
+
+def _ap(tps, fps):
+    # sum of (recall step x precision), same definition as sklearn's average_precision_score
+    recall = tps / tps[..., -1:]
+    with np.errstate(invalid="ignore"):
+        precision = np.nan_to_num(tps / (tps + fps))
+    zero = np.zeros(recall.shape[:-1] + (1,))
+    return (np.diff(np.concatenate([zero, recall], -1), axis=-1) * precision).sum(-1)
+
+def roc_points(c):
+    tpr = np.r_[0, c["tps"] / c["tps"][-1]]
+    fpr = np.r_[0, c["fps"] / c["fps"][-1]]
+    return fpr, tpr
+
+def pr_points(c):
+    # sklearn's precision_recall_curve layout: recall decreasing, ends on
+    # (recall 0, precision 1)
+    tps, fps = c["tps"], c["fps"]
+    precision = tps / (tps + fps)
+    recall = tps / tps[-1]
+    return np.r_[precision[::-1], 1], np.r_[recall[::-1], 0]
+
+def calibration_points(c, n_bins=10):
+    # quantile bins like sklearn's calibration_curve(strategy="quantile"),
+    # from cumulative sums over the ascending scores
+    p_asc, y_asc = c["p"][::-1], c["y"][::-1]
+    n = len(p_asc)
+    pos = np.linspace(0, 1, n_bins + 1) * (n - 1)
+    lo = np.floor(pos).astype(int)
+    hi = np.minimum(lo + 1, n - 1)
+    edges = p_asc[lo] + (pos - lo) * (p_asc[hi] - p_asc[lo])
+
+    cuts = np.r_[0, np.searchsorted(p_asc, edges[1:-1], side="right"), n]
+    cum_p, cum_y = np.r_[0, np.cumsum(p_asc)], np.r_[0, np.cumsum(y_asc)]
+    total = np.diff(cuts)
+    keep = total > 0
+    mean_pred = np.diff(cum_p[cuts])[keep] / total[keep]
+    frac_pos = np.diff(cum_y[cuts])[keep] / total[keep]
+    return mean_pred, frac_pos
+
+@profiled
+def model_curves(y, probas, n_bins=10):
+    # roc, pr and calibration points per model, in the shapes the plots take
+    roc, pr, cal = {}, {}, {}
+    for name, p in probas.items():
+        c = sorted_counts(y, p)
+        roc[name] = roc_points(c)
+        pr[name] = pr_points(c)
+        cal[name] = calibration_points(c, n_bins=n_bins)
+    return roc, pr, cal
+
+@profiled
 def evaluate_all(fitted_models, X_test, y_test):
     records = []
     probas = {}
@@ -11,35 +88,138 @@ def evaluate_all(fitted_models, X_test, y_test):
         p = model.predict_proba(X_test)[:, 1]
         probas[name] = p
 
-        auc   = roc_auc_score(y_test, p)
-        ap    = average_precision_score(y_test, p)
-
-        records.append({"model": name, "roc_auc": auc, "avg_precision": ap})
+        c = sorted_counts(y_test, p)
+        records.append({"model": name, "roc_auc": _auc(c["tps"], c["fps"]),
+                        "avg_precision": _ap(c["tps"], c["fps"])})
 
     results = pd.DataFrame(records).sort_values("roc_auc", ascending=False)
     return results, probas
 
-def roc_data(y_test, probas):
-    from sklearn.metrics import roc_curve
-    curves = {}
-    for name, p in probas.items():
-        fpr, tpr, _ = roc_curve(y_test, p)
-        curves[name] = (fpr, tpr)
-    return curves
+# ---------- uncertainty ----------
 
-def pr_data(y_test, probas):
-    curves = {}
-    for name, p in probas.items():
-        prec, rec, _ = precision_recall_curve(y_test, p)
-        curves[name] = (prec, rec)
-    return curves
+def bootstrap_metrics(c, n_boot=1000, seed=0, chunk=250, max_cells=2_000_000):
+    # stratified bootstrap: positives and negatives are resampled separately
+    # so every replicate keeps the test set's class balance. a replicate is a
+    # row of multinomial counts over the already-sorted rows, so there is no
+    # re-sorting, just weighted cumsums. returns {metric: (n_boot,) array}.
+    # replicates go through in (chunk, n_test) float64 blocks, with chunk cut
+    # down so a block stays under max_cells (16 MB) on big test sets
+    rng = np.random.default_rng(seed)
+    y_s, p_s, last = c["y"], c["p"], c["last"]
+    pos, neg = np.flatnonzero(y_s == 1), np.flatnonzero(y_s == 0)
+    sq_err = (p_s - y_s) ** 2
+    chunk = max(1, min(chunk, max_cells // max(len(y_s), 1)))
+
+    out = {"roc_auc": [], "avg_precision": [], "brier": []}
+    for start in range(0, n_boot, chunk):
+        b = min(chunk, n_boot - start)
+        w = np.zeros((b, len(y_s)))
+        w[:, pos] = rng.multinomial(len(pos), np.full(len(pos), 1 / len(pos)), size=b)
+        w[:, neg] = rng.multinomial(len(neg), np.full(len(neg), 1 / len(neg)), size=b)
+
+        out["brier"].append(w @ sq_err / len(y_s))
+
+        # one scratch block for both cumsums
+        cum = np.cumsum(w, axis=1)
+        total = cum[:, last]
+        np.multiply(w, y_s, out=cum)
+        tps = np.cumsum(cum, axis=1, out=cum)[:, last]
+        fps = total - tps
+        out["roc_auc"].append(_auc(tps, fps))
+        out["avg_precision"].append(_ap(tps, fps))
+    return {k: np.concatenate(v) for k, v in out.items()}
+
+def delong_components(c):
+    # per-row auc contributions (DeLong 1988), read off the tie-grouped
+    # counts: each positive's share of negatives scored below it (ties count
+    # half) and each negative's share of positives scored above it.
+    # returned in the original row order so models can be lined up
+    tps, fps = c["tps"], c["fps"]
+    n_pos, n_neg = tps[-1], fps[-1]
+    prev_tps, prev_fps = np.r_[0, tps[:-1]], np.r_[0, fps[:-1]]
+    group = np.repeat(np.arange(len(tps)), np.diff(np.r_[-1, c["last"]]))
+
+    v10 = (n_neg - fps + 0.5 * (fps - prev_fps)) / n_neg
+    v01 = (prev_tps + 0.5 * (tps - prev_tps)) / n_pos
+    comp = np.where(c["y"] == 1, v10[group], v01[group])
+
+    out = np.empty_like(comp)
+    out[c["order"]] = comp
+    return out
+
+def delong_test(y, comps_a, comps_b):
+    # auc difference, its standard error and two-sided p-value for two models
+    # scored on the same rows. the variances need two of each class, folds
+    # without them get NaNs
+    y = np.asarray(y)
+    pos, neg = y == 1, y == 0
+    if pos.sum() < 2 or neg.sum() < 2:
+        return np.nan, np.nan, np.nan
+    d10 = comps_a[pos] - comps_b[pos]
+    d01 = comps_a[neg] - comps_b[neg]
+    diff = d10.mean()
+    se = math.sqrt(d10.var(ddof=1) / pos.sum() + d01.var(ddof=1) / neg.sum())
+    if se == 0:
+        return diff, se, 1.0 if diff == 0 else 0.0
+    return diff, se, 2 * norm.sf(abs(diff) / se)
+
+def evaluate_probas(y, probas, n_boot=1000, alpha=0.05, seed=0):
+    # point estimates with bootstrap percentile cis for each model, plus a
+    # delong test for every pair of models. one row per (model, metric)
+    y = np.asarray(y)
+    n_test, n_pos = len(y), int(y.sum())
+    z = norm.ppf(1 - alpha / 2)
+    rows, comps = [], {}
 
-def model_calibration_data(y_test, probas, n_bins=10):
-    cal = {}
     for name, p in probas.items():
-        frac_pos, mean_pred = calibration_curve(y_test, p, n_bins=n_bins, strategy="quantile")
-        cal[name] = (mean_pred, frac_pos)
-    return cal
+        c = sorted_counts(y, p)
+        point = {
+            "roc_auc": _auc(c["tps"], c["fps"]),
+            "avg_precision": _ap(c["tps"], c["fps"]),
+            "brier": float(np.mean((c["p"] - c["y"]) ** 2)),
+        }
+        boot = bootstrap_metrics(c, n_boot=n_boot, seed=seed)
+        for metric, value in point.items():
+            lo, hi = np.percentile(boot[metric], [100 * alpha / 2, 100 * (1 - alpha / 2)])
+            rows.append({"model": name, "vs": None, "metric": metric, "value": value,
+                         "ci_low": lo, "ci_high": hi, "p_value": np.nan})
+        comps[name] = delong_components(c)
+
+    names = list(probas)
+    for i, a in enumerate(names):
+        for b in names[i + 1:]:
+            diff, se, p_value = delong_test(y, comps[a], comps[b])
+            rows.append({"model": a, "vs": b, "metric": "roc_auc_diff", "value": diff,
+                         "ci_low": diff - z * se, "ci_high": diff + z * se, "p_value": p_value})
+
+    out = pd.DataFrame(rows)
+    out["n_test"] = n_test
+    out["n_pos"] = n_pos
+    return out
+
+@profiled
+def metrics_frame(y_test, probas, wf_preds=None, n_boot=1000, alpha=0.05, seed=0):
+    # one tidy frame: the single split, every walk-forward fold and the folds
+    # pooled. wf_preds is walk_forward_validate's prediction frame
+    # (fold, test_period, y_true, <model>_prob)
+    parts = [evaluate_probas(y_test, probas, n_boot, alpha, seed).assign(
+        scope="split", fold=np.nan, test_period="holdout")]
+
+    if wf_preds is not None:
+        models = [c[:-len("_prob")] for c in wf_preds.columns if c.endswith("_prob")]
+
+        def wf_probas(frame):
+            return {m: frame[f"{m}_prob"].to_numpy() for m in models}
+
+        for (fold, period), grp in wf_preds.groupby(["fold", "test_period"], sort=True):
+            parts.append(evaluate_probas(grp["y_true"].to_numpy(), wf_probas(grp), n_boot, alpha, seed)
+                         .assign(scope="walk_forward", fold=fold, test_period=period))
+        parts.append(evaluate_probas(wf_preds["y_true"].to_numpy(), wf_probas(wf_preds), n_boot, alpha, seed)
+                     .assign(scope="walk_forward_pooled", fold=np.nan, test_period="all"))
+
+    out = pd.concat(parts, ignore_index=True)
+    lead = ["scope", "fold", "test_period", "model", "vs", "metric"]
+    return out[lead + [c for c in out.columns if c not in lead]]
 
 def feature_importance(fitted_models, feat_cols):
     rows = []
@@ -55,4 +235,4 @@ def feature_importance(fitted_models, feat_cols):
         for feat, imp in zip(feat_cols, xgb.feature_importances_):
             rows.append({"model": "xgb", "feature": feat, "importance": imp})
 
-    return pd.DataFrame(rows)
\ No newline at end of file
+    return pd.DataFrame(rows)
@@ -0,0 +1,139 @@
+import numpy as np
+import pandas as pd
+from src.load_data import LEAGUE_NAMES
+from src.schema import FLOAT, KNOWN_CATEGORIES
+from src.features import BOOKS, devig
+
+# the model's input transform, fitted once on the training frame and kept
+# with the model so scoring builds exactly the same columns.
+#   training: pipe = FeaturePipeline().fit(df); X = pipe.transform(df)
+#   scoring:  X = pipe.transform_odds(odds, leagues, dates)
+
+FEAT_COLS = [
+    "b365_ph", "b365_pd", "b365_pa",
+    "b365_close_open_delta_h", "b365_close_open_delta_a",
+    "b365_overround",
+    "ps_overround",
+    "fav_implied_bucket", "b365_spread", "season_phase_enc", "fav_implied", "league_enc",
+]
+
+# row-level columns from features.build_features the transform starts from
+INPUT_COLS = [
+    "b365_ph", "b365_pd", "b365_pa",
+    "b365_open_ph", "b365_open_pa",
+    "b365_overround", "ps_overround",
+]
+
+# raw price sets transform_odds de-vigs, in the order their columns appear above
+ODDS_BOOKS = ["b365", "b365_open", "ps"]
+
+# football-data's date formats, tried in this order after iso
+DATE_FORMATS = ["%d/%m/%y", "%d/%m/%Y"]
+
+def parse_dates(dates):
+    # snapshot date strings: iso first (json / http payloads, any utc offset
+    # is dropped after converting), then DATE_FORMATS. dayfirst guessing
+    # would read 2025-08-10 as 8 october
+    dates = pd.Series(dates)
+    if pd.api.types.is_datetime64_any_dtype(dates):
+        return dates
+    text = dates.astype("string").str.strip()
+    out = pd.to_datetime(text, format="ISO8601", errors="coerce", utc=True).dt.tz_convert(None)
+    for fmt in DATE_FORMATS:
+        out = out.fillna(pd.to_datetime(text, format=fmt, errors="coerce"))
+    return out
+
+def days_into_season(dates):
+    # days since 1 july of the year the season started in. dates: datetime64 array
+    dates = np.asarray(dates, dtype="datetime64[D]")
+    months = dates.astype("datetime64[M]").astype(int) % 12 + 1
+    years = dates.astype("datetime64[Y]").astype(int) + 1970 - (months < 7)
+    anchor = (years - 1970).astype("datetime64[Y]") + np.timedelta64(6, "M")
+    days = (dates - anchor.astype("datetime64[D]")).astype(FLOAT)
+    days[np.isnat(dates)] = np.nan
+    return days
+
+class FeaturePipeline:
+    def __init__(self, bucket_edges=(0, 0.4, 0.5, 0.6, 0.7, 1.0), devig_method="multiplicative"):
+        self.feat_cols = list(FEAT_COLS)
+        self.bucket_edges = np.asarray(bucket_edges, dtype=np.float64)
+        self.devig_method = devig_method
+        self.phase_map = {p: i for i, p in enumerate(KNOWN_CATEGORIES["season_phase"])}
+
+    def fit(self, df):
+        # league vocabulary (sorted, so codes don't depend on row order) and
+        # the typical season-phase cut-offs in days into the season, which is
+        # all a snapshot with no season around it has to go on
+        self.leagues_ = np.array(sorted(df["league"].astype(str).unique()), dtype=object)
+        dates = df.groupby("season", observed=True)["Date"]
+        self.phase_days_ = (
+            float(np.median(days_into_season(dates.quantile(0.26).to_numpy()))),
+            float(np.median(days_into_season(dates.quantile(0.74).to_numpy()))),
+        )
+        return self
+
+    def league_codes(self, leagues):
+        leagues = np.asarray(leagues, dtype=object).astype(str)
+        idx = np.searchsorted(self.leagues_, leagues).clip(0, len(self.leagues_) - 1)
+        return np.where(self.leagues_[idx] == leagues, idx, np.nan).astype(FLOAT)
+
+    def phase_codes(self, dates):
+        early, late = self.phase_days_
+        days = days_into_season(dates)
+        codes = np.select([days >= late, days <= early], [2, 0], default=1).astype(FLOAT)
+        codes[np.isnan(days)] = np.nan
+        return codes
+
+    def transform_block(self, block, phase, league):
+        # block: (n, len(INPUT_COLS)) float32, phase/league: float codes.
+        # returns (n, len(feat_cols)) float32, NaN wherever an input was missing
+        ph, pd_, pa, open_ph, open_pa, b365_over, ps_over = block.T
+        probs = block[:, :3]
+        fav = probs.max(axis=1)
+        bucket = np.searchsorted(self.bucket_edges, fav) - 1
+        bucket = np.where((bucket >= 0) & (bucket < len(self.bucket_edges) - 1), bucket, np.nan)
+        # variance in float64, sqrt in float32: same numbers pandas' .std gave
+        spread = np.sqrt(probs.astype(np.float64).var(axis=1, ddof=1).astype(FLOAT))
+
+        X = np.column_stack([
+            ph, pd_, pa,
+            ph - open_ph, pa - open_pa,
+            b365_over, ps_over,
+            bucket, spread, phase, fav, league,
+        ])
+        return X.astype(FLOAT)
+
+    def transform(self, df):
+        # feature frame (build_features output) -> X. doesn't touch df
+        block = df[INPUT_COLS].to_numpy(dtype=FLOAT)
+        phase = df["season_phase"].astype(object).map(self.phase_map).to_numpy(dtype=FLOAT)
+        return self.transform_block(block, phase, self.league_codes(df["league"].to_numpy()))
+
+    def transform_odds(self, odds, leagues, dates):
+        # raw decimal prices (n, 3 books, 3) in ODDS_BOOKS order -> X, without
+        # going through build_features
+        # prices are float32 in the training frame, round the same way
+        probs, overround = devig(np.asarray(odds, dtype=FLOAT), method=self.devig_method)
+        block = np.column_stack([
+            probs[:, 0], probs[:, 1, [0, 2]], overround[:, [0, 2]],
+        ]).astype(FLOAT)
+        return self.transform_block(block, self.phase_codes(dates), self.league_codes(leagues))
+
+    def snapshot_arrays(self, snap):
+        # football-data style snapshot frame -> transform_odds inputs.
+        # missing price columns come through as NaN (no score for those rows)
+        odds = np.full((len(snap), len(ODDS_BOOKS), 3), np.nan)
+        for j, book in enumerate(ODDS_BOOKS):
+            for k, col in enumerate(BOOKS[book]):
+                if col in snap.columns:
+                    odds[:, j, k] = pd.to_numeric(snap[col], errors="coerce").to_numpy(dtype=np.float64)
+
+        if "league" in snap.columns:
+            leagues = snap["league"].to_numpy()
+        elif "Div" in snap.columns:
+            leagues = snap["Div"].map(lambda d: LEAGUE_NAMES.get(d, d)).to_numpy()
+        else:
+            leagues = np.full(len(snap), "")
+
+        dates = snap["Date"] if "Date" in snap.columns else pd.Series(pd.NaT, index=snap.index)
+        return odds, leagues, parse_dates(dates).to_numpy()
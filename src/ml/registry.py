@@ -0,0 +1,124 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import joblib
+import pandas as pd
+from xgboost import XGBClassifier
+
+# fitted models on disk, one folder per key:
+#   data/models/<key>/model.joblib (sklearn) or model.ubj (xgboost native)
+#   data/models/<key>/meta.json
+# the key hashes the training rows, the feature list and the hyperparameters,
+# so a hit means the exact same fit has been done before
+
+REGISTRY_DIR = "data/models"
+
+# params that change speed but not the fitted model
+IGNORED_PARAMS = {"n_jobs", "verbose", "verbosity"}
+
+def data_hash(X, y):
+    h = hashlib.sha1()
+    h.update(json.dumps(list(X.columns)).encode())
+    h.update(pd.util.hash_pandas_object(X, index=True).to_numpy().tobytes())
+    h.update(pd.util.hash_pandas_object(y, index=True).to_numpy().tobytes())
+    return h.hexdigest()
+
+def model_key(name, params, X, y, parent=None, **extra):
+    # parent: key of the model this one was warm-started from
+    params = {k: v for k, v in params.items() if k not in IGNORED_PARAMS}
+    blob = json.dumps({
+        "name": name,
+        "params": params,
+        "features": list(X.columns),
+        "data": data_hash(X, y),
+        "parent": parent,
+        "extra": extra,
+    }, sort_keys=True, default=str)
+    return hashlib.sha1(blob.encode()).hexdigest()[:20]
+
+def _entry(registry_dir, key):
+    return os.path.join(registry_dir, key)
+
+def load_model(registry_dir, key):
+    path = _entry(registry_dir, key)
+    meta_path = os.path.join(path, "meta.json")
+    if not os.path.exists(meta_path):
+        return None
+
+    with open(meta_path) as fh:
+        meta = json.load(fh)
+    if meta["format"] == "xgb":
+        model = XGBClassifier()
+        model.load_model(os.path.join(path, "model.ubj"))
+    else:
+        model = joblib.load(os.path.join(path, "model.joblib"))
+
+    # mtime of meta.json doubles as last-used time for eviction
+    os.utime(meta_path)
+    model.registry_key_ = key
+    return model
+
+def save_model(registry_dir, key, name, model, **meta):
+    path = _entry(registry_dir, key)
+    tmp = path + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+
+    fmt = "xgb" if isinstance(model, XGBClassifier) else "joblib"
+    if fmt == "xgb":
+        model.save_model(os.path.join(tmp, "model.ubj"))
+    else:
+        joblib.dump(model, os.path.join(tmp, "model.joblib"))
+
+    meta = {"key": key, "name": name, "format": fmt, "created": time.time(), **meta}
+    with open(os.path.join(tmp, "meta.json"), "w") as fh:
+        json.dump(meta, fh, indent=1, default=str)
+
+    # parallel fold jobs can race on the same key; first one in wins
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+    model.registry_key_ = key
+
+def list_models(registry_dir=REGISTRY_DIR):
+    rows = []
+    if not os.path.isdir(registry_dir):
+        return pd.DataFrame(rows)
+    for key in os.listdir(registry_dir):
+        meta_path = os.path.join(registry_dir, key, "meta.json")
+        if not os.path.exists(meta_path):
+            continue
+        with open(meta_path) as fh:
+            meta = json.load(fh)
+        folder = os.path.join(registry_dir, key)
+        size = sum(os.path.getsize(os.path.join(folder, f)) for f in os.listdir(folder))
+        rows.append({
+            "key": key,
+            "name": meta["name"],
+            "created": meta["created"],
+            "last_used": os.path.getmtime(meta_path),
+            "n_rows": meta.get("n_rows"),
+            "bytes": size,
+        })
+    return pd.DataFrame(rows)
+
+def evict(registry_dir=REGISTRY_DIR, max_age_days=30, max_bytes=2 * 1024 ** 3):
+    # drop entries unused for max_age_days, then least recently used ones
+    # until the registry fits in max_bytes
+    entries = list_models(registry_dir)
+    if entries.empty:
+        return 0
+
+    cutoff = time.time() - max_age_days * 86400
+    entries = entries.sort_values("last_used", ascending=False)
+    too_big = entries["bytes"].cumsum() > max_bytes
+    drop = entries[(entries["last_used"] < cutoff) | too_big]
+
+    for key in drop["key"]:
+        shutil.rmtree(_entry(registry_dir, key), ignore_errors=True)
+    if len(drop):
+        print(f"registry: evicted {len(drop)} models")
+    return len(drop)
@@ -0,0 +1,60 @@
+import os
+import joblib
+import numpy as np
+import pandas as pd
+from src.ml.registry import REGISTRY_DIR, load_model
+
+# scoring live odds snapshots with a model from the registry. the scorer file
+# holds the registry keys of the fitted models plus the FeaturePipeline they
+# were trained through (league vocabulary, bucket edges, season-phase
+# cut-offs), so scoring never has to look at the historical frame
+
+SCORER_PATH = os.path.join(REGISTRY_DIR, "scorer.joblib")
+
+# columns echoed back next to the probability
+ID_COLS = ["Date", "league", "HomeTeam", "AwayTeam"]
+
+def save_scorer(models, pipeline, path=SCORER_PATH):
+    # models: fitted dict from train_models (trained with registry_dir set).
+    # pipeline: the fitted FeaturePipeline from build_ml_features
+    keys = {}
+    for name, model in models.items():
+        key = getattr(model, "registry_key_", None)
+        if key is None:
+            raise ValueError(f"{name} isn't in the registry, train with registry_dir set")
+        keys[name] = key
+
+    scorer = {"models": keys, "pipeline": pipeline}
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    joblib.dump(scorer, path)
+    return scorer
+
+def load_scorer(path=SCORER_PATH, model="logreg", registry_dir=REGISTRY_DIR):
+    scorer = joblib.load(path)
+    fitted = load_model(registry_dir, scorer["models"][model])
+    if fitted is None:
+        raise FileNotFoundError(f"{model} ({scorer['models'][model]}) has been evicted from {registry_dir}")
+    scorer["name"] = model
+    scorer["model"] = fitted
+    return scorer
+
+def score_batch(snap, scorer):
+    # returns the id columns plus high_gap_prob (NaN where an input is missing
+    # or the league wasn't in the training data)
+    pipe = scorer["pipeline"]
+    odds, leagues, dates = pipe.snapshot_arrays(snap)
+    X = pipe.transform_odds(odds, leagues, dates)
+    ok = ~np.isnan(X).any(axis=1)
+
+    probs = np.full(len(X), np.nan)
+    if ok.any():
+        # models were fit on named columns, keep sklearn from warning about it
+        probs[ok] = scorer["model"].predict_proba(pd.DataFrame(X[ok], columns=pipe.feat_cols))[:, 1]
+
+    out = pd.DataFrame({"Date": dates, "league": leagues}, index=snap.index)
+    for c in ID_COLS[2:]:
+        if c in snap.columns:
+            out[c] = snap[c]
+    out["model"] = scorer["name"]
+    out["high_gap_prob"] = probs
+    return out
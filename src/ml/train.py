@@ -1,39 +1,26 @@
+import copy
 import pandas as pd
 import numpy as np
 from sklearn.linear_model import LogisticRegression
 from sklearn.ensemble import RandomForestClassifier
-from sklearn.preprocessing import LabelEncoder
+from sklearn.utils.class_weight import compute_class_weight
 from xgboost import XGBClassifier
-
-TRAIN_CUTOFF = "2022-23"
-
-def build_ml_features(df):
-    feat_cols = [
-        "b365_ph", "b365_pd", "b365_pa",
-        "b365_close_open_delta_h", "b365_close_open_delta_a",
-        "b365_overround",
-        "ps_overround",
-    ]
-
-    df["fav_implied"] = df[["b365_ph", "b365_pd", "b365_pa"]].max(axis=1)
-    df["fav_implied_bucket"] = pd.cut(
-        df["fav_implied"],
-        bins=[0, 0.4, 0.5, 0.6, 0.7, 1.0],
-        labels=[0, 1, 2, 3, 4]
-    ).astype(float)
-
-    df["b365_spread"] = df[["b365_ph", "b365_pd", "b365_pa"]].std(axis=1)
-
-    phase_map = {"early": 0, "mid": 1, "late": 2}
-    df["season_phase_enc"] = df["season_phase"].map(phase_map)
-
-    # league matters — B365 shading patterns differ by market
-    le = LabelEncoder()
-    df["league_enc"] = le.fit_transform(df["league"].astype(str))
-
-    feat_cols += ["fav_implied_bucket", "b365_spread", "season_phase_enc", "fav_implied", "league_enc"]
-
-    ml_df = df[feat_cols + ["high_gap", "season"]].dropna()
+from src.ml.pipeline import FeaturePipeline
+from src.ml.registry import model_key, load_model, save_model
+from src.profiling import profiled
+
+@profiled
+def build_ml_features(df, pipeline=None):
+    # pipeline: a fitted FeaturePipeline to reuse, fit on df when not given.
+    # returns (ml_df, pipeline); pipeline.feat_cols are the model columns
+    if pipeline is None:
+        pipeline = FeaturePipeline().fit(df)
+    feat_cols = pipeline.feat_cols
+
+    ml_df = pd.DataFrame(pipeline.transform(df), columns=feat_cols, index=df.index)
+    ml_df["high_gap"] = df["high_gap"]
+    ml_df["season"] = df["season"]
+    ml_df = ml_df.dropna()
     ml_df["high_gap"] = ml_df["high_gap"].astype(int)
 
     pos_rate = ml_df["high_gap"].mean()
@@ -44,11 +31,15 @@ def build_ml_features(df):
     print(f"High gap rate: {pos_pct}%")
     print(f"Total positive: {pos_count} out of {total_rows}")
 
-    return ml_df, feat_cols
+    return ml_df, pipeline
 
-def split(ml_df):
-    train = ml_df[ml_df["season"] <= TRAIN_CUTOFF].drop(columns="season")
-    test  = ml_df[ml_df["season"] >  TRAIN_CUTOFF].drop(columns="season")
+def split(ml_df, test_seasons=2):
+    # hold out the last test_seasons seasons in the data, train on the rest.
+    # season labels are "YYYY-YY" so they sort chronologically
+    season = ml_df["season"].astype(str)
+    held_out = sorted(season.unique())[-test_seasons:]
+    train = ml_df[~season.isin(held_out)].drop(columns="season")
+    test  = ml_df[season.isin(held_out)].drop(columns="season")
 
     X_train, y_train = train.drop(columns="high_gap"), train["high_gap"]
     X_test,  y_test  = test.drop(columns="high_gap"),  test["high_gap"]
@@ -58,22 +49,100 @@ def split(ml_df):
     
     return X_train, X_test, y_train, y_test
 
-def train_models(X_train, y_train):
-    neg, pos = (y_train == 0).sum(), (y_train == 1).sum()
-
-    lr_model = LogisticRegression(max_iter=1000, class_weight="balanced")
-    lr_model.fit(X_train, y_train)
-    print("logreg done")
-
-    rf_model = RandomForestClassifier(n_estimators=200, max_depth=6, class_weight="balanced", random_state=42)
-    rf_model.fit(X_train, y_train)
-    print("rf done")
-
-    xgb_model = XGBClassifier(n_estimators=200, max_depth=4, learning_rate=0.05,
-                              scale_pos_weight=neg/pos, eval_metric="logloss", random_state=42)
-    xgb_model.fit(X_train, y_train)
-    print("xgb done")
-    
-    fitted = {"logreg": lr_model, "rf": rf_model, "xgb": xgb_model}
-
-    return fitted
\ No newline at end of file
+MODEL_NAMES = ["logreg", "rf", "xgb"]
+
+def make_model(name, y_train, n_jobs=1, params=None):
+    # n_jobs caps the threads rf/xgb use, so parallel callers can share out cores.
+    # params overrides the defaults below (e.g. tuned ones from tune.py)
+    if name == "logreg":
+        model = LogisticRegression(max_iter=1000, class_weight="balanced")
+    elif name == "rf":
+        model = RandomForestClassifier(n_estimators=200, max_depth=6, class_weight="balanced",
+                                       random_state=42, n_jobs=n_jobs)
+    elif name == "xgb":
+        neg, pos = (y_train == 0).sum(), (y_train == 1).sum()
+        # no positives (a short fold) -> unweighted rather than a division by zero
+        model = XGBClassifier(n_estimators=200, max_depth=4, learning_rate=0.05, tree_method="hist",
+                              scale_pos_weight=neg / pos if pos else 1.0, eval_metric="logloss",
+                              random_state=42, n_jobs=n_jobs)
+    else:
+        raise ValueError(f"unknown model {name}")
+    if params:
+        model.set_params(**params)
+    return model
+
+@profiled
+def fit_model(name, X_train, y_train, n_jobs=1, registry_dir=None, params=None):
+    # registry_dir: reuse an identical earlier fit from the model registry
+    model = make_model(name, y_train, n_jobs=n_jobs, params=params)
+    if registry_dir is not None:
+        key = model_key(name, model.get_params(), X_train, y_train)
+        cached = load_model(registry_dir, key)
+        if cached is not None:
+            print(f"{name} cached")
+            return cached
+
+    model.fit(X_train, y_train)
+    print(f"{name} done")
+    if registry_dir is not None:
+        save_model(registry_dir, key, name, model, n_rows=len(X_train))
+    return model
+
+@profiled
+def update_model(name, prev, X_new, y_new, X_all, y_all, n_jobs=1, extra_trees=50, registry_dir=None):
+    # carry a fitted model forward to the next expanding-window fold instead of
+    # refitting from scratch. X_new/y_new are only the rows added since prev was
+    # fit, X_all/y_all the whole window
+    # only cacheable when prev came from the registry too: its key plus the
+    # current window pin down exactly which rows are new
+    parent = getattr(prev, "registry_key_", None)
+    if registry_dir is not None and parent is None:
+        registry_dir = None
+    base = make_model(name, y_all)
+    if name == "rf":
+        # "balanced" with warm_start warns on every fold (the extra trees only
+        # see the new rows), so balance explicitly over the whole window
+        classes = np.unique(y_all)
+        weights = compute_class_weight("balanced", classes=classes, y=y_all)
+        base.set_params(class_weight=dict(zip(classes.tolist(), weights.tolist())))
+    if registry_dir is not None:
+        # balance="window": class weights come from y_all (earlier xgb
+        # updates took them from the new rows only, under the same params)
+        key = model_key(name, base.get_params(), X_all, y_all,
+                        parent=parent, extra_trees=extra_trees, balance="window")
+        cached = load_model(registry_dir, key)
+        if cached is not None:
+            print(f"{name} cached")
+            return cached
+
+    if name == "logreg":
+        # lbfgs starting from the previous coefficients, converges in a few steps
+        model = copy.deepcopy(prev).set_params(warm_start=True)
+        model.fit(X_all, y_all)
+    elif name == "rf":
+        # grow extra trees on the new seasons, keep the old ones
+        model = copy.deepcopy(prev).set_params(warm_start=True, n_jobs=n_jobs,
+                                               n_estimators=prev.n_estimators + extra_trees,
+                                               class_weight=base.class_weight)
+        model.fit(X_new, y_new)
+    elif name == "xgb":
+        # keep boosting from the previous booster on the new seasons
+        # class balance from the whole window like a refit, not just the new rows
+        model = copy.deepcopy(base).set_params(n_estimators=extra_trees, n_jobs=n_jobs)
+        model.fit(X_new, y_new, xgb_model=prev.get_booster())
+    else:
+        raise ValueError(f"unknown model {name}")
+    print(f"{name} updated")
+    if registry_dir is not None:
+        save_model(registry_dir, key, name, model, n_rows=len(X_all))
+    return model
+
+@profiled
+def train_models(X_train, y_train, n_jobs=None, registry_dir=None, params=None):
+    # n_jobs=None lets rf/xgb use their own defaults.
+    # params: {model name: overrides}, e.g. tune.best_params(results)
+    params = params or {}
+    fitted = {name: fit_model(name, X_train, y_train, n_jobs=n_jobs, registry_dir=registry_dir,
+                              params=params.get(name))
+              for name in MODEL_NAMES}
+    return fitted
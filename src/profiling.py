@@ -0,0 +1,199 @@
+import os
+import sys
+import json
+import time
+import functools
+import threading
+import tracemalloc
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+# opt-in profiling. functions decorated with @profiled (and `with span(...)`
+# blocks) record wall time, cpu time, rss growth, python allocations
+# (tracemalloc) and rows in / out once enable() has been called. when it
+# hasn't, the wrapper is a single flag check.
+#   enable(); ...; write_report("output/profile")
+
+_state = {"on": False, "t0": 0.0}
+_spans = []
+_local = threading.local()
+_lock = threading.Lock()
+
+def enabled():
+    return _state["on"]
+
+def enable(trace_malloc=True):
+    _spans.clear()
+    _state.update(on=True, t0=time.perf_counter(), started=time.time(), malloc=trace_malloc, pid=os.getpid())
+    if trace_malloc and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+def disable():
+    _state["on"] = False
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+def _max_rss_mb():
+    if resource is None:
+        return None
+    kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on mac, kilobytes on linux
+    return kb / 1024 ** 2 if sys.platform == "darwin" else kb / 1024
+
+def _rss_mb():
+    try:
+        with open("/proc/self/statm") as fh:
+            return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+    except (OSError, ValueError):
+        return None
+
+def _rows(obj):
+    # rows of the first frame in obj (a frame, or a tuple / dict holding one)
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        return len(obj)
+    if isinstance(obj, dict):
+        obj = obj.values()
+    elif not isinstance(obj, (tuple, list)):
+        return None
+    frame = next((o for o in obj if isinstance(o, (pd.DataFrame, pd.Series))), None)
+    return len(frame) if frame is not None else None
+
+class span:
+    # with span("features.add_value_gap", rows_in=len(df)) as s: ...; s.rows_out = ...
+    def __init__(self, name, rows_in=None):
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = None
+
+    def __enter__(self):
+        # forked pool workers inherit the flag, but their spans would be lost
+        if not _state["on"] or os.getpid() != _state["pid"]:
+            return self
+        stack = _local.__dict__.setdefault("stack", [])
+        self.parent = stack[-1] if stack else None
+        self.path = (self.parent.path + ";" if self.parent else "") + self.name
+        self.malloc = _state.get("malloc") and tracemalloc.is_tracing()
+        if self.malloc:
+            cur, peak = tracemalloc.get_traced_memory()
+            # parent keeps the highest peak seen so far, the counter restarts for us
+            if self.parent is not None and self.parent.malloc:
+                self.parent.peak_seen = max(self.parent.peak_seen, peak)
+            tracemalloc.reset_peak()
+            self.malloc_start = self.peak_seen = cur
+        self.max_rss_start = _max_rss_mb()
+        stack.append(self)
+        self.cpu_start = time.thread_time()
+        self.t_start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if not hasattr(self, "t_start"):
+            return False
+        wall = time.perf_counter() - self.t_start
+        cpu = time.thread_time() - self.cpu_start
+        _local.stack.pop()
+
+        rec = {
+            "name": self.name,
+            "path": self.path,
+            "thread": threading.current_thread().name,
+            "start_s": self.t_start - _state["t0"],
+            "wall_s": wall,
+            "cpu_s": cpu,
+            "rss_mb": _rss_mb(),
+            "max_rss_mb": _max_rss_mb(),
+            "rows_in": self.rows_in,
+            "rows_out": self.rows_out,
+        }
+        if self.max_rss_start is not None:
+            rec["max_rss_growth_mb"] = rec["max_rss_mb"] - self.max_rss_start
+        if self.malloc:
+            cur, peak = tracemalloc.get_traced_memory()
+            self.peak_seen = max(self.peak_seen, peak)
+            rec["py_alloc_delta_mb"] = (cur - self.malloc_start) / 1024 ** 2
+            rec["py_peak_mb"] = (self.peak_seen - self.malloc_start) / 1024 ** 2
+            if self.parent is not None and self.parent.malloc:
+                self.parent.peak_seen = max(self.parent.peak_seen, self.peak_seen)
+        with _lock:
+            _spans.append(rec)
+        return False
+
+def profiled(fn=None, name=None):
+    # @profiled or @profiled(name="..."). rows in = first frame argument,
+    # rows out = first frame in the return value
+    if fn is None:
+        return functools.partial(profiled, name=name)
+    label = name or f"{fn.__module__.split('.')[-1]}.{fn.__name__}"
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not _state["on"]:
+            return fn(*args, **kwargs)
+        with span(label, rows_in=_rows(args) if args else _rows(kwargs)) as s:
+            out = fn(*args, **kwargs)
+            s.rows_out = _rows(out)
+        return out
+    return wrapper
+
+def spans_frame():
+    return pd.DataFrame(_spans)
+
+def summary():
+    # one row per span name: calls and totals, slowest first
+    frame = spans_frame()
+    if frame.empty:
+        return frame
+    agg = {"calls": ("wall_s", "size"), "wall_s": ("wall_s", "sum"), "cpu_s": ("cpu_s", "sum"),
+           "rows_in": ("rows_in", "max"), "rows_out": ("rows_out", "max")}
+    if "py_peak_mb" in frame:
+        agg["py_peak_mb"] = ("py_peak_mb", "max")
+    if "max_rss_growth_mb" in frame:
+        agg["max_rss_growth_mb"] = ("max_rss_growth_mb", "sum")
+    out = frame.groupby("name").agg(**agg).sort_values("wall_s", ascending=False)
+    return out.reset_index()
+
+def write_report(out_dir="output/profile", trace=False, meta=None):
+    # run_report.json: every span plus the per-name summary.
+    # trace=True also writes trace.json (chrome trace events, opens in
+    # perfetto / speedscope / chrome://tracing) and stacks.folded (one
+    # "a;b;c self_microseconds" line per stack, for flamegraph.pl)
+    os.makedirs(out_dir, exist_ok=True)
+    frame = spans_frame()
+    report = {
+        "started": _state.get("started"),
+        "argv": sys.argv,
+        "wall_s": time.perf_counter() - _state["t0"],
+        "max_rss_mb": _max_rss_mb(),
+        **(meta or {}),
+        "summary": summary().to_dict(orient="records"),
+        "spans": frame.to_dict(orient="records"),
+    }
+    paths = [os.path.join(out_dir, "run_report.json")]
+    with open(paths[0], "w") as fh:
+        json.dump(report, fh, indent=1, default=str)
+
+    if trace and not frame.empty:
+        tids = {t: i for i, t in enumerate(frame["thread"].unique())}
+        events = [{
+            "name": r["name"], "cat": "span", "ph": "X", "pid": os.getpid(), "tid": tids[r["thread"]],
+            "ts": round(r["start_s"] * 1e6), "dur": round(r["wall_s"] * 1e6),
+            "args": {k: r[k] for k in ["cpu_s", "rows_in", "rows_out", "py_peak_mb"] if k in r and pd.notna(r[k])},
+        } for r in frame.to_dict(orient="records")]
+        paths.append(os.path.join(out_dir, "trace.json"))
+        with open(paths[-1], "w") as fh:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, fh)
+
+        # self time = own wall minus direct children's
+        total = frame.groupby("path")["wall_s"].sum()
+        parent = total.index.str.rsplit(";", n=1).str[0]
+        child_time = total[parent != total.index].groupby(parent[parent != total.index]).sum()
+        self_time = (total - child_time.reindex(total.index).fillna(0)).clip(lower=0)
+        paths.append(os.path.join(out_dir, "stacks.folded"))
+        with open(paths[-1], "w") as fh:
+            for path, secs in self_time.items():
+                fh.write(f"{path} {int(secs * 1e6)}\n")
+    return paths
@@ -0,0 +1,239 @@
+import os
+import sys
+import time
+import types
+import hashlib
+import inspect
+import joblib
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from src.profiling import span
+
+# tiny stage runner for main.py. a stage is a plain function plus a spec:
+#   {"fn": features, "inputs": ["raw"], "outputs": ["df"], "files": [...]}
+# the function is called with its inputs as keyword args and returns a dict
+# with its outputs. each run is cached under
+#   data/cache/stages/<stage>-<key>.joblib
+# where key hashes the stage's code (its module and the repo modules it
+# reaches) and the content of its inputs, so a stage only re-runs when one
+# of those changed. "files" are paths the stage writes; a hit also needs
+# them to still exist. stages with "cache": False always run (load, which
+# has its own per-file cache).
+
+STAGE_CACHE = os.path.join("data", "cache", "stages")
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# entries kept per stage, oldest dropped first
+KEEP_ENTRIES = 3
+
+def _repo_module(obj):
+    mod = obj if isinstance(obj, types.ModuleType) else sys.modules.get(getattr(obj, "__module__", None) or "")
+    path = getattr(mod, "__file__", None)
+    if path and os.path.abspath(path).startswith(REPO_ROOT + os.sep):
+        return mod
+    return None
+
+def code_hash(fn):
+    # the stage function's source, the source of helpers it calls from its
+    # own module (not the whole file, so editing one stage in main.py leaves
+    # the others cached) and every repo module it can reach from there,
+    # following module-level references (functions, classes, modules)
+    h = hashlib.sha1()
+    funcs, mods = [fn], []
+    seen_funcs, seen_mods = set(), {fn.__module__}
+    while funcs:
+        f = funcs.pop()
+        if f.__qualname__ in seen_funcs:
+            continue
+        seen_funcs.add(f.__qualname__)
+        h.update(inspect.getsource(f).encode())
+        for name in f.__code__.co_names:
+            obj = f.__globals__.get(name)
+            if isinstance(obj, types.FunctionType) and obj.__module__ == fn.__module__:
+                funcs.append(obj)
+            elif obj is not None and _repo_module(obj) is not None:
+                mods.append(_repo_module(obj))
+
+    while mods:
+        mod = mods.pop()
+        if mod.__name__ in seen_mods:
+            continue
+        seen_mods.add(mod.__name__)
+        with open(mod.__file__, "rb") as fh:
+            h.update(fh.read())
+        for value in vars(mod).values():
+            dep = _repo_module(value)
+            if dep is not None and dep.__name__ not in seen_mods:
+                mods.append(dep)
+    return h.hexdigest()
+
+def content_hash(value):
+    # joblib.hash of a frame depends on how its columns sit in blocks (a
+    # freshly parsed frame and the same one read back from parquet differ),
+    # so frames and series hash their values, index, columns and dtypes.
+    # dicts / lists / tuples of them go through element by element
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        try:
+            rows = pd.util.hash_pandas_object(value, index=True).to_numpy()
+        except TypeError:
+            # unhashable cells (lists, dicts)
+            return joblib.hash(value)
+        frame = value.to_frame() if isinstance(value, pd.Series) else value
+        dtypes = [(c, str(t), list(t.categories) if isinstance(t, pd.CategoricalDtype) else None)
+                  for c, t in frame.dtypes.items()]
+        return joblib.hash([type(value).__name__, rows, dtypes])
+    if isinstance(value, dict):
+        return joblib.hash({k: content_hash(v) for k, v in value.items()})
+    if isinstance(value, (list, tuple)):
+        return joblib.hash([type(value).__name__] + [content_hash(v) for v in value])
+    return joblib.hash(value)
+
+def producers(stages):
+    # output name -> stage that makes it
+    out = {}
+    for name, spec in stages.items():
+        for o in spec["outputs"]:
+            if o in out:
+                raise ValueError(f"{o} is produced by both {out[o]} and {name}")
+            out[o] = name
+    return out
+
+def upstream(stages, targets):
+    # targets plus everything they need, in a valid run order
+    made_by = producers(stages)
+    order, seen = [], set()
+
+    def visit(name, path=()):
+        if name in path:
+            raise ValueError(f"cycle: {' -> '.join(path + (name,))}")
+        if name in seen:
+            return
+        for i in stages[name]["inputs"]:
+            if i not in made_by:
+                raise ValueError(f"{name} needs {i}, which no stage produces")
+            visit(made_by[i], path + (name,))
+        seen.add(name)
+        order.append(name)
+
+    for t in targets:
+        if t not in stages:
+            raise ValueError(f"unknown stage {t}, have {', '.join(stages)}")
+        visit(t)
+    return order
+
+def _entry_path(cache_dir, name, key):
+    return os.path.join(cache_dir, f"{name}-{key}.joblib")
+
+def _prune(cache_dir, name, keep=KEEP_ENTRIES):
+    entries = [os.path.join(cache_dir, f) for f in os.listdir(cache_dir) if f.startswith(f"{name}-")]
+    entries.sort(key=os.path.getmtime, reverse=True)
+    for path in entries[keep:]:
+        os.remove(path)
+
+def run(stages, targets=None, cache_dir=STAGE_CACHE, force=(), workers=4, use_cache=True):
+    # runs targets (default: every stage) and whatever they depend on.
+    # force: stage names to re-run even on a cache hit.
+    # independent stages run on a thread pool of `workers`; a stage with
+    # "exclusive": True (it brings its own process pool) runs on its own.
+    # returns {output name: value} for everything that was run or loaded,
+    # and a per-stage summary frame
+    targets = list(stages) if targets is None else list(targets)
+    order = upstream(stages, targets)
+    made_by = producers(stages)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    values, hashes, entries = {}, {}, {}
+    status, code, missed = {}, {}, set()
+
+    def need(names):
+        # inputs for a stage that has to run; loads hit outputs on demand
+        for n in names:
+            if n not in values:
+                values.update(joblib.load(entries[made_by[n]])["outputs"])
+        return {n: values[n] for n in names}
+
+    def key_for(name):
+        spec = stages[name]
+        if name not in code:
+            code[name] = code_hash(spec["fn"])
+        blob = [name, code[name]] + [f"{i}={hashes[i]}" for i in spec["inputs"]]
+        return hashlib.sha1("|".join(blob).encode()).hexdigest()[:16]
+
+    def try_hit(name):
+        spec = stages[name]
+        if name in missed or not use_cache or not spec.get("cache", True) or name in force:
+            return False
+        path = _entry_path(cache_dir, name, key_for(name))
+        if not os.path.exists(path) or not all(os.path.exists(f) for f in spec.get("files", [])):
+            missed.add(name)
+            return False
+        # only the hashes now, the values get loaded if something downstream runs
+        hashes.update(joblib.load(path)["hashes"])
+        entries[name] = path
+        os.utime(path)
+        return True
+
+    def execute(name, inputs):
+        spec = stages[name]
+        t = time.perf_counter()
+        print(f"\n=== {name} ===")
+        with span(f"stage:{name}"):
+            out = spec["fn"](**inputs)
+        missing = set(spec["outputs"]) - set(out)
+        if missing:
+            raise ValueError(f"stage {name} didn't return {', '.join(sorted(missing))}")
+        return out, time.perf_counter() - t
+
+    def finish(name, out, secs):
+        spec = stages[name]
+        out_hashes = {o: content_hash(out[o]) for o in spec["outputs"]}
+        values.update({o: out[o] for o in spec["outputs"]})
+        hashes.update(out_hashes)
+        if spec.get("cache", True) and use_cache:
+            path = _entry_path(cache_dir, name, key_for(name))
+            tmp = path + ".tmp"
+            joblib.dump({"outputs": {o: out[o] for o in spec["outputs"]}, "hashes": out_hashes}, tmp)
+            os.replace(tmp, path)
+            entries[name] = path
+            _prune(cache_dir, name)
+        status[name] = ("ran", secs)
+
+    def ready(name):
+        return all(made_by[i] in status for i in stages[name]["inputs"])
+
+    pending = list(order)
+    running = {}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        while pending or running:
+            # cache hits first, each one can make more stages ready
+            hit = True
+            while hit:
+                hit = False
+                for name in [n for n in pending if ready(n)]:
+                    if try_hit(name):
+                        status[name] = ("cached", 0.0)
+                        pending.remove(name)
+                        hit = True
+
+            exclusive = any(stages[n].get("exclusive") for n in running.values())
+            for name in [n for n in pending if ready(n)]:
+                if exclusive:
+                    break
+                if stages[name].get("exclusive") and running:
+                    continue
+                # inputs are loaded here on the scheduling thread, stages only compute
+                running[pool.submit(execute, name, need(stages[name]["inputs"]))] = name
+                pending.remove(name)
+                exclusive = stages[name].get("exclusive", False)
+
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                name = running.pop(fut)
+                out, secs = fut.result()
+                finish(name, out, secs)
+
+    summary = pd.DataFrame([{"stage": n, "status": status[n][0], "secs": round(status[n][1], 2)}
+                            for n in order])
+    return values, summary
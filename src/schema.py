@@ -0,0 +1,81 @@
+import numpy as np
+import pandas as pd
+from src.profiling import profiled
+
+# one place that decides how the match frame is stored. odds and everything
+# derived from them are float32 (plenty for 2dp odds / probabilities), the
+# dimensions are categoricals with a fixed category order so codes don't
+# shuffle between runs
+
+FLOAT = "float32"
+
+NON_NUMERIC = ["Div", "Date", "HomeTeam", "AwayTeam", "FTR", "season", "league"]
+
+# fixed vocabularies. anything not listed gets appended in sorted order
+KNOWN_CATEGORIES = {
+    "FTR": ["H", "D", "A"],
+    "season_phase": ["early", "mid", "late"],
+    "movement_cat": ["drifted_fav", "flip", "stable_dog", "stable_fav", "steamed_fav"],
+}
+
+# string columns that get stored as categoricals
+CATEGORICAL = ["Div", "HomeTeam", "AwayTeam", "FTR", "season", "league", "season_phase", "movement_cat"]
+
+def stable_categories(col, values):
+    known = KNOWN_CATEGORIES.get(col, [])
+    extra = sorted({str(v) for v in values if pd.notna(v)} - set(known))
+    return known + extra
+
+def as_category(s, col=None):
+    col = col or s.name
+    values = s.cat.categories if isinstance(s.dtype, pd.CategoricalDtype) else s.unique()
+    cats = stable_categories(col, values)
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        return s.cat.set_categories(cats)
+    return s.astype(pd.CategoricalDtype(cats))
+
+def to_float(df, cols):
+    cols = [c for c in cols if df[c].dtype != FLOAT]
+    if cols:
+        df[cols] = df[cols].astype(FLOAT)
+    return df
+
+@profiled
+def compact(df):
+    # float64/int64 numerics -> float32, string dims -> categorical.
+    # bools and datetimes are left alone
+    floats = [c for c in df.columns
+              if c not in NON_NUMERIC and (df[c].dtype == np.float64 or df[c].dtype == np.int64)]
+    to_float(df, floats)
+    for c in CATEGORICAL:
+        if c in df.columns:
+            df[c] = as_category(df[c], c)
+    return df
+
+def concat_compact(frames):
+    # align categories up front so concat keeps them categorical instead of
+    # falling back to object columns
+    for c in CATEGORICAL:
+        present = [f for f in frames if c in f.columns]
+        if not present:
+            continue
+        values = set()
+        for f in present:
+            s = f[c]
+            values |= set(s.cat.categories if isinstance(s.dtype, pd.CategoricalDtype) else s.dropna().unique())
+        dtype = pd.CategoricalDtype(stable_categories(c, values))
+        for f in present:
+            f[c] = f[c].astype(dtype)
+    df = pd.concat(frames, ignore_index=True)
+    # columns missing from some files come back as float64/object after the concat
+    return compact(df)
+
+def memory_report(df):
+    usage = df.memory_usage(deep=True, index=False)
+    out = pd.DataFrame({
+        "column": usage.index,
+        "dtype": [str(df[c].dtype) for c in usage.index],
+        "bytes": usage.values,
+    })
+    out["share"] = out["bytes"] / out["bytes"].sum()
+    return out.sort_values("bytes", ascending=False).reset_index(drop=True)
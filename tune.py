@@ -0,0 +1,269 @@
+import os
+import math
+import time
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+from sklearn.metrics import roc_auc_score, average_precision_score
+from src.ml.train import build_ml_features, make_model
+from walk_forward import plan_folds, period_labels, make_folds
+
+# hyperparameter search for rf / xgb over the walk-forward folds.
+# successive halving with the number of trees as the budget: every config is
+# scored on all folds at a small budget, the best 1/eta go up a rung with eta
+# times the trees, and so on. hyperband runs several of those brackets with
+# different trade-offs between many cheap configs and few expensive ones.
+#   python tune.py [--model xgb] [--workers 4] [--configs 27]
+
+# values sampled per config. n_estimators is the budget, so it's not in here
+SEARCH_SPACE = {
+    "rf": {
+        "max_depth": [4, 6, 8, 10, 14, None],
+        "min_samples_leaf": [1, 5, 20, 50],
+        "max_features": ["sqrt", 0.5, 0.8, 1.0],
+    },
+    "xgb": {
+        "max_depth": [2, 3, 4, 6, 8],
+        "learning_rate": [0.02, 0.05, 0.1, 0.2],
+        "min_child_weight": [1, 5, 20],
+        "subsample": [0.6, 0.8, 1.0],
+        "colsample_bytree": [0.6, 0.8, 1.0],
+        "reg_lambda": [0.1, 1.0, 10.0],
+        "tree_method": ["hist"],
+    },
+}
+
+# trees at the bottom and top rung
+MIN_BUDGET = 25
+MAX_BUDGET = 400
+
+# ---------- fold data in shared memory ----------
+# the feature matrix and labels are copied into shared memory once; trials
+# only get the name of the block plus row positions, so workers never pickle
+# or re-slice the frame
+
+_shared = {}
+_shared_specs = {}
+
+def share_array(arr):
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[:] = arr
+    return shm, (shm.name, arr.shape, arr.dtype.str)
+
+def _attach(specs):
+    # pool initializer: map the shared blocks once per worker
+    for key, (name, shape, dtype) in specs.items():
+        shm = shared_memory.SharedMemory(name=name)
+        _shared[key] = (shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf))
+
+def _block(key):
+    return _shared[key][1]
+
+def fold_positions(df, freq="season", min_train=None, window=None):
+    # same folds walk_forward_validate uses, as row positions into X / y
+    ml_df, pipeline = build_ml_features(df)
+    plan = plan_folds(df, freq=freq, min_train=min_train, window=window)
+    if not plan:
+        raise ValueError(f"not enough {freq} periods in the data for a walk-forward fold")
+    labels = period_labels(df, freq).reindex(ml_df.index)
+    folds = make_folds(ml_df, plan, labels)
+
+    X = ml_df[pipeline.feat_cols].to_numpy(dtype=np.float32)
+    y = ml_df["high_gap"].to_numpy(dtype=np.int8)
+    positions = [{
+        "fold": f["fold"],
+        "test_period": f["test_period"],
+        "train": ml_df.index.get_indexer(f["X_tr"].index),
+        "test": ml_df.index.get_indexer(f["X_te"].index),
+    } for f in folds]
+    return X, y, positions
+
+# ---------- trials ----------
+
+def _trial_job(args):
+    # one (config, budget, fold) fit, on the shared X / y
+    name, params, budget, fold, n_jobs = args
+    X, y = _block("X"), _block("y")
+    tr, te = _block(f"train_{fold}"), _block(f"test_{fold}")
+
+    t = time.perf_counter()
+    model = make_model(name, y[tr], n_jobs=n_jobs, params={**params, "n_estimators": budget})
+    model.fit(X[tr], y[tr])
+    p = model.predict_proba(X[te])[:, 1]
+    secs = time.perf_counter() - t
+    return roc_auc_score(y[te], p), average_precision_score(y[te], p), secs
+
+def sample_configs(name, n, seed=0):
+    # n distinct random configs from SEARCH_SPACE (all of them if the space is smaller)
+    space = SEARCH_SPACE[name]
+    grid = list(itertools.product(*space.values()))
+    rng = np.random.default_rng(seed)
+    picks = rng.permutation(len(grid))[:n]
+    return [dict(zip(space.keys(), grid[i])) for i in picks]
+
+def rung_budgets(eta=3, min_budget=MIN_BUDGET, max_budget=MAX_BUDGET):
+    # max_budget / eta**k for as many rungs as stay above min_budget
+    s_max = int(math.log(max_budget / min_budget, eta))
+    return [int(round(max_budget / eta ** (s_max - r))) for r in range(s_max + 1)]
+
+def successive_halving(name, configs, budgets, n_folds, run, eta=3, bracket=0, first_id=0):
+    # configs: list of param dicts. run(jobs) -> [(auc, ap, secs)] in job order.
+    # returns one row per (config, rung) it was scored at
+    rows = []
+    alive = list(enumerate(configs, start=first_id))
+    for rung, budget in enumerate(budgets):
+        jobs = [(name, params, budget, f) for _, params in alive for f in range(n_folds)]
+        scores = np.array(run(jobs)).reshape(len(alive), n_folds, 3)
+
+        rung_rows = []
+        for (cid, params), s in zip(alive, scores):
+            rung_rows.append({
+                "model": name,
+                "bracket": bracket,
+                "config_id": cid,
+                "rung": rung,
+                "n_estimators": budget,
+                **params,
+                "mean_auc": s[:, 0].mean(),
+                "std_auc": s[:, 0].std(),
+                "min_auc": s[:, 0].min(),
+                "mean_ap": s[:, 1].mean(),
+                "n_folds": n_folds,
+                "fit_s": s[:, 2].sum(),
+            })
+        rung_rows.sort(key=lambda r: r["mean_auc"], reverse=True)
+
+        keep = max(1, len(alive) // eta) if rung < len(budgets) - 1 else 0
+        for i, r in enumerate(rung_rows):
+            r["promoted"] = i < keep
+        rows += rung_rows
+
+        by_id = dict(alive)
+        alive = [(r["config_id"], by_id[r["config_id"]]) for r in rung_rows[:keep]]
+        print(f"  {name} bracket {bracket} rung {rung}: {len(rung_rows)} configs x {n_folds} folds "
+              f"@ {budget} trees, best auc {rung_rows[0]['mean_auc']:.4f}")
+    return rows
+
+def hyperband(name, n_folds, run, eta=3, min_budget=MIN_BUDGET, max_budget=MAX_BUDGET, seed=0):
+    # brackets from "many configs, start at min_budget" down to "a few configs
+    # straight at max_budget"
+    budgets = rung_budgets(eta, min_budget, max_budget)
+    s_max = len(budgets) - 1
+    rows, next_id = [], 0
+    for s in range(s_max, -1, -1):
+        n = int(math.ceil((s_max + 1) / (s + 1) * eta ** s))
+        configs = sample_configs(name, n, seed=seed + s)
+        rows += successive_halving(name, configs, budgets[s_max - s:], n_folds, run,
+                                   eta=eta, bracket=s_max - s, first_id=next_id)
+        next_id += len(configs)
+    return rows
+
+def _make_runner(workers, n_jobs_total):
+    # jobs come back in submission order, so results don't depend on timing
+    if workers == 1:
+        return lambda jobs: [_trial_job(j + (n_jobs_total,)) for j in jobs], None
+    threads = max(1, n_jobs_total // workers)
+    pool = ProcessPoolExecutor(max_workers=workers, initializer=_attach, initargs=(_shared_specs,))
+    return lambda jobs: list(pool.map(_trial_job, [j + (threads,) for j in jobs], chunksize=4)), pool
+
+def search(df, models=("rf", "xgb"), method="halving", n_configs=27, eta=3, workers=1,
+           min_budget=MIN_BUDGET, max_budget=MAX_BUDGET, seed=0, freq="season", min_train=None):
+    # method="halving": one bracket of n_configs random configs.
+    # method="hyperband": every bracket, n_configs is ignored.
+    # workers > 1 (None = all cores) runs the trials on a process pool.
+    # returns a tidy frame, one row per (config, rung), best first
+    X, y, positions = fold_positions(df, freq=freq, min_train=min_train)
+    blocks = {"X": X, "y": y}
+    for i, f in enumerate(positions):
+        blocks[f"train_{i}"] = f["train"]
+        blocks[f"test_{i}"] = f["test"]
+
+    n_cpu = os.cpu_count() or 1
+    workers = n_cpu if workers is None else max(1, workers)
+
+    handles = []
+    pool = None
+    try:
+        _shared_specs.clear()
+        for key, arr in blocks.items():
+            shm, spec = share_array(arr)
+            handles.append(shm)
+            _shared_specs[key] = spec
+        _attach(_shared_specs)
+        run, pool = _make_runner(workers, n_cpu)
+
+        rows = []
+        for name in models:
+            print(f"\n--- tuning {name} ({method}, {len(positions)} folds) ---")
+            if method == "hyperband":
+                rows += hyperband(name, len(positions), run, eta=eta, min_budget=min_budget,
+                                  max_budget=max_budget, seed=seed)
+            elif method == "halving":
+                configs = sample_configs(name, n_configs, seed=seed)
+                rows += successive_halving(name, configs, rung_budgets(eta, min_budget, max_budget),
+                                           len(positions), run, eta=eta)
+            else:
+                raise ValueError(f"unknown method {method}")
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        for shm, _ in _shared.values():
+            shm.close()
+        _shared.clear()
+        for shm in handles:
+            shm.close()
+            shm.unlink()
+
+    results = pd.DataFrame(rows)
+    params = [p for p in dict.fromkeys(k for name in models for k in SEARCH_SPACE[name])]
+    ids = ["model", "bracket", "config_id", "rung", "n_estimators"]
+    results = results[ids + params + [c for c in results.columns if c not in ids + params]]
+    # best first: most trees (the configs that survived longest), then auc
+    return results.sort_values(["model", "n_estimators", "mean_auc"], ascending=[True, False, False],
+                               ignore_index=True)
+
+def _choice(name, param, v):
+    # value from the frame back to the search-space entry it came from (so
+    # max_features 1.0 doesn't turn into the int 1, NaN depth is None again)
+    for c in SEARCH_SPACE[name][param]:
+        if (c is None and pd.isna(v)) or (c is not None and not pd.isna(v) and c == v):
+            return c
+    return v
+
+def best_params(results):
+    # {model: params} of the best config scored at the full budget, for
+    # train_models(params=...)
+    best = {}
+    for name, grp in results.groupby("model"):
+        top = grp[grp["n_estimators"] == grp["n_estimators"].max()]
+        top = top.sort_values("mean_auc", ascending=False).iloc[0]
+        best[name] = {p: _choice(name, p, top[p]) for p in SEARCH_SPACE[name]}
+        best[name]["n_estimators"] = int(top["n_estimators"])
+    return best
+
+if __name__ == "__main__":
+    import argparse
+    from src.load_data import load_all
+    from src.features import build_features_incremental
+
+    ap = argparse.ArgumentParser(description="tune rf / xgb over the walk-forward folds")
+    ap.add_argument("--model", action="append", choices=list(SEARCH_SPACE), help="default: all")
+    ap.add_argument("--method", default="halving", choices=["halving", "hyperband"])
+    ap.add_argument("--configs", type=int, default=27)
+    ap.add_argument("--eta", type=int, default=3)
+    ap.add_argument("--workers", type=int, default=None)
+    ap.add_argument("--out", default="output/results/tuning_results.csv")
+    args = ap.parse_args()
+
+    df = build_features_incremental(load_all())
+    results = search(df, models=args.model or list(SEARCH_SPACE), method=args.method,
+                     n_configs=args.configs, eta=args.eta, workers=args.workers)
+    os.makedirs(os.path.dirname(args.out), exist_ok=True)
+    results.to_csv(args.out, index=False)
+
+    top = results.groupby("model").head(5)
+    print("\n--- tuning: best configs ---")
+    print(top.drop(columns=["bracket", "promoted"]).round(4).to_string(index=False))
+    print(best_params(results))
@@ -1,22 +1,73 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
-from src.ml.train import build_ml_features, train_models
+from src.ml.train import build_ml_features, fit_model, update_model, MODEL_NAMES
 from src.ml.evaluate import evaluate_all
+from src.profiling import profiled
 
-seasons = ["2020-21", "2021-22", "2022-23", "2023-24", "2024-25"]
+# minimum number of earlier periods before the first test period
+MIN_TRAIN = {"season": 2, "month": 12, "week": 52}
 
-def walk_forward_validate(df):
-    ml_df, feat_cols = build_ml_features(df.copy())
+def period_labels(df, freq="season"):
+    # season = the csv season, month/week = rolling origins for retraining
+    # more often than once a year. week is the calendar week, which is close
+    # enough to a matchweek across leagues
+    if freq == "season":
+        return df["season"].astype(str)
+    if freq == "month":
+        return df["Date"].dt.to_period("M").astype(str)
+    if freq == "week":
+        return df["Date"].dt.to_period("W").astype(str)
+    raise ValueError(f"unknown freq {freq}")
 
-    all_preds = []
-    stats = []
+def discover_periods(df, freq="season"):
+    # every period present in the data, ordered by its first match
+    labels = period_labels(df, freq)
+    return list(df["Date"].groupby(labels.to_numpy()).min().sort_values().index)
+
+def plan_folds(df, freq="season", min_train=None, window=None):
+    # rolling-origin folds: test on each period in turn, train on everything
+    # before it (or the last `window` periods)
+    periods = discover_periods(df, freq)
+    min_train = MIN_TRAIN[freq] if min_train is None else min_train
 
-    for i in range(2, len(seasons)):
-        target = seasons[i]
-        train_seasons = seasons[:i]
+    plan = []
+    for i in range(min_train, len(periods)):
+        train = periods[:i] if window is None else periods[max(0, i - window):i]
+        plan.append({"fold": len(plan), "freq": freq, "test_period": periods[i], "train_periods": train})
+    return plan
 
-        train = ml_df[ml_df["season"].isin(train_seasons)].drop(columns="season")
-        test = ml_df[ml_df["season"] == target].drop(columns="season")
+def folds_to_frame(plan):
+    # flat, csv-friendly version of a plan. folds_from_frame reads it back, so
+    # any single fold can be re-run with walk_forward_validate(df, plan=...)
+    return pd.DataFrame([{
+        "fold": f["fold"],
+        "freq": f["freq"],
+        "test_period": f["test_period"],
+        "train_first": f["train_periods"][0],
+        "train_last": f["train_periods"][-1],
+        "n_train_periods": len(f["train_periods"]),
+        "train_periods": ";".join(f["train_periods"]),
+    } for f in plan])
+
+def folds_from_frame(frame):
+    return [{
+        "fold": int(r["fold"]),
+        "freq": r["freq"],
+        "test_period": str(r["test_period"]),
+        "train_periods": str(r["train_periods"]).split(";"),
+    } for _, r in frame.iterrows()]
+
+def make_folds(ml_df, plan, labels):
+    # labels: period label per ml_df row (period_labels on the full frame)
+    ml_df = ml_df.drop(columns="season")
+    folds = []
+    for f in plan:
+        target = f["test_period"]
+        train = ml_df[labels.isin(f["train_periods"])]
+        test = ml_df[labels == target]
 
         if len(test) == 0:
             print(f"  skip {target} — no rows")
@@ -25,32 +76,132 @@ def walk_forward_validate(df):
             print(f"  skip {target} — zero positives")
             continue
 
-        X_tr = train.drop(columns="high_gap")
-        y_tr = train["high_gap"]
-        X_te = test.drop(columns="high_gap")
-        y_te = test["high_gap"]
+        folds.append({
+            "fold": f["fold"],
+            "test_period": target,
+            "train_periods": f["train_periods"],
+            "X_tr": train.drop(columns="high_gap"),
+            "y_tr": train["high_gap"],
+            "X_te": test.drop(columns="high_gap"),
+            "y_te": test["high_gap"],
+        })
+    return folds
+
+def _fit_job(args):
+    name, X_tr, y_tr, n_jobs, registry_dir = args
+    t = time.perf_counter()
+    model = fit_model(name, X_tr, y_tr, n_jobs=n_jobs, registry_dir=registry_dir)
+    return model, time.perf_counter() - t
+
+def _incremental_job(args):
+    # one model carried through every fold in order
+    name, folds, n_jobs, registry_dir = args
+    out, prev, prev_idx = [], None, None
+    for fold in folds:
+        X_tr, y_tr = fold["X_tr"], fold["y_tr"]
+        t = time.perf_counter()
+        if prev is None:
+            model = fit_model(name, X_tr, y_tr, n_jobs=n_jobs, registry_dir=registry_dir)
+        else:
+            new = ~X_tr.index.isin(prev_idx)
+            model = update_model(name, prev, X_tr[new], y_tr[new], X_tr, y_tr, n_jobs=n_jobs,
+                                 registry_dir=registry_dir)
+        out.append((model, time.perf_counter() - t))
+        prev, prev_idx = model, X_tr.index
+    return out
+
+def _run_jobs(fn, args, workers):
+    if workers == 1:
+        return [fn(a) for a in args]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # map keeps job order, so the collected results don't depend on timing
+        return list(pool.map(fn, args))
+
+@profiled
+def fit_folds(folds, workers=1, mode="refit", registry_dir=None):
+    # mode="refit": one job per (fold, model), each fit from scratch.
+    # mode="incremental": one job per model that warm-starts fold to fold
+    # (see train.update_model), so only the new season is trained on.
+    # workers > 1 (None = all cores) runs the jobs on a process pool and
+    # splits the cores between them so rf/xgb threads don't oversubscribe.
+    # registry_dir serves repeat fits from the model registry.
+    # returns {fold index: {model: fitted}}, {fold index: {model: fit seconds}}
+    if mode == "refit":
+        jobs = [(i, name) for i in range(len(folds)) for name in MODEL_NAMES]
+    elif mode == "incremental":
+        jobs = list(MODEL_NAMES)
+    else:
+        raise ValueError(f"unknown mode {mode}")
+
+    n_cpu = os.cpu_count() or 1
+    if workers is None:
+        workers = n_cpu
+    workers = max(1, min(workers, len(jobs)))
+    threads = None if workers == 1 else max(1, n_cpu // workers)
+
+    fitted = {i: {} for i in range(len(folds))}
+    secs = {i: {} for i in range(len(folds))}
+    if mode == "refit":
+        args = [(name, folds[i]["X_tr"], folds[i]["y_tr"], threads, registry_dir) for i, name in jobs]
+        for (i, name), (model, t) in zip(jobs, _run_jobs(_fit_job, args, workers)):
+            fitted[i][name], secs[i][name] = model, t
+    else:
+        args = [(name, folds, threads, registry_dir) for name in jobs]
+        for name, chain in zip(jobs, _run_jobs(_incremental_job, args, workers)):
+            for i, (model, t) in enumerate(chain):
+                fitted[i][name], secs[i][name] = model, t
+    return fitted, secs
 
-        print(f"fold → train: {train_seasons}  |  test: {target}  "
-              f"|  train_pos: {y_tr.mean():.2%}  "
-              f"|  test_pos: {y_te.mean():.2%}  "
-              f"|  n_test: {len(test)}")
+@profiled
+def walk_forward_validate(df, workers=1, mode="refit", window=None, freq="season",
+                          min_train=None, plan=None, registry_dir=None):
+    # plan: a fold list from plan_folds / folds_from_frame. built from the
+    # data (freq, min_train, window) when not given
+    if mode == "incremental" and window is not None:
+        # trees fit on periods that have slid out of the window can't be removed
+        raise ValueError("incremental mode only supports the expanding window")
 
-        fitted = train_models(X_tr, y_tr)
-        results, probas = evaluate_all(fitted, X_te, y_te)
+    ml_df, _ = build_ml_features(df)
+
+    if plan is None:
+        plan = plan_folds(df, freq=freq, min_train=min_train, window=window)
+    if not plan:
+        raise ValueError(f"not enough {freq} periods in the data for a walk-forward fold")
+    labels = period_labels(df, plan[0]["freq"]).reindex(ml_df.index)
+
+    folds = make_folds(ml_df, plan, labels)
+    for fold in folds:
+        tr = fold["train_periods"]
+        print(f"fold {fold['fold']} → train: {tr[0]}..{tr[-1]} ({len(tr)})  |  test: {fold['test_period']}  "
+              f"|  train_pos: {fold['y_tr'].mean():.2%}  "
+              f"|  test_pos: {fold['y_te'].mean():.2%}  "
+              f"|  n_test: {len(fold['y_te'])}")
+
+    fitted_by_fold, fit_secs = fit_folds(folds, workers=workers, mode=mode, registry_dir=registry_dir)
+
+    all_preds = []
+    stats = []
+
+    for i, fold in enumerate(folds):
+        target, X_te, y_te = fold["test_period"], fold["X_te"], fold["y_te"]
+        results, probas = evaluate_all(fitted_by_fold[i], X_te, y_te)
 
         # collect metrics per model
         for _, row in results.iterrows():
             stats.append({
-                "season": target,
+                "fold": fold["fold"],
+                "test_period": target,
                 "model": row["model"],
                 "roc_auc": row["roc_auc"],
                 "avg_precision": row["avg_precision"],
-                "n_test": len(test),
+                "n_test": len(y_te),
                 "n_pos": int(y_te.sum()),
+                "fit_s": fit_secs[i][row["model"]],
             })
 
         tmp = pd.DataFrame(index=y_te.index)
-        tmp["season"] = target
+        tmp["fold"] = fold["fold"]
+        tmp["test_period"] = target
         tmp["y_true"] = y_te.values
         for m, probs in probas.items():
             tmp[f"{m}_prob"] = probs
@@ -66,4 +217,23 @@ def walk_forward_validate(df):
     avg = stats_df.groupby("model")[["roc_auc", "avg_precision"]].mean().round(4)
     print(avg)
 
-    return all_preds_df, stats_df
\ No newline at end of file
+    return all_preds_df, stats_df
+
+@profiled
+def compare_training_modes(df, baseline=None, workers=1, plan=None, registry_dir=None):
+    # incremental vs full-refit auc and fit time per fold. pass the refit
+    # fold_stats from walk_forward_validate as baseline to skip re-running it
+    if baseline is None:
+        _, baseline = walk_forward_validate(df, workers=workers, plan=plan, registry_dir=registry_dir)
+    _, incr = walk_forward_validate(df, workers=workers, mode="incremental", plan=plan,
+                                    registry_dir=registry_dir)
+
+    keys = ["fold", "test_period", "model"]
+    cols = keys + ["roc_auc", "avg_precision", "fit_s"]
+    out = baseline[cols].merge(incr[cols], on=keys, suffixes=("_refit", "_incremental"))
+    out["auc_delta"] = out["roc_auc_incremental"] - out["roc_auc_refit"]
+
+    print("\n--- walk-forward: refit vs incremental ---")
+    print(out[["test_period", "model", "roc_auc_refit", "roc_auc_incremental", "auc_delta",
+               "fit_s_refit", "fit_s_incremental"]].round(4).to_string(index=False))
+    return out